@@ -0,0 +1,96 @@
+import logging
+
+from typing import Callable
+from contextlib import asynccontextmanager
+from sqlalchemy.orm import Session
+from sqlalchemy.event import listens_for
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from slow_webhooks import timed_stage
+
+BEFORE_COMMIT_CALLBACKS_KEY = "before_commit_callbacks"
+AFTER_COMMIT_CALLBACKS_KEY = "after_commit_callbacks"
+AFTER_ROLLBACK_CALLBACKS_KEY = "after_rollback_callbacks"
+
+CALLBACKS_KEYS = (
+    BEFORE_COMMIT_CALLBACKS_KEY,
+    AFTER_COMMIT_CALLBACKS_KEY,
+    AFTER_ROLLBACK_CALLBACKS_KEY,
+)
+
+
+# Откладывает callback до успешного коммита транзакции сессии.
+# При откате транзакции отложенные callback'и отбрасываются.
+def call_after_commit(session: AsyncSession | Session, callback: Callable[[], None]):
+    session.info.setdefault(AFTER_COMMIT_CALLBACKS_KEY, []).append(callback)
+
+
+# Выполняет callback перед коммитом транзакции сессии. Ошибка callback'а
+# отменяет коммит, и транзакция откатывается.
+def call_before_commit(session: AsyncSession | Session, callback: Callable[[], None]):
+    session.info.setdefault(BEFORE_COMMIT_CALLBACKS_KEY, []).append(callback)
+
+
+# Выполняет callback после отката транзакции сессии, в том числе после
+# неудачного коммита. При успешном коммите callback отбрасывается.
+def call_after_rollback(session: AsyncSession | Session, callback: Callable[[], None]):
+    session.info.setdefault(AFTER_ROLLBACK_CALLBACKS_KEY, []).append(callback)
+
+
+# Точка сохранения внутри транзакции сессии. Если она откатывается, отбрасываются
+# и callback'и, отложенные внутри нее, а отложенные до нее остаются в силе.
+# Callback'и отката точки не выполняются: до коммита им нечего отменять.
+@asynccontextmanager
+async def savepoint(session: AsyncSession):
+    marks = {key: len(session.info.setdefault(key, [])) for key in CALLBACKS_KEYS}
+
+    try:
+        async with session.begin_nested():
+            yield
+    except BaseException:
+        for key, mark in marks.items():
+            del session.info.setdefault(key, [])[mark:]
+        raise
+
+
+# before_commit, after_commit и after_rollback срабатывают и для точек
+# сохранения: при их освобождении внешняя транзакция еще может откатиться, а
+# при откате callback'и точки отбрасывает сам savepoint. Поэтому callback'и
+# выполняются и отбрасываются только для корневой транзакции.
+@listens_for(Session, "before_commit")
+def _run_before_commit_callbacks(session: Session):
+    if session.in_nested_transaction():
+        return
+
+    for callback in session.info.pop(BEFORE_COMMIT_CALLBACKS_KEY, []):
+        callback()
+
+
+@listens_for(Session, "after_commit")
+def _run_after_commit_callbacks(session: Session):
+    if session.in_nested_transaction():
+        return
+
+    session.info.pop(AFTER_ROLLBACK_CALLBACKS_KEY, None)
+
+    with timed_stage("after_commit"):
+        for callback in session.info.pop(AFTER_COMMIT_CALLBACKS_KEY, []):
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"after commit callback failed: {e}", exc_info=True)
+
+
+@listens_for(Session, "after_rollback")
+def _run_after_rollback_callbacks(session: Session):
+    if session.in_nested_transaction():
+        return
+
+    session.info.pop(BEFORE_COMMIT_CALLBACKS_KEY, None)
+    session.info.pop(AFTER_COMMIT_CALLBACKS_KEY, None)
+
+    for callback in session.info.pop(AFTER_ROLLBACK_CALLBACKS_KEY, []):
+        try:
+            callback()
+        except Exception as e:
+            logging.error(f"after rollback callback failed: {e}", exc_info=True)
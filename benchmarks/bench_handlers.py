@@ -0,0 +1,292 @@
+# Бенчмарк обработчиков платежей с подсчетом SQL.
+#
+# Вызывает handle_succeeded_payment, handle_canceled_payment,
+# handle_succeeded_refund и add_referrer_bonus_if_needed напрямую на локальной
+# базе и через события движка SQLAlchemy считает для каждого вызова:
+#   statements  - выполненные запросы;
+#   round_trips - обращения к серверу: запросы, BEGIN, COMMIT/ROLLBACK и
+#                 точки сохранения;
+#   rows        - строки, которые драйвер вернул или изменил.
+# Кэш username -> user_id очищается перед каждым вызовом, поэтому поиск
+# пользователя всегда входит в счет. Каждая итерация работает со своими
+# пользователями и платежами, счет не зависит от предыдущих итераций.
+# pool_pre_ping отключен: в продакшене он добавляет одно обращение на каждое
+# получение соединения из пула.
+#
+# Печатается максимум по итерациям для каждого обработчика. Бюджета и
+# проверки нет: счет зависит от схемы из common и измеряется только на базе
+# с ней, поэтому его сравнивают с запуском до изменения запросов вручную.
+#
+# Нужна отдельная, не боевая база, настроенная через MI_YKP_POSTGRES_*.
+#
+# Запуск из корня репозитория: python -m benchmarks.bench_handlers
+import os
+import time
+import uuid
+import asyncio
+import argparse
+import tempfile
+
+from datetime import datetime
+from datetime import timezone
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from config import Config
+from db_engine import create_db_engine
+from webhook_decoder import Refund
+from webhook_decoder import Payment
+from user_id_cache import USER_ID_CACHE
+from event_log_writer import EventLogWriter
+from notification_outbox import NotificationOutbox
+from refund_handlers import handle_succeeded_refund
+from payment_handlers import handle_canceled_payment
+from payment_handlers import handle_succeeded_payment
+from payment_handlers import add_referrer_bonus_if_needed
+from common.models.db import User
+from common.models.db import ReferralType
+from benchmarks.bench_load import DEFAULT_ENV
+
+COUNTERS = ("statements", "round_trips", "rows")
+
+
+class SqlCounter:
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.counts = dict.fromkeys(COUNTERS, 0)
+
+    def install(self, engine):
+        sync_engine = engine.sync_engine
+
+        event.listen(sync_engine, "after_cursor_execute", self.__on_execute)
+
+        for name in ("begin", "commit", "rollback", "savepoint", "release_savepoint"):
+            event.listen(sync_engine, name, self.__on_transaction)
+
+    def __on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not self.enabled:
+            return
+
+        self.counts["statements"] += 1
+        self.counts["round_trips"] += 1
+        self.counts["rows"] += max(cursor.rowcount, 0)
+
+    def __on_transaction(self, conn, *args):
+        if self.enabled:
+            self.counts["round_trips"] += 1
+
+
+# Заглушка RwmsTasksProcessor: задачи только запоминаются.
+class RecordingTasksProcessor:
+    def __init__(self):
+        self.tasks = []
+
+    def schedule(self, payment_id: str, task):
+        self.tasks.append((payment_id, task))
+
+
+def payment(payment_id: str, username: str, status: str, autopay: bool, saved: bool):
+    now = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+    return Payment.model_validate(
+        {
+            "id": payment_id,
+            "status": status,
+            "amount": {"value": "299.00", "currency": "RUB"},
+            "created_at": now,
+            "captured_at": now if status == "succeeded" else None,
+            "payment_method": {"id": str(uuid.uuid4()), "saved": saved},
+            "metadata": {
+                "username": username,
+                "telegram_id": 1,
+                "subscription_period": "month",
+                "autopay": autopay,
+                "trial_promotion": False,
+                "from_trial": False,
+            },
+        }
+    )
+
+
+class HandlerBenchmark:
+    def __init__(self, session_maker, counter: SqlCounter):
+        self.__session_maker = session_maker
+        self.__counter = counter
+        self.__outbox = NotificationOutbox(publisher=None, session_maker=session_maker)
+        self.__event_log_writer = EventLogWriter(session_maker=session_maker)
+        self.__tasks_processor = RecordingTasksProcessor()
+        self.results: dict[str, list[dict]] = {}
+        self.durations: dict[str, list[float]] = {}
+
+    async def run_iteration(self, prefix: str):
+        username = f"{prefix}-user"
+        referrer = f"{prefix}-referrer"
+        referral = f"{prefix}-referral"
+        bonus_referral = f"{prefix}-bonus-referral"
+
+        await self.__seed_user(username)
+        referrer_id = await self.__seed_user(referrer)
+        await self.__seed_user(referral, referrer_id, ReferralType.STANDARD)
+        await self.__seed_user(bonus_referral, referrer_id, ReferralType.STANDARD)
+
+        succeeded = payment(f"{prefix}-1", username, "succeeded", False, False)
+        await self.__measure("succeeded_payment", self.__succeeded(succeeded))
+        await self.__measure("succeeded_duplicate", self.__succeeded(succeeded))
+
+        autopay = payment(f"{prefix}-2", username, "succeeded", True, True)
+        await self.__measure("succeeded_autopay", self.__succeeded(autopay))
+
+        with_referrer = payment(f"{prefix}-3", referral, "succeeded", False, False)
+        await self.__measure("succeeded_with_referrer", self.__succeeded(with_referrer))
+
+        canceled = payment(f"{prefix}-4", username, "canceled", True, False)
+        await self.__measure("canceled_autopay", self.__canceled(canceled))
+
+        await self.__measure("succeeded_refund", self.__refund(succeeded.id))
+
+        bonus = payment(f"{prefix}-5", bonus_referral, "succeeded", False, False)
+        await self.__measure("referrer_bonus", self.__referrer_bonus(bonus))
+
+    async def __measure(self, name: str, call):
+        USER_ID_CACHE.clear()
+        self.__counter.reset()
+        self.__counter.enabled = True
+        started_at = time.perf_counter()
+
+        try:
+            success = await call
+        finally:
+            self.__counter.enabled = False
+
+        if success is False:
+            raise RuntimeError(f"handler for {name} failed, see log")
+
+        self.durations.setdefault(name, []).append(time.perf_counter() - started_at)
+        self.results.setdefault(name, []).append(dict(self.__counter.counts))
+
+    async def __succeeded(self, payment):
+        return await handle_succeeded_payment(
+            outbox=self.__outbox,
+            event_log_writer=self.__event_log_writer,
+            tasks_processor=self.__tasks_processor,
+            session_maker=self.__session_maker,
+            payment=payment,
+            metadata=payment.metadata,
+        )
+
+    async def __canceled(self, payment):
+        return await handle_canceled_payment(
+            outbox=self.__outbox,
+            event_log_writer=self.__event_log_writer,
+            session_maker=self.__session_maker,
+            payment=payment,
+            metadata=payment.metadata,
+        )
+
+    async def __refund(self, payment_id: str):
+        refund = Refund(id=str(uuid.uuid4()), payment_id=payment_id, status="succeeded")
+        return await handle_succeeded_refund(self.__session_maker, refund)
+
+    async def __referrer_bonus(self, payment):
+        async with self.__session_maker() as session:
+            async with session.begin():
+                await add_referrer_bonus_if_needed(
+                    session=session,
+                    tasks_processor=self.__tasks_processor,
+                    payment_id=payment.id,
+                    metadata=payment.metadata,
+                    bonus_days_count=30,
+                )
+
+        return True
+
+    async def __seed_user(
+        self, username: str, referred_by_id: int | None = None, referral_type=None
+    ) -> int:
+        values = {"username": username, "telegram_id": 1}
+
+        if referred_by_id is not None:
+            values["referred_by_id"] = referred_by_id
+            values["referral_type"] = referral_type
+
+        async with self.__session_maker() as session:
+            user_id = await session.scalar(
+                insert(User).values(**values).returning(User.id)
+            )
+            await session.commit()
+
+        return user_id
+
+
+def summarize(benchmark: HandlerBenchmark) -> dict[str, dict]:
+    summary = {}
+
+    for name, results in benchmark.results.items():
+        durations = sorted(benchmark.durations[name])
+
+        summary[name] = {
+            **{counter: max(r[counter] for r in results) for counter in COUNTERS},
+            "calls": len(results),
+            "p50_ms": durations[len(durations) // 2] * 1000,
+        }
+
+    return summary
+
+
+async def run(args) -> dict[str, dict]:
+    engine = create_db_engine(Config())
+    session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+    counter = SqlCounter()
+    counter.install(engine)
+
+    benchmark = HandlerBenchmark(session_maker, counter)
+    run_id = uuid.uuid4().hex[:8]
+
+    try:
+        for i in range(args.iterations):
+            await benchmark.run_iteration(f"bench-sql-{run_id}-{i}")
+    finally:
+        await engine.dispose()
+
+    return summarize(benchmark)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="payment handler benchmark with SQL counting"
+    )
+    parser.add_argument("--iterations", type=int, default=20)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    for name, value in DEFAULT_ENV.items():
+        os.environ.setdefault(name, value)
+
+    os.environ.setdefault("MI_YKP_RWMS_ADDR", "127.0.0.1")
+    os.environ.setdefault("MI_YKP_RWMS_PORT", "50151")
+    os.environ["MI_YKP_POSTGRES_POOL_PRE_PING"] = "false"
+
+    # Outbox и журнал событий пишут файлы относительно текущей директории.
+    os.chdir(tempfile.mkdtemp(prefix="bench-handlers-"))
+
+    summary = asyncio.run(run(args))
+
+    print(f"{'handler':<26}{'statements':>12}{'round trips':>13}{'rows':>6}{'p50':>10}")
+
+    for name, measured in summary.items():
+        print(
+            f"{name:<26}{measured['statements']:>12}{measured['round_trips']:>13}"
+            f"{measured['rows']:>6}{measured['p50_ms']:>7.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
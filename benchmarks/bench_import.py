@@ -0,0 +1,243 @@
+# Бюджет времени импорта main.py.
+#
+# Пока импортируется main, сервер не принимает webhook'и, поэтому при
+# перезапуске контейнера время импорта - это окно, в котором YooKassa получает
+# отказы. Тяжелые зависимости, не нужные для приема webhook'а (SQLAlchemy,
+# asyncpg, redis, grpc, protobuf, обработчики), загружаются в фоне через
+# payment_service.
+#
+# Бенчмарк несколько раз импортирует main в отдельном процессе с
+# python -X importtime, печатает медиану времени импорта и самые тяжелые
+# прямые импорты и проверяет, что ни один модуль из forbidden_modules
+# (benchmarks/import_budget.json, вместе с подмодулями) не импортируется
+# вместе с main. При нарушении бенчмарк завершается с кодом 1. Бюджета
+# времени нет: время зависит от машины и от модуля common, и проверяется
+# только список модулей. Список запрещенных модулей правится вручную.
+#
+# Импорт main требует зависимостей образа и модуля common, поэтому
+# tests/test_import_budget.py дополнительно проверяет запрещенные модули по
+# исходникам (static_imports) - эта проверка работает без них.
+#
+# Запуск из корня репозитория: python -m benchmarks.bench_import
+import os
+import sys
+import ast
+import orjson
+import argparse
+import tempfile
+import subprocess
+
+from pathlib import Path
+
+from benchmarks.bench_load import DEFAULT_ENV
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+BUDGET_PATH = Path(__file__).resolve().parent / "import_budget.json"
+
+
+# Строка -X importtime: "import time: self [us] | cumulative | imported package",
+# вложенность импорта - отступ в последней колонке, по два пробела на уровень.
+def parse_importtime(output: str) -> list[dict]:
+    modules = []
+
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+
+        if not self_us.strip().isdigit():
+            continue
+
+        modules.append(
+            {
+                "name": name.strip(),
+                "depth": (len(name) - len(name.lstrip()) - 1) // 2,
+                "self_ms": int(self_us) / 1000,
+                "cumulative_ms": int(cumulative_us) / 1000,
+            }
+        )
+
+    return modules
+
+
+def import_main(workdir: Path) -> list[dict]:
+    env = {
+        **DEFAULT_ENV,
+        **os.environ,
+        "PYTHONPATH": str(REPO_DIR),
+        "MI_YKP_RWMS_ADDR": os.environ.get("MI_YKP_RWMS_ADDR", "127.0.0.1"),
+        "MI_YKP_RWMS_PORT": os.environ.get("MI_YKP_RWMS_PORT", "50151"),
+    }
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=workdir,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+
+    if result.returncode != 0:
+        raise RuntimeError(f"importing main failed:\n{result.stderr}")
+
+    return parse_importtime(result.stderr)
+
+
+# Вывод -X importtime идет в порядке завершения импорта: модуль печатается
+# после всех своих вложенных импортов. Прямые импорты main - записи глубины 1
+# между предыдущей записью глубины 0 и самим main.
+def main_children(modules: list[dict]) -> list[dict]:
+    index = next(i for i, m in enumerate(modules) if m["name"] == "main")
+    children = []
+
+    for module in reversed(modules[:index]):
+        if module["depth"] == 0:
+            break
+
+        if module["depth"] == 1:
+            children.append(module)
+
+    return children
+
+
+# Импорты верхнего уровня файла, включая импорты внутри if, try и with.
+# Импорты внутри функций выполняются позже и не учитываются.
+def top_level_imports(path: Path) -> list[str]:
+    names = []
+    nodes = list(ast.parse(path.read_text()).body)
+
+    while nodes:
+        node = nodes.pop()
+
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.append(node.module)
+            # Импортируемое имя может быть подмодулем пакета.
+            names.extend(f"{node.module}.{alias.name}" for alias in node.names)
+        elif isinstance(node, (ast.If, ast.Try, ast.With)):
+            nodes.extend(node.body)
+            nodes.extend(getattr(node, "orelse", []))
+            nodes.extend(getattr(node, "finalbody", []))
+
+            for handler in getattr(node, "handlers", []):
+                nodes.extend(handler.body)
+
+    return names
+
+
+def module_path(name: str) -> Path | None:
+    path = REPO_DIR.joinpath(*name.split("."))
+
+    for candidate in (path.with_suffix(".py"), path / "__init__.py"):
+        if candidate.is_file():
+            return candidate
+
+    return None
+
+
+# Модули, которые импортируются вместе с module, по исходникам: импорты
+# верхнего уровня модулей репозитория рекурсивно. Модули вне репозитория
+# (сторонние пакеты, common) попадают в результат, но их импорты не
+# разбираются.
+def static_imports(module: str) -> set[str]:
+    imported = set()
+    queue = [module]
+
+    while queue:
+        path = module_path(queue.pop())
+
+        if path is None:
+            continue
+
+        for name in top_level_imports(path):
+            parts = name.split(".")
+
+            for depth in range(1, len(parts) + 1):
+                parent = ".".join(parts[:depth])
+
+                if parent not in imported:
+                    imported.add(parent)
+                    queue.append(parent)
+
+    return imported
+
+
+def is_forbidden(name: str, forbidden: list[str]) -> bool:
+    return any(name == prefix or name.startswith(f"{prefix}.") for prefix in forbidden)
+
+
+def run(args, budget: dict) -> dict:
+    workdir = Path(tempfile.mkdtemp(prefix="bench-import-"))
+    durations = []
+    modules = []
+
+    for _ in range(args.runs):
+        modules = import_main(workdir)
+        main = next(m for m in modules if m["name"] == "main")
+        durations.append(main["cumulative_ms"])
+
+    durations.sort()
+    direct = sorted(
+        main_children(modules), key=lambda m: m["cumulative_ms"], reverse=True
+    )
+
+    return {
+        "import_main_ms": durations[len(durations) // 2],
+        "runs_ms": durations,
+        "modules": len(modules),
+        "heaviest": direct[: args.top],
+        "forbidden": sorted(
+            m["name"]
+            for m in modules
+            if is_forbidden(m["name"], budget["forbidden_modules"])
+        ),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="import time budget of main.py")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="heaviest imports to show")
+    parser.add_argument("--budget", type=Path, default=BUDGET_PATH)
+    return parser.parse_args()
+
+
+def check_budget(result: dict) -> list[str]:
+    violations = []
+
+    for name in result["forbidden"]:
+        violations.append(f"{name} is imported by main, load it in payment_service")
+
+    return violations
+
+
+def main():
+    args = parse_args()
+    budget = orjson.loads(args.budget.read_bytes())
+    result = run(args, budget)
+
+    print(
+        f"import main: {result['import_main_ms']:.0f} ms, {result['modules']} modules"
+    )
+    print("heaviest direct imports:")
+
+    for module in result["heaviest"]:
+        print(f"  {module['cumulative_ms']:8.1f} ms  {module['name']}")
+
+    violations = check_budget(result)
+
+    if violations:
+        print("import budget exceeded:")
+
+        for violation in violations:
+            print(f"  {violation}")
+
+        sys.exit(1)
+
+    print("import budget ok")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,475 @@
+# Нагрузочный бенчмарк сервиса целиком: от приема webhook'а до активации
+# подписки в RWMS.
+#
+# FastAPI-приложение из main.py поднимается в этом же процессе вместе с
+# lifespan и фоновыми обработчиками, а уведомления отправляются в него
+# напрямую через ASGI, без сети. RWMS заменяется локальным gRPC-сервером
+# (benchmarks/rwms_stub.py), Postgres и Redis - локальные экземпляры,
+# настроенные через обычные переменные окружения MI_YKP_*. Для бенчмарка
+# нужны отдельные, не боевые база и Redis: в базу добавляются пользователи
+# bench-user-*, а в очереди ботов уходят уведомления.
+#
+# YooKassa не подписывает уведомления, их подлинность проверяется по IP
+# отправителя, поэтому запросы приходят с адреса из диапазона YooKassa.
+#
+# Генерируются успешные ручные оплаты, автоплатежи, оплаты пробного периода,
+# отмены и возвраты в заданной пропорции, с заданной частотой и ограничением
+# числа одновременных запросов. Задержка ответа считается от запланированного
+# момента отправки, поэтому очередь перед переполненным сервисом в нее входит.
+# Время до активации - от отправки успешного платежа до вызова UpdateUser/AddUser
+# в RWMS для этого пользователя.
+#
+# Запуск из корня репозитория:
+#   python -m benchmarks.bench_load --rate 50 --count 2000 --output load.json
+import os
+import time
+import uuid
+import zlib
+import orjson
+import random
+import asyncio
+import argparse
+import tempfile
+import importlib
+
+from pathlib import Path
+from datetime import datetime
+from datetime import timezone
+from collections import deque
+
+WEBHOOK_PATH = "/yookassa/webhook"
+YOOKASSA_CLIENT = ("185.71.76.1", 443)
+
+DEFAULT_MIX = "succeeded=60,autopay=15,trial=10,canceled=10,refund=5"
+NOTIFICATION_KINDS = ("succeeded", "autopay", "trial", "canceled", "refund")
+
+# Возвраты выбирают платеж из последних успешных. Список ограничен, чтобы
+# длинный прогон не копил его в памяти бенчмарка.
+REFUNDABLE_PAYMENTS_KEPT = 10000
+
+# Переменные окружения, без которых сервис не запускается. Значения из
+# окружения имеют приоритет, RWMS всегда указывает на локальную замену.
+DEFAULT_ENV = {
+    "MI_YKP_HOST": "127.0.0.1",
+    "MI_YKP_PORT": "8000",
+    "MI_YKP_LOG_LEVEL": "warning",
+    "MI_YKP_INTERNAL_ALL_NODES_SQUAD_UUID": "00000000-0000-0000-0000-000000000000",
+    "MI_YKP_REDIS_HOST": "127.0.0.1",
+    "MI_YKP_REDIS_PORT": "6379",
+    "MI_YKP_REDIS_PASSWORD": "",
+    "MI_YKP_POSTGRES_HOST": "127.0.0.1",
+    "MI_YKP_POSTGRES_PORT": "5432",
+    "MI_YKP_POSTGRES_USER": "postgres",
+    "MI_YKP_POSTGRES_PASSWORD": "postgres",
+    "MI_YKP_POSTGRES_DB": "payment_bench",
+}
+
+
+def parse_mix(value: str) -> dict[str, float]:
+    mix = {}
+
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        kind = kind.strip()
+
+        if kind not in NOTIFICATION_KINDS:
+            raise argparse.ArgumentTypeError(f"unknown notification kind {kind!r}")
+
+        mix[kind] = float(weight)
+
+    return mix
+
+
+def percentiles(values: list[float]) -> dict[str, float | None]:
+    if not values:
+        return {
+            "count": 0,
+            "mean": None,
+            "p50": None,
+            "p95": None,
+            "p99": None,
+            "max": None,
+        }
+
+    ordered = sorted(values)
+
+    def rank(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": rank(0.50),
+        "p95": rank(0.95),
+        "p99": rank(0.99),
+        "max": ordered[-1],
+    }
+
+
+def telegram_id_for(username: str) -> int:
+    return zlib.crc32(username.encode())
+
+
+def iso_now() -> str:
+    return (
+        datetime.now(timezone.utc)
+        .isoformat(timespec="milliseconds")
+        .replace("+00:00", "Z")
+    )
+
+
+class NotificationFactory:
+    def __init__(self, usernames: list[str], mix: dict[str, float], seed: int):
+        self.__usernames = usernames
+        self.__kinds = list(mix)
+        self.__weights = list(mix.values())
+        self.__random = random.Random(seed)
+        self.__succeeded_payment_ids: deque[str] = deque(
+            maxlen=REFUNDABLE_PAYMENTS_KEPT
+        )
+
+    # Возвращает (вид, username или None, тело уведомления).
+    def next(self) -> tuple[str, str | None, bytes]:
+        kind = self.__random.choices(self.__kinds, self.__weights)[0]
+
+        if kind == "refund" and not self.__succeeded_payment_ids:
+            kind = "succeeded"
+
+        if kind == "refund":
+            return kind, None, self.__refund()
+
+        username = self.__random.choice(self.__usernames)
+        payment_id = str(uuid.uuid4())
+
+        if kind != "canceled":
+            self.__succeeded_payment_ids.append(payment_id)
+
+        return kind, username, self.__payment(kind, username, payment_id)
+
+    def __payment(self, kind: str, username: str, payment_id: str) -> bytes:
+        succeeded = kind != "canceled"
+        trial = kind == "trial"
+        now = iso_now()
+
+        payment = {
+            "id": payment_id,
+            "status": "succeeded" if succeeded else "canceled",
+            "paid": succeeded,
+            "amount": {"value": "10.00" if trial else "299.00", "currency": "RUB"},
+            "created_at": now,
+            "description": f"bench payment for {username}",
+            "metadata": {
+                "username": username,
+                "telegram_id": telegram_id_for(username),
+                "subscription_period": "threedays" if trial else "month",
+                "autopay": kind == "autopay",
+                "trial_promotion": trial,
+                "from_trial": False,
+            },
+            "payment_method": {
+                "type": "bank_card",
+                "id": str(uuid.uuid4()),
+                "saved": kind in ("autopay", "trial"),
+            },
+            "recipient": {"account_id": "100500", "gateway_id": "100700"},
+            "refundable": succeeded,
+            "test": True,
+        }
+
+        if succeeded:
+            payment["captured_at"] = now
+        else:
+            payment["cancellation_details"] = {
+                "party": "payment_network",
+                "reason": "insufficient_funds",
+            }
+
+        event = "payment.succeeded" if succeeded else "payment.canceled"
+        return orjson.dumps({"type": "notification", "event": event, "object": payment})
+
+    def __refund(self) -> bytes:
+        payment_id = self.__random.choice(self.__succeeded_payment_ids)
+
+        return orjson.dumps(
+            {
+                "type": "notification",
+                "event": "refund.succeeded",
+                "object": {
+                    "id": str(uuid.uuid4()),
+                    "payment_id": payment_id,
+                    "status": "succeeded",
+                    "amount": {"value": "299.00", "currency": "RUB"},
+                    "created_at": iso_now(),
+                },
+            }
+        )
+
+
+# Один POST-запрос к ASGI-приложению, возвращает HTTP-статус ответа.
+async def post_asgi(app, path: str, body: bytes) -> int:
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "https",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+        "client": YOOKASSA_CLIENT,
+        "server": ("127.0.0.1", 443),
+    }
+
+    request_sent = False
+    disconnected = asyncio.Event()
+    status = 0
+
+    async def receive():
+        nonlocal request_sent
+
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status
+
+        if message["type"] == "http.response.start":
+            status = message["status"]
+
+    await app(scope, receive, send)
+    disconnected.set()
+
+    return status
+
+
+class ActivationTracker:
+    def __init__(self):
+        self.__sent_at: dict[str, deque[float]] = {}
+        self.latencies: list[float] = []
+        self.expected = 0
+
+    def expect(self, username: str, sent_at: float):
+        self.__sent_at.setdefault(username, deque()).append(sent_at)
+        self.expected += 1
+
+    def on_activation(self, username: str):
+        pending = self.__sent_at.get(username)
+
+        if pending:
+            self.latencies.append(time.perf_counter() - pending.popleft())
+
+    @property
+    def received(self) -> int:
+        return len(self.latencies)
+
+
+async def seed_users(usernames: list[str]):
+    from sqlalchemy.dialects.postgresql import insert
+    from config import Config
+    from db_engine import create_db_engine
+    from common.models.db import User
+
+    engine = create_db_engine(Config())
+
+    try:
+        async with engine.begin() as connection:
+            await connection.execute(
+                insert(User)
+                .values(
+                    [
+                        {
+                            "username": username,
+                            "telegram_id": telegram_id_for(username),
+                        }
+                        for username in usernames
+                    ]
+                )
+                .on_conflict_do_nothing()
+            )
+    finally:
+        await engine.dispose()
+
+
+async def send_load(
+    app, args, factory: NotificationFactory, tracker: ActivationTracker
+):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    ack_latencies: list[float] = []
+    statuses: dict[str, int] = {}
+    kinds: dict[str, int] = {}
+    tasks = []
+
+    async def send_one(kind: str, username: str | None, body: bytes, planned_at: float):
+        async with semaphore:
+            if kind != "canceled" and kind != "refund":
+                tracker.expect(username, planned_at)
+
+            status = await post_asgi(app, WEBHOOK_PATH, body)
+
+        ack_latencies.append(time.perf_counter() - planned_at)
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    started_at = time.perf_counter()
+
+    for i in range(args.count):
+        planned_at = started_at + i / args.rate
+        delay = planned_at - time.perf_counter()
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        kind, username, body = factory.next()
+        kinds[kind] = kinds.get(kind, 0) + 1
+        tasks.append(asyncio.create_task(send_one(kind, username, body, planned_at)))
+
+    await asyncio.gather(*tasks)
+    duration = time.perf_counter() - started_at
+
+    return {
+        "sent": args.count,
+        "duration": duration,
+        "throughput": args.count / duration,
+        "kinds": kinds,
+        "statuses": statuses,
+        "http_ack": percentiles(ack_latencies),
+    }
+
+
+async def wait_for_activations(tracker: ActivationTracker, timeout: float) -> float:
+    started_at = time.perf_counter()
+
+    while tracker.received < tracker.expected:
+        if time.perf_counter() - started_at > timeout:
+            break
+
+        await asyncio.sleep(0.1)
+
+    return time.perf_counter() - started_at
+
+
+async def run(args) -> dict:
+    from benchmarks.rwms_stub import start_rwms_stub
+
+    tracker = ActivationTracker()
+    usernames = [f"bench-user-{i}" for i in range(args.users)]
+
+    server, rwms_stub = await start_rwms_stub(
+        args.rwms_port, args.rwms_latency, tracker.on_activation
+    )
+
+    for username in usernames:
+        rwms_stub.add_expired_user(username)
+
+    await seed_users(usernames)
+    main = importlib.import_module("main")
+
+    factory = NotificationFactory(usernames, args.mix, args.seed)
+
+    try:
+        async with main.app.router.lifespan_context(main.app):
+            load = await send_load(main.app, args, factory, tracker)
+            drain = await wait_for_activations(tracker, args.drain_timeout)
+    finally:
+        await server.stop(grace=None)
+
+    return {
+        "benchmark": "load",
+        "started_at": iso_now(),
+        "config": {
+            "rate": args.rate,
+            "concurrency": args.concurrency,
+            "count": args.count,
+            "users": args.users,
+            "mix": args.mix,
+            "rwms_latency": args.rwms_latency,
+            "seed": args.seed,
+        },
+        **load,
+        "activation": {
+            **percentiles(tracker.latencies),
+            "expected": tracker.expected,
+            "drain_seconds": drain,
+        },
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="end-to-end load benchmark of the payment service"
+    )
+    parser.add_argument("--rate", type=float, default=50, help="webhooks per second")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--count", type=int, default=1000, help="webhooks to send")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--rwms-port", type=int, default=50151)
+    parser.add_argument(
+        "--rwms-latency", type=float, default=0.02, help="RWMS stub latency, seconds"
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=60,
+        help="seconds to wait for activations after the last webhook",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", type=Path, default=None)
+    parser.add_argument("--output", type=Path, default=Path("bench-load.json"))
+    return parser.parse_args()
+
+
+# Окружение сервиса и рабочая директория. Вызывается до импорта main.
+def prepare_service(args, prefix: str) -> Path:
+    for name, value in DEFAULT_ENV.items():
+        os.environ.setdefault(name, value)
+
+    os.environ["MI_YKP_RWMS_ADDR"] = "127.0.0.1"
+    os.environ["MI_YKP_RWMS_PORT"] = str(args.rwms_port)
+
+    # Spool-директории сервиса создаются относительно текущей директории.
+    workdir = args.workdir or Path(tempfile.mkdtemp(prefix=prefix))
+    workdir.mkdir(parents=True, exist_ok=True)
+    os.chdir(workdir)
+
+    return workdir
+
+
+def main():
+    args = parse_args()
+    output = args.output.resolve()
+    workdir = prepare_service(args, "bench-load-")
+
+    result = asyncio.run(run(args))
+    result["workdir"] = str(workdir)
+
+    output.write_bytes(orjson.dumps(result, option=orjson.OPT_INDENT_2))
+
+    print(
+        f"sent {result['sent']} webhooks in {result['duration']:.1f}s "
+        f"({result['throughput']:.1f}/s), statuses {result['statuses']}"
+    )
+
+    for name in ("http_ack", "activation"):
+        stats = result[name]
+
+        if stats["count"]:
+            print(
+                f"{name:<12} p50 {stats['p50'] * 1000:8.1f} ms"
+                f"  p95 {stats['p95'] * 1000:8.1f} ms"
+                f"  p99 {stats['p99'] * 1000:8.1f} ms  ({stats['count']})"
+            )
+
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,433 @@
+# Длительный прогон сервиса для поиска утечек памяти.
+#
+# Сервис поднимается так же, как в benchmarks/bench_load.py: приложение из
+# main.py в этом же процессе, RWMS - локальная замена, Postgres и Redis -
+# отдельные, не боевые экземпляры. Webhook'и отправляются с постоянной
+# частотой часами, а через заданные интервалы записываются:
+#   rss_mb    - резидентная память процесса (/proc/self/status);
+#   traced_mb - память Python-объектов по tracemalloc.
+# Перед каждым замером выполняется gc.collect(), чтобы циклический мусор не
+# выглядел как рост.
+#
+# Первые --warmup webhook'ов не учитываются: за это время заполняются кэши
+# (user_id, журнал медленных webhook'ов, пул соединений) и метки метрик.
+# После прогрева снимается базовый снимок tracemalloc. Рост считается как
+# наклон прямой методом наименьших квадратов по замерам после прогрева и
+# пересчитывается на 100 тысяч webhook'ов. В конце финальный снимок
+# сравнивается с базовым и выводятся места аллокаций с наибольшим ростом.
+# Если рост traced или RSS на 100 тысяч webhook'ов выше порога, бенчмарк
+# завершается с кодом 1.
+#
+# Уровень логирования по умолчанию info, чтобы форматирование логов тоже
+# участвовало в прогоне. За часы работы лог занимает заметное место на диске.
+#
+# tracemalloc замедляет выделение памяти в несколько раз, поэтому задержки
+# в этом режиме не показательны - для них есть bench_load.
+#
+# Запуск из корня репозитория:
+#   python -m benchmarks.bench_soak --duration 14400 --rate 100 --output soak.json
+import gc
+import os
+import sys
+import time
+import orjson
+import asyncio
+import argparse
+import importlib
+import tracemalloc
+
+from pathlib import Path
+
+from benchmarks.bench_load import DEFAULT_MIX
+from benchmarks.bench_load import WEBHOOK_PATH
+from benchmarks.bench_load import NotificationFactory
+from benchmarks.bench_load import iso_now
+from benchmarks.bench_load import parse_mix
+from benchmarks.bench_load import post_asgi
+from benchmarks.bench_load import seed_users
+from benchmarks.bench_load import prepare_service
+from benchmarks.rwms_stub import start_rwms_stub
+
+GROWTH_UNIT = 100_000  # webhooks
+
+# Аллокации самого tracemalloc и бенчмарка не относятся к сервису.
+SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, f"{Path(__file__).resolve().parent}/*"),
+)
+
+
+def read_rss() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # Не Linux: пиковое значение лучше, чем ничего.
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+# Наклон прямой y = a + b * x методом наименьших квадратов.
+def slope(xs: list[float], ys: list[float]) -> float | None:
+    if len(xs) < 2:
+        return None
+
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+
+    if variance == 0:
+        return None
+
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / variance
+
+
+# Считает только количества: списки задержек за часы прогона сами были бы утечкой.
+class SoakCounters:
+    def __init__(self):
+        self.sent = 0
+        self.acked = 0
+        self.expected_activations = 0
+        self.activations = 0
+        self.statuses: dict[str, int] = {}
+
+    def on_activation(self, username: str):
+        self.activations += 1
+
+
+class MemorySampler:
+    def __init__(self, counters: SoakCounters, warmup: int):
+        self.__counters = counters
+        self.__warmup = warmup
+        self.__started_at = time.perf_counter()
+        self.baseline: tracemalloc.Snapshot | None = None
+        self.samples: list[dict] = []
+
+    def sample(self):
+        gc.collect()
+
+        traced, _ = tracemalloc.get_traced_memory()
+        sample = {
+            "elapsed": time.perf_counter() - self.__started_at,
+            "webhooks": self.__counters.acked,
+            "activations": self.__counters.activations,
+            "rss_mb": read_rss() / 2**20,
+            "traced_mb": traced / 2**20,
+            "after_warmup": self.baseline is not None,
+        }
+
+        if self.baseline is None and self.__counters.acked >= self.__warmup:
+            self.baseline = take_snapshot()
+            sample["after_warmup"] = True
+
+        self.samples.append(sample)
+
+        print(
+            f"{sample['elapsed']:8.0f}s  webhooks {sample['webhooks']:>9}  "
+            f"rss {sample['rss_mb']:8.1f} MB  traced {sample['traced_mb']:8.1f} MB"
+            f"{'' if sample['after_warmup'] else '  (warmup)'}",
+            flush=True,
+        )
+
+    # Рост на GROWTH_UNIT webhook'ов по замерам после прогрева, в килобайтах.
+    def growth(self) -> dict[str, float | None]:
+        measured = [s for s in self.samples if s["after_warmup"]]
+        xs = [s["webhooks"] for s in measured]
+        growth = {}
+
+        for name in ("rss", "traced"):
+            value = slope(xs, [s[f"{name}_mb"] for s in measured])
+            growth[f"{name}_kb_per_100k"] = (
+                None if value is None else value * GROWTH_UNIT * 1024
+            )
+
+        return growth
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.sample()
+
+
+def take_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+
+def top_growth(
+    baseline: tracemalloc.Snapshot, snapshot: tracemalloc.Snapshot, limit: int
+) -> list[dict]:
+    stats = snapshot.compare_to(baseline, "traceback")
+
+    return [
+        {
+            "site": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+            "size_diff_kb": stat.size_diff / 1024,
+            "count_diff": stat.count_diff,
+            "size_kb": stat.size / 1024,
+        }
+        for stat in stats[:limit]
+        if stat.size_diff > 0
+    ]
+
+
+# Открытая нагрузка с постоянной частотой до конца прогона. Незавершенные
+# запросы хранятся во множестве и удаляются из него по завершении.
+async def send_soak_load(app, args, factory: NotificationFactory, counters):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    in_flight: set[asyncio.Task] = set()
+
+    async def send_one(kind: str, body: bytes):
+        async with semaphore:
+            if kind != "canceled" and kind != "refund":
+                counters.expected_activations += 1
+
+            status = str(await post_asgi(app, WEBHOOK_PATH, body))
+
+        counters.acked += 1
+        counters.statuses[status] = counters.statuses.get(status, 0) + 1
+
+    started_at = time.perf_counter()
+
+    while True:
+        planned_at = started_at + counters.sent / args.rate
+
+        if planned_at - started_at >= args.duration:
+            break
+
+        if args.count and counters.sent >= args.count:
+            break
+
+        delay = planned_at - time.perf_counter()
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        kind, _, body = factory.next()
+        counters.sent += 1
+
+        task = asyncio.create_task(send_one(kind, body))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    if in_flight:
+        await asyncio.gather(*in_flight)
+
+    return time.perf_counter() - started_at
+
+
+async def run(args) -> dict:
+    counters = SoakCounters()
+    usernames = [f"bench-user-{i}" for i in range(args.users)]
+
+    server, rwms_stub = await start_rwms_stub(
+        args.rwms_port, args.rwms_latency, counters.on_activation
+    )
+
+    for username in usernames:
+        rwms_stub.add_expired_user(username)
+
+    await seed_users(usernames)
+    main = importlib.import_module("main")
+
+    factory = NotificationFactory(usernames, args.mix, args.seed)
+    sampler = MemorySampler(counters, args.warmup)
+
+    try:
+        async with main.app.router.lifespan_context(main.app):
+            sampler.sample()
+            sampling = asyncio.create_task(sampler.run(args.snapshot_interval))
+
+            try:
+                duration = await send_soak_load(main.app, args, factory, counters)
+            finally:
+                sampling.cancel()
+
+            # Даем обработчикам разобрать очередь, чтобы финальный замер
+            # не включал необработанные webhook'и.
+            drain_started_at = time.perf_counter()
+
+            while counters.activations < counters.expected_activations:
+                if time.perf_counter() - drain_started_at > args.drain_timeout:
+                    break
+
+                await asyncio.sleep(0.5)
+
+            sampler.sample()
+    finally:
+        await server.stop(grace=None)
+
+    growth = sampler.growth()
+    violations = []
+
+    for name, limit in (
+        ("traced", args.max_traced_growth_kb),
+        ("rss", args.max_rss_growth_kb),
+    ):
+        value = growth[f"{name}_kb_per_100k"]
+
+        if value is not None and value > limit:
+            violations.append(
+                f"{name} grows {value:.0f} KB per 100k webhooks, limit {limit:.0f} KB"
+            )
+
+    if sampler.baseline is None:
+        violations.append(
+            f"warmup of {args.warmup} webhooks was not reached, nothing measured"
+        )
+        growth_sites = []
+    else:
+        growth_sites = top_growth(sampler.baseline, take_snapshot(), args.top)
+
+    return {
+        "benchmark": "soak",
+        "started_at": iso_now(),
+        "config": {
+            "duration": args.duration,
+            "count": args.count,
+            "rate": args.rate,
+            "concurrency": args.concurrency,
+            "users": args.users,
+            "mix": args.mix,
+            "rwms_latency": args.rwms_latency,
+            "warmup": args.warmup,
+            "snapshot_interval": args.snapshot_interval,
+            "traceback_frames": args.traceback_frames,
+            "seed": args.seed,
+        },
+        "sent": counters.sent,
+        "duration": duration,
+        "statuses": counters.statuses,
+        "activations": counters.activations,
+        "expected_activations": counters.expected_activations,
+        "samples": sampler.samples,
+        "growth": growth,
+        "top_growth": growth_sites,
+        "violations": violations,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="soak test of the payment service with memory growth tracking"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=3600, help="seconds to send webhooks"
+    )
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=0,
+        help="stop after this many webhooks, 0 - no limit",
+    )
+    parser.add_argument("--rate", type=float, default=100, help="webhooks per second")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX))
+    parser.add_argument("--rwms-port", type=int, default=50151)
+    parser.add_argument(
+        "--rwms-latency", type=float, default=0.02, help="RWMS stub latency, seconds"
+    )
+    parser.add_argument(
+        "--warmup",
+        type=int,
+        default=20000,
+        help="webhooks before the baseline snapshot",
+    )
+    parser.add_argument(
+        "--snapshot-interval", type=float, default=60, help="seconds between samples"
+    )
+    parser.add_argument(
+        "--traceback-frames",
+        type=int,
+        default=1,
+        help="frames kept per allocation, more frames cost more memory and time",
+    )
+    parser.add_argument(
+        "--max-traced-growth-kb",
+        type=float,
+        default=1024,
+        help="allowed Python heap growth per 100k webhooks",
+    )
+    parser.add_argument(
+        "--max-rss-growth-kb",
+        type=float,
+        default=4096,
+        help="allowed RSS growth per 100k webhooks",
+    )
+    parser.add_argument(
+        "--top", type=int, default=20, help="allocation sites in the report"
+    )
+    parser.add_argument(
+        "--drain-timeout",
+        type=float,
+        default=120,
+        help="seconds to wait for activations after the last webhook",
+    )
+    parser.add_argument("--log-level", default="info")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", type=Path, default=None)
+    parser.add_argument("--output", type=Path, default=Path("bench-soak.json"))
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    output = args.output.resolve()
+
+    os.environ["MI_YKP_LOG_LEVEL"] = args.log_level
+    workdir = prepare_service(args, "bench-soak-")
+
+    # До импорта main, чтобы в базовый снимок попали объекты, созданные при импорте.
+    tracemalloc.start(args.traceback_frames)
+
+    result = asyncio.run(run(args))
+    result["workdir"] = str(workdir)
+
+    output.write_bytes(orjson.dumps(result, option=orjson.OPT_INDENT_2))
+
+    growth = result["growth"]
+    print(
+        f"sent {result['sent']} webhooks in {result['duration']:.0f}s, "
+        f"statuses {result['statuses']}, activations "
+        f"{result['activations']}/{result['expected_activations']}"
+    )
+
+    for name in ("traced", "rss"):
+        value = growth[f"{name}_kb_per_100k"]
+        print(
+            f"{name:<7} growth "
+            f"{'n/a' if value is None else f'{value:.0f} KB'} per 100k webhooks"
+        )
+
+    if result["top_growth"]:
+        print("top growing allocation sites:")
+
+        for site in result["top_growth"]:
+            print(
+                f"  {site['size_diff_kb']:+10.1f} KB {site['count_diff']:+8} blocks  "
+                f"{site['site'][-1]}"
+            )
+
+    print(f"results written to {output}")
+
+    if result["violations"]:
+        print("memory growth limit exceeded:")
+
+        for violation in result["violations"]:
+            print(f"  {violation}")
+
+        sys.exit(1)
+
+    print("memory growth ok")
+
+
+if __name__ == "__main__":
+    main()
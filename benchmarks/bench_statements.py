@@ -0,0 +1,89 @@
+# Микро-бенчмарк накладных расходов на построение SQL-запросов платежа.
+#
+# Сравнивает старый путь, в котором text()/select()/insert() собирались
+# внутри обработчика на каждый webhook, с реестром из statements.py.
+# На каждый execute SQLAlchemy строит ключ кэша запроса и по нему
+# находит скомпилированный SQL, поэтому измеряются три варианта:
+#   build+compile  - сборка и полная компиляция (кэш компиляции холодный);
+#   build+key      - сборка и ключ кэша (старый путь с теплым кэшем);
+#   registry key   - только ключ кэша заранее собранного запроса.
+#
+# Запуск из корня репозитория: python -m benchmarks.bench_statements
+import timeit
+
+from sqlalchemy import text
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import insert
+
+import statements
+from common.models.db import User
+from common.models.db import YkPayment
+
+ITERATIONS = 20000
+DIALECT = postgresql.dialect()
+
+
+def build_extend_expire_at():
+    return text("""
+        UPDATE users
+            SET expire_at =
+            CASE
+                WHEN expire_at > (NOW() AT TIME ZONE 'UTC') THEN expire_at + (:interval)::interval
+                ELSE (NOW() AT TIME ZONE 'UTC') + (:interval)::interval
+            END
+            WHERE username = :username
+        """)
+
+
+def build_select_autopay_allow():
+    return select(User.autopay_allow).where(User.username == "username")
+
+
+def build_insert_payment():
+    return insert(YkPayment).values(
+        is_trial_promotion=False,
+        user_id=1,
+        amount=199,
+        currency="RUB",
+        status="succeeded",
+        captured_at=None,
+        created_at=None,
+        payment_id="payment-id",
+        subscription_period="month",
+    )
+
+
+CASES = {
+    "extend_expire_at": (build_extend_expire_at, statements.EXTEND_EXPIRE_AT),
+    "select_autopay_allow": (
+        build_select_autopay_allow,
+        statements.SELECT_AUTOPAY_ALLOW_BY_USERNAME,
+    ),
+    "insert_payment": (
+        build_insert_payment,
+        statements.INSERT_PAYMENT_IF_NOT_EXISTS,
+    ),
+}
+
+
+def measure(func) -> float:
+    seconds = timeit.timeit(func, number=ITERATIONS)
+    return seconds / ITERATIONS * 1_000_000
+
+
+def main():
+    print(
+        f"{'statement':<24}{'build+compile':>16}{'build+key':>14}{'registry key':>16}"
+    )
+
+    for name, (build, prebuilt) in CASES.items():
+        compiled = measure(lambda: build().compile(dialect=DIALECT))
+        keyed = measure(lambda: build()._generate_cache_key())
+        registry = measure(lambda: prebuilt._generate_cache_key())
+
+        print(f"{name:<24}{compiled:>13.1f} us{keyed:>11.1f} us{registry:>13.1f} us")
+
+
+if __name__ == "__main__":
+    main()
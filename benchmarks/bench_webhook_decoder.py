@@ -0,0 +1,102 @@
+# Сравнение разбора уведомления через yookassa SDK с webhook_decoder.
+#
+# SDK-путь: orjson.loads + WebhookNotificationFactory().create + Metadata.model_validate.
+# Lean-путь: decode_notification прямо из байтов, Metadata валидируется там же.
+# Для каждого пути печатается время на webhook и число/объем выделений памяти.
+#
+# Запуск из корня репозитория: python -m benchmarks.bench_webhook_decoder
+import orjson
+import timeit
+import tracemalloc
+
+from yookassa.domain.notification import WebhookNotificationFactory
+
+from metadata import Metadata
+from webhook_decoder import decode_notification
+
+ITERATIONS = 20000
+
+PAYLOAD = orjson.dumps(
+    {
+        "type": "notification",
+        "event": "payment.succeeded",
+        "object": {
+            "id": "2e8a5a5f-000f-5000-9000-1b5fd2d6e4a4",
+            "status": "succeeded",
+            "paid": True,
+            "amount": {"value": "199.00", "currency": "RUB"},
+            "income_amount": {"value": "192.03", "currency": "RUB"},
+            "authorization_details": {
+                "rrn": "603668397306",
+                "auth_code": "000000",
+                "three_d_secure": {"applied": True},
+            },
+            "captured_at": "2024-11-05T10:21:33.102Z",
+            "created_at": "2024-11-05T10:20:43.317Z",
+            "description": "Подписка на месяц",
+            "metadata": {
+                "username": "user-123456",
+                "telegram_id": "123456",
+                "subscription_period": "month",
+                "autopay": "false",
+                "trial_promotion": "false",
+                "from_trial": "false",
+            },
+            "payment_method": {
+                "type": "bank_card",
+                "id": "2e8a5a5f-000f-5000-9000-1b5fd2d6e4a4",
+                "saved": True,
+                "title": "Bank card *4444",
+                "card": {
+                    "first6": "555555",
+                    "last4": "4444",
+                    "expiry_month": "12",
+                    "expiry_year": "2030",
+                    "card_type": "MasterCard",
+                    "issuer_country": "RU",
+                },
+            },
+            "recipient": {"account_id": "100500", "gateway_id": "100700"},
+            "refundable": True,
+            "refunded_amount": {"value": "0.00", "currency": "RUB"},
+            "test": False,
+        },
+    }
+)
+
+
+def decode_with_sdk():
+    notification = WebhookNotificationFactory().create(orjson.loads(PAYLOAD))
+    return Metadata.model_validate(notification.object.metadata)
+
+
+def decode_lean():
+    return decode_notification(PAYLOAD).object.metadata
+
+
+def measure_allocations(func) -> tuple[int, int]:
+    tracemalloc.start()
+    snapshot_before = tracemalloc.take_snapshot()
+    result = func()
+    snapshot_after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    del result
+
+    stats = snapshot_after.compare_to(snapshot_before, "lineno")
+    count = sum(stat.count_diff for stat in stats if stat.count_diff > 0)
+    size = sum(stat.size_diff for stat in stats if stat.size_diff > 0)
+    return count, size
+
+
+def main():
+    print(f"{'decoder':<10}{'time':>12}{'allocations':>14}{'bytes':>10}")
+
+    for name, func in (("sdk", decode_with_sdk), ("lean", decode_lean)):
+        func()
+        seconds = timeit.timeit(func, number=ITERATIONS) / ITERATIONS
+        count, size = measure_allocations(func)
+        print(f"{name:<10}{seconds * 1_000_000:>9.1f} us{count:>14}{size:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# Локальная замена RWMS для нагрузочных тестов.
+#
+# gRPC-сервер RwManager, который хранит пользователей в памяти и отвечает
+# с заданной задержкой. Каждое продление подписки (AddUser/UpdateUser)
+# передается в on_activation, по нему считается время от оплаты до активации.
+import uuid
+import grpc
+import asyncio
+
+from typing import Callable
+from datetime import datetime
+from datetime import timezone
+from google.protobuf.timestamp_pb2 import Timestamp
+
+import proto.rwmanager_pb2 as proto
+from proto.rwmanager_pb2_grpc import RwManagerServicer
+from proto.rwmanager_pb2_grpc import add_RwManagerServicer_to_server
+
+
+class RwmsStub(RwManagerServicer):
+    def __init__(self, latency: float, on_activation: Callable[[str], None]):
+        self.__latency = latency
+        self.__on_activation = on_activation
+        self.__users: dict[str, proto.UserResponse] = {}
+        self.__usernames_by_uuid: dict[str, str] = {}
+
+    # Пользователь с истекшей подпиской, как у пользователя, который продлевает ее.
+    def add_expired_user(self, username: str):
+        expire_at = Timestamp()
+        expire_at.FromDatetime(datetime(2020, 1, 1, tzinfo=timezone.utc))
+
+        user = proto.UserResponse(
+            uuid=str(uuid.uuid4()),
+            username=username,
+            status=proto.UserStatus.ACTIVE,
+            expire_at=expire_at,
+        )
+
+        self.__users[username] = user
+        self.__usernames_by_uuid[user.uuid] = username
+
+    async def GetUserByUsername(self, request, context):
+        await asyncio.sleep(self.__latency)
+        user = self.__users.get(request.username)
+
+        if user is None:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "user not found")
+
+        return user
+
+    async def AddUser(self, request, context):
+        await asyncio.sleep(self.__latency)
+
+        user = proto.UserResponse(
+            uuid=str(uuid.uuid4()),
+            username=request.username,
+            status=request.status,
+            expire_at=request.expire_at,
+        )
+
+        self.__users[request.username] = user
+        self.__usernames_by_uuid[user.uuid] = request.username
+        self.__on_activation(request.username)
+
+        return user
+
+    async def UpdateUser(self, request, context):
+        await asyncio.sleep(self.__latency)
+        username = self.__usernames_by_uuid.get(request.uuid)
+
+        if username is None:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "user not found")
+
+        user = self.__users[username]
+        user.expire_at.CopyFrom(request.expire_at)
+        self.__on_activation(username)
+
+        return user
+
+
+async def start_rwms_stub(
+    port: int, latency: float, on_activation: Callable[[str], None]
+) -> tuple[grpc.aio.Server, RwmsStub]:
+    server = grpc.aio.server()
+    stub = RwmsStub(latency=latency, on_activation=on_activation)
+
+    add_RwManagerServicer_to_server(stub, server)
+    server.add_insecure_port(f"127.0.0.1:{port}")
+    await server.start()
+
+    return server, stub
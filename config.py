@@ -1,4 +1,5 @@
 import os
+import socket
 
 # yk payment
 MI_YKP_HOST = "MI_YKP_HOST"
@@ -17,6 +18,9 @@ MI_YKP_RWMS_PORT = "MI_YKP_RWMS_PORT"
 MI_YKP_REDIS_HOST = "MI_YKP_REDIS_HOST"
 MI_YKP_REDIS_PORT = "MI_YKP_REDIS_PORT"
 MI_YKP_REDIS_PASSWORD = "MI_YKP_REDIS_PASSWORD"
+MI_YKP_REDIS_TRANSPORT = "MI_YKP_REDIS_TRANSPORT"
+MI_YKP_REDIS_STREAM_MAXLEN = "MI_YKP_REDIS_STREAM_MAXLEN"
+MI_YKP_REDIS_STREAM_LAG_THRESHOLD = "MI_YKP_REDIS_STREAM_LAG_THRESHOLD"
 
 # postgres
 MI_YKP_POSTGRES_HOST = "MI_YKP_POSTGRES_HOST"
@@ -24,6 +28,36 @@ MI_YKP_POSTGRES_PORT = "MI_YKP_POSTGRES_PORT"
 MI_YKP_POSTGRES_USER = "MI_YKP_POSTGRES_USER"
 MI_YKP_POSTGRES_PASSWORD = "MI_YKP_POSTGRES_PASSWORD"
 MI_YKP_POSTGRES_DB = "MI_YKP_POSTGRES_DB"
+MI_YKP_POSTGRES_POOL_SIZE = "MI_YKP_POSTGRES_POOL_SIZE"
+MI_YKP_POSTGRES_MAX_OVERFLOW = "MI_YKP_POSTGRES_MAX_OVERFLOW"
+MI_YKP_POSTGRES_POOL_TIMEOUT = "MI_YKP_POSTGRES_POOL_TIMEOUT"
+MI_YKP_POSTGRES_POOL_RECYCLE = "MI_YKP_POSTGRES_POOL_RECYCLE"
+MI_YKP_POSTGRES_POOL_PRE_PING = "MI_YKP_POSTGRES_POOL_PRE_PING"
+MI_YKP_POSTGRES_STATEMENT_CACHE_SIZE = "MI_YKP_POSTGRES_STATEMENT_CACHE_SIZE"
+
+# user id cache
+MI_YKP_USER_ID_CACHE_SIZE = "MI_YKP_USER_ID_CACHE_SIZE"
+MI_YKP_USER_ID_CACHE_TTL = "MI_YKP_USER_ID_CACHE_TTL"
+
+# tracing
+MI_YKP_TRACE_SAMPLE_RATE = "MI_YKP_TRACE_SAMPLE_RATE"
+
+# tuning
+MI_YKP_TUNING_FILE = "MI_YKP_TUNING_FILE"
+
+# partitions
+MI_YKP_PARTITIONS = "MI_YKP_PARTITIONS"
+MI_YKP_NODE_ID = "MI_YKP_NODE_ID"
+MI_YKP_PARTITION_LEASE_TTL = "MI_YKP_PARTITION_LEASE_TTL"
+MI_YKP_SHARED_SPOOL = "MI_YKP_SHARED_SPOOL"
+
+# readiness
+MI_YKP_WARMUP_TIMEOUT = "MI_YKP_WARMUP_TIMEOUT"
+MI_YKP_READINESS_MAX_QUEUE_LAG = "MI_YKP_READINESS_MAX_QUEUE_LAG"
+
+# debug
+MI_YKP_DEBUG_TOKEN = "MI_YKP_DEBUG_TOKEN"
+MI_YKP_LOOP_STALL_THRESHOLD_MS = "MI_YKP_LOOP_STALL_THRESHOLD_MS"
 
 
 class Config:
@@ -50,6 +84,18 @@ class Config:
         self.redis_host: str = self.__read_required_str_env(MI_YKP_REDIS_HOST)
         self.redis_port: int = self.__read_required_int_env(MI_YKP_REDIS_PORT)
         self.redis_password: str = self.__read_required_str_env(MI_YKP_REDIS_PASSWORD)
+        self.redis_transport: str = os.getenv(MI_YKP_REDIS_TRANSPORT, "list")
+        self.redis_stream_maxlen: int = self.__read_int_env(
+            MI_YKP_REDIS_STREAM_MAXLEN, 100000
+        )
+        self.redis_stream_lag_threshold: int = self.__read_int_env(
+            MI_YKP_REDIS_STREAM_LAG_THRESHOLD, 50000
+        )
+
+        if self.redis_transport not in ("list", "stream"):
+            raise ValueError(
+                f"{MI_YKP_REDIS_TRANSPORT} must be 'list' or 'stream', got {self.redis_transport!r}"
+            )
 
         # postgres envs
         self.pg_host: str = self.__read_required_str_env(MI_YKP_POSTGRES_HOST)
@@ -57,6 +103,79 @@ class Config:
         self.pg_user: str = self.__read_required_str_env(MI_YKP_POSTGRES_USER)
         self.pg_password: str = self.__read_required_str_env(MI_YKP_POSTGRES_PASSWORD)
         self.pg_db: str = self.__read_required_str_env(MI_YKP_POSTGRES_DB)
+        self.pg_pool_size: int = self.__read_int_env(MI_YKP_POSTGRES_POOL_SIZE, 10)
+        self.pg_max_overflow: int = self.__read_int_env(
+            MI_YKP_POSTGRES_MAX_OVERFLOW, 10
+        )
+        self.pg_pool_timeout: int = self.__read_int_env(
+            MI_YKP_POSTGRES_POOL_TIMEOUT, 30
+        )
+        self.pg_pool_recycle: int = self.__read_int_env(
+            MI_YKP_POSTGRES_POOL_RECYCLE, 1800
+        )
+        self.pg_pool_pre_ping: bool = (
+            os.getenv(MI_YKP_POSTGRES_POOL_PRE_PING, "true") == "true"
+        )
+        self.pg_statement_cache_size: int = self.__read_int_env(
+            MI_YKP_POSTGRES_STATEMENT_CACHE_SIZE, 100
+        )
+
+        # user id cache envs
+        self.user_id_cache_size: int = self.__read_int_env(
+            MI_YKP_USER_ID_CACHE_SIZE, 10000
+        )
+        self.user_id_cache_ttl: int = self.__read_int_env(
+            MI_YKP_USER_ID_CACHE_TTL, 3600
+        )
+
+        # tracing envs
+        self.trace_sample_rate: float = self.__read_float_env(
+            MI_YKP_TRACE_SAMPLE_RATE, 0.0
+        )
+
+        if not 0.0 <= self.trace_sample_rate <= 1.0:
+            raise ValueError(
+                f"{MI_YKP_TRACE_SAMPLE_RATE} must be between 0 and 1, got {self.trace_sample_rate}"
+            )
+
+        # tuning envs: файл с параметрами пропускной способности (tuning.py)
+        self.tuning_file: str = os.getenv(MI_YKP_TUNING_FILE, "tuning.json")
+
+        # partition envs: число разделов spool (partitions.py) - одинаковое на
+        # всех узлах, имя процесса во владении разделами и срок аренды раздела
+        # в Redis, секунды. Делить разделы между процессами через Redis можно,
+        # только если spool-директории webhooks/ и rwms-tasks/ у них общие
+        # (MI_YKP_SHARED_SPOOL=true, partition_ownership.py). По умолчанию
+        # spool локальный и процесс обрабатывает все разделы своего spool.
+        self.partitions: int = self.__read_int_env(MI_YKP_PARTITIONS, 1)
+        self.node_id: str = os.getenv(
+            MI_YKP_NODE_ID, f"{socket.gethostname()}:{os.getpid()}"
+        )
+        self.partition_lease_ttl: float = self.__read_float_env(
+            MI_YKP_PARTITION_LEASE_TTL, 15.0
+        )
+        self.shared_spool: bool = os.getenv(MI_YKP_SHARED_SPOOL, "false") == "true"
+
+        if self.partitions < 1:
+            raise ValueError(
+                f"{MI_YKP_PARTITIONS} must be at least 1, got {self.partitions}"
+            )
+
+        # readiness envs: сколько ждать соединений при запуске и при каком
+        # отставании очереди webhook'ов экземпляр перестает быть готовым, секунды.
+        # Отставание растет на всех экземплярах сразу, когда недоступна общая
+        # зависимость, поэтому по умолчанию (0) готовность от него не зависит.
+        self.warmup_timeout: float = self.__read_float_env(MI_YKP_WARMUP_TIMEOUT, 10.0)
+        self.readiness_max_queue_lag: float = self.__read_float_env(
+            MI_YKP_READINESS_MAX_QUEUE_LAG, 0.0
+        )
+
+        # debug envs: без токена отладочные эндпоинты выключены,
+        # при нулевом пороге сторож зависаний event loop не запускается
+        self.debug_token: str | None = os.getenv(MI_YKP_DEBUG_TOKEN) or None
+        self.loop_stall_threshold_ms: int = self.__read_int_env(
+            MI_YKP_LOOP_STALL_THRESHOLD_MS, 0
+        )
 
     def __read_required_int_env(self, name: str) -> int:
         value = os.getenv(name)
@@ -69,6 +188,23 @@ class Config:
         except ValueError:
             raise ValueError(f"{name} must be an integer, got {value!r}")
 
+    def __read_int_env(self, name: str, default: int) -> int:
+        if os.getenv(name) is None:
+            return default
+
+        return self.__read_required_int_env(name)
+
+    def __read_float_env(self, name: str, default: float) -> float:
+        value = os.getenv(name)
+
+        if value is None:
+            return default
+
+        try:
+            return float(value)
+        except ValueError:
+            raise ValueError(f"{name} must be a number, got {value!r}")
+
     def __read_required_str_env(self, name: str) -> str:
         value = os.getenv(name)
 
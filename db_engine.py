@@ -0,0 +1,77 @@
+import time
+import asyncio
+import logging
+
+from contextlib import AsyncExitStack
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.util.queue import AsyncAdaptedQueue
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from config import Config
+from metrics import DB_POOL_CHECKOUT_SECONDS
+
+SLOW_CHECKOUT_THRESHOLD = 1.0  # seconds
+
+
+# Время ожидания свободного соединения в очереди пула. Создание нового
+# соединения сверх очереди (overflow) сюда не входит: его ожидание - это
+# время установки соединения, а не нехватка пула.
+class TimedAsyncAdaptedQueue(AsyncAdaptedQueue):
+    def get(self, block: bool = True, timeout: float | None = None):
+        started_at = time.perf_counter()
+
+        try:
+            return super().get(block, timeout)
+        finally:
+            wait = time.perf_counter() - started_at
+            DB_POOL_CHECKOUT_SECONDS.observe(wait)
+
+            if wait >= SLOW_CHECKOUT_THRESHOLD:
+                logging.warning(
+                    f"waited {wait:.3f}s for a postgres connection, pool is too small for the load"
+                )
+
+
+class TimedAsyncQueuePool(AsyncAdaptedQueuePool):
+    _queue_class = TimedAsyncAdaptedQueue
+
+
+def create_db_engine(config: Config) -> AsyncEngine:
+    database_url = (
+        f"postgresql+asyncpg://{config.pg_user}:{config.pg_password}@{config.pg_host}:{config.pg_port}/{config.pg_db}"
+        f"?prepared_statement_cache_size={config.pg_statement_cache_size}"
+    )
+
+    return create_async_engine(
+        database_url,
+        echo=False,
+        poolclass=TimedAsyncQueuePool,
+        pool_size=config.pg_pool_size,
+        max_overflow=config.pg_max_overflow,
+        pool_timeout=config.pg_pool_timeout,
+        pool_recycle=config.pg_pool_recycle,
+        pool_pre_ping=config.pg_pool_pre_ping,
+        connect_args={"statement_cache_size": config.pg_statement_cache_size},
+    )
+
+
+async def ping_db(engine: AsyncEngine):
+    async with engine.connect() as connection:
+        await connection.exec_driver_sql("SELECT 1")
+
+
+# Открывает size соединений одновременно и возвращает их в пул,
+# чтобы первые платежи после деплоя не платили за установку соединения.
+async def prewarm_pool(engine: AsyncEngine, size: int):
+    started_at = time.perf_counter()
+
+    async with AsyncExitStack() as stack:
+        await asyncio.gather(
+            *(stack.enter_async_context(engine.connect()) for _ in range(size))
+        )
+
+    logging.info(
+        f"postgres pool warmed up with {size} connections "
+        f"in {time.perf_counter() - started_at:.3f}s"
+    )
@@ -0,0 +1,205 @@
+import time
+import orjson
+import asyncio
+import logging
+
+from pathlib import Path
+from sqlalchemy import select
+from sqlalchemy import insert
+from sqlalchemy.exc import InterfaceError
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from common.models.db import User
+from common.models.db import EventLog
+from common.models.analytics_event import AnalyticsEvent
+from user_id_cache import USER_ID_CACHE
+from after_commit import call_after_commit
+from tuning import TUNING
+
+# Сколько раз файл событий пытаются записать в базу, прежде чем отложить его
+# в failed/. Ошибки соединения с базой попыток не тратят.
+EVENT_LOG_MAX_ATTEMPTS = 3
+
+
+# Буферизованная запись событий аналитики в event_logs.
+# События дописываются в файл на диске (чтобы не потерять их при падении)
+# и вставляются в базу пачкой одним INSERT по размеру буфера или по таймеру,
+# вне транзакции обработки платежа.
+class EventLogWriter:
+    def __init__(self, session_maker: async_sessionmaker):
+        self.__session_maker = session_maker
+
+        self.__event_logs_dir = Path("event-logs")
+        self.__flushing_dir = self.__event_logs_dir / "flushing"
+        self.__failed_dir = self.__event_logs_dir / "failed"
+        self.__buffer_path = self.__event_logs_dir / "buffer.jsonl"
+
+        self.__event_logs_dir.mkdir(parents=True, exist_ok=True)
+        self.__flushing_dir.mkdir(parents=True, exist_ok=True)
+        self.__failed_dir.mkdir(parents=True, exist_ok=True)
+
+        self.__buffer = open(self.__buffer_path, "ab")
+        self.__buffered_count = 0
+        self.__flush_requested = asyncio.Event()
+        self.__flush_lock = asyncio.Lock()
+        self.__attempts: dict[str, int] = {}
+
+    def enqueue(self, username: str, event: AnalyticsEvent, user_id: int | None = None):
+        record = {
+            "username": username,
+            "user_id": user_id,
+            "event_type": event.event_type,
+            "event_payload": event.model_dump(mode="json"),
+        }
+
+        self.__buffer.write(orjson.dumps(record) + b"\n")
+        self.__buffer.flush()
+        self.__buffered_count += 1
+
+        if self.__buffered_count >= TUNING.values.event_log_flush_size:
+            self.__flush_requested.set()
+
+    # Событие попадет в буфер только после успешного коммита транзакции сессии.
+    # Если транзакция откатится, событие будет отброшено вместе с ней.
+    def enqueue_after_commit(
+        self, session: AsyncSession, username: str, event: AnalyticsEvent
+    ):
+        call_after_commit(session, lambda: self.enqueue(username, event))
+
+    async def process(self):
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self.__flush_requested.wait(),
+                    timeout=TUNING.values.event_log_flush_interval,
+                )
+            except asyncio.TimeoutError:
+                pass
+
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.error(f"flushing event logs failed: {e}", exc_info=True)
+
+    async def flush(self):
+        async with self.__flush_lock:
+            self.__flush_requested.clear()
+            self.__rotate_buffer()
+
+            for file in sorted(self.__flushing_dir.glob("*.jsonl")):
+                try:
+                    await self.__flush_file(file)
+                except (OperationalError, InterfaceError, OSError) as e:
+                    # База недоступна - остальные файлы подождут следующей записи.
+                    logging.error(f"flushing event logs from {file.name} failed: {e}")
+                    return
+                except Exception as e:
+                    logging.error(
+                        f"flushing event logs from {file.name} failed: {e}",
+                        exc_info=True,
+                    )
+                    self.__count_failed_attempt(file)
+
+    # Файл, который не записывается из-за своего содержимого, после
+    # EVENT_LOG_MAX_ATTEMPTS попыток откладывается в failed/, чтобы не
+    # задерживать следующие файлы. Вернуть его можно переносом в flushing/.
+    def __count_failed_attempt(self, file: Path):
+        attempts = self.__attempts.get(file.name, 0) + 1
+
+        if attempts < EVENT_LOG_MAX_ATTEMPTS:
+            self.__attempts[file.name] = attempts
+            return
+
+        self.__attempts.pop(file.name, None)
+
+        try:
+            file.rename(self.__failed_dir / file.name)
+            logging.error(f"event logs from {file.name} moved to {self.__failed_dir}")
+        except Exception as e:
+            logging.error(f"failed to move {file.name} to {self.__failed_dir}: {e}")
+
+    def __rotate_buffer(self):
+        if self.__buffered_count == 0 and self.__buffer_path.stat().st_size == 0:
+            return
+
+        self.__buffer.close()
+        self.__buffer_path.rename(self.__flushing_dir / f"{time.time_ns()}.jsonl")
+        self.__buffer = open(self.__buffer_path, "ab")
+        self.__buffered_count = 0
+
+    async def __flush_file(self, file: Path):
+        records = []
+
+        for line in file.read_bytes().splitlines():
+            try:
+                records.append(orjson.loads(line))
+            except orjson.JSONDecodeError:
+                # Последняя строка может быть недописана, если процесс упал во время записи.
+                logging.error(f"skipping malformed event log record in {file.name}")
+
+        if records:
+            async with self.__session_maker() as session:
+                async with session.begin():
+                    rows = await self.__records_to_rows(session, records)
+
+                    if rows:
+                        await session.execute(insert(EventLog), rows)
+
+            logging.info(f"flushed {len(records)} event logs from {file.name}")
+
+        file.unlink()
+        self.__attempts.pop(file.name, None)
+
+    async def __records_to_rows(
+        self, session: AsyncSession, records: list[dict]
+    ) -> list[dict]:
+        user_ids: dict[str, int] = {}
+        unknown_usernames = set()
+
+        for record in records:
+            username = record["username"]
+
+            if record["user_id"] is not None:
+                user_ids[username] = record["user_id"]
+                continue
+
+            user_id = USER_ID_CACHE.get(username)
+
+            if user_id is not None:
+                user_ids[username] = user_id
+            else:
+                unknown_usernames.add(username)
+
+        unknown_usernames -= user_ids.keys()
+
+        if unknown_usernames:
+            result = await session.execute(
+                select(User.username, User.id).where(
+                    User.username.in_(unknown_usernames)
+                )
+            )
+
+            for username, user_id in result:
+                USER_ID_CACHE.put(username, user_id)
+                user_ids[username] = user_id
+
+        rows = []
+
+        for record in records:
+            user_id = user_ids.get(record["username"])
+
+            if user_id is None:
+                logging.error(f"not found user id for username {record['username']}")
+                continue
+
+            rows.append(
+                {
+                    "user_id": user_id,
+                    "event_type": record["event_type"],
+                    "event_payload": record["event_payload"],
+                }
+            )
+
+        return rows
@@ -0,0 +1,240 @@
+import io
+import sys
+import time
+import asyncio
+import logging
+import threading
+
+from pathlib import Path
+from collections import deque
+from collections import Counter
+
+# Диагностика event loop без передеплоя: сэмплирующий профайлер, стеки задач
+# и сторож зависаний. Профайлер и сторож работают в отдельных потоках и читают
+# стек потока event loop через sys._current_frames(), поэтому видят именно тот
+# синхронный код, который сейчас держит loop (запись на диск, логирование,
+# сериализацию), и ничего не меняют в самом loop.
+
+REPO_DIR = Path(__file__).resolve().parent
+
+MAX_PROFILE_SECONDS = 300
+MAX_STACK_DEPTH = 128
+STALL_HISTORY_SIZE = 100
+HEARTBEAT_INTERVAL = 0.01  # seconds
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})"
+
+
+def _stack_of_thread(thread_id: int) -> list:
+    frame = sys._current_frames().get(thread_id)
+    stack = []
+
+    while frame is not None and len(stack) < MAX_STACK_DEPTH:
+        stack.append(frame)
+        frame = frame.f_back
+
+    stack.reverse()
+    return stack
+
+
+# Самый глубокий кадр из кода сервиса - обработчик, который держит loop.
+def _culprit(stack: list) -> str | None:
+    for frame in reversed(stack):
+        if Path(frame.f_code.co_filename).resolve().is_relative_to(REPO_DIR):
+            return _frame_label(frame)
+
+    return _frame_label(stack[-1]) if stack else None
+
+
+# Сэмплирует стек потока event loop с заданным интервалом. Результат - стеки
+# в свернутом формате ("кадр;кадр;кадр N"), который понимают flamegraph.pl,
+# speedscope и inferno.
+class LoopSampler:
+    def __init__(self, thread_id: int, interval: float):
+        self.__thread_id = thread_id
+        self.__interval = interval
+        self.__samples: Counter[str] = Counter()
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(
+            target=self.__run, name="loop-sampler", daemon=True
+        )
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        self.__thread.join()
+
+    def collapsed(self) -> str:
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.__samples.most_common()
+        )
+
+    def __run(self):
+        while not self.__stopped.wait(self.__interval):
+            stack = _stack_of_thread(self.__thread_id)
+
+            if stack:
+                self.__samples[";".join(_frame_label(f) for f in stack)] += 1
+
+
+class LoopProfiler:
+    def __init__(self):
+        self.__lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.__lock.locked()
+
+    # Должен вызываться из потока event loop.
+    async def profile(self, seconds: float, interval: float) -> str:
+        async with self.__lock:
+            sampler = LoopSampler(threading.get_ident(), interval)
+            sampler.start()
+            logging.info(f"profiling event loop for {seconds}s every {interval}s")
+
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                sampler.stop()
+
+            return sampler.collapsed()
+
+
+# Сторож зависаний: корутина-пульс обновляет метку времени, а поток проверяет,
+# что пульс не отстает больше чем на threshold. Если отстает, loop занят
+# синхронным кодом - стек этого кода записывается и логируется один раз на
+# зависание, а после его окончания фиксируется полная длительность.
+class LoopStallWatchdog:
+    def __init__(self):
+        self.__threshold = 0.0
+        self.__last_beat = time.monotonic()
+        self.__loop_thread_id: int | None = None
+        self.__heartbeat: asyncio.Task | None = None
+        self.__thread: threading.Thread | None = None
+        self.__stopped = threading.Event()
+        self.__current_stall: dict | None = None
+        self.__window_lock = asyncio.Lock()
+        self.stalls: deque[dict] = deque(maxlen=STALL_HISTORY_SIZE)
+
+    @property
+    def threshold(self) -> float:
+        return self.__threshold
+
+    @property
+    def running(self) -> bool:
+        return self.__heartbeat is not None
+
+    @property
+    def window_running(self) -> bool:
+        return self.__window_lock.locked()
+
+    # Запись зависаний дольше threshold в течение seconds. Если сторож уже
+    # работает с большим порогом, порог временно снижается.
+    async def watch_for(self, threshold: float, seconds: float) -> list[dict]:
+        async with self.__window_lock:
+            started_at = time.time()
+            was_running = self.running
+            previous_threshold = self.__threshold
+
+            if was_running:
+                self.__threshold = min(previous_threshold, threshold)
+            else:
+                self.start(threshold)
+
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                if was_running:
+                    self.__threshold = previous_threshold
+                else:
+                    self.stop()
+
+            return [stall for stall in self.stalls if stall["started_at"] >= started_at]
+
+    # Должен вызываться из потока event loop.
+    def start(self, threshold: float):
+        self.__threshold = threshold
+
+        if self.running:
+            return
+
+        self.__loop_thread_id = threading.get_ident()
+        self.__last_beat = time.monotonic()
+        self.__stopped.clear()
+        self.__heartbeat = asyncio.create_task(self.__beat())
+        self.__thread = threading.Thread(
+            target=self.__watch, name="loop-stall-watchdog", daemon=True
+        )
+        self.__thread.start()
+
+        logging.info(f"loop stall watchdog started with threshold {threshold}s")
+
+    def stop(self):
+        if not self.running:
+            return
+
+        self.__stopped.set()
+        self.__heartbeat.cancel()
+        self.__heartbeat = None
+        self.__thread.join()
+
+        logging.info("loop stall watchdog stopped")
+
+    async def __beat(self):
+        while True:
+            self.__last_beat = time.monotonic()
+
+            if self.__current_stall is not None:
+                self.__finish_stall()
+
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    def __watch(self):
+        while not self.__stopped.wait(max(self.__threshold / 4, HEARTBEAT_INTERVAL)):
+            blocked_for = time.monotonic() - self.__last_beat - HEARTBEAT_INTERVAL
+
+            if blocked_for < self.__threshold or self.__current_stall is not None:
+                continue
+
+            stack = _stack_of_thread(self.__loop_thread_id)
+            stall = {
+                "started_at": time.time() - blocked_for,
+                "duration": None,
+                "culprit": _culprit(stack),
+                "stack": [_frame_label(frame) for frame in stack],
+            }
+
+            self.__current_stall = stall
+            self.stalls.append(stall)
+
+            logging.warning(
+                f"event loop blocked for {blocked_for * 1000:.0f}ms in {stall['culprit']}, "
+                f"stack: {' <- '.join(reversed(stall['stack']))}"
+            )
+
+    def __finish_stall(self):
+        stall = self.__current_stall
+        self.__current_stall = None
+        stall["duration"] = time.time() - stall["started_at"]
+
+        logging.warning(
+            f"event loop was blocked for {stall['duration'] * 1000:.0f}ms in {stall['culprit']}"
+        )
+
+
+def format_task_stacks() -> str:
+    output = io.StringIO()
+    tasks = sorted(asyncio.all_tasks(), key=lambda task: task.get_name())
+
+    output.write(f"{len(tasks)} tasks\n\n")
+
+    for task in tasks:
+        task.print_stack(file=output)
+        output.write("\n")
+
+    return output.getvalue()
@@ -1,69 +1,133 @@
-import orjson
+import os
+import hmac
+import time
+import signal
 import logging
+import pydantic
 import asyncio
+import orjson
 import uvicorn
+import importlib
 
 from fastapi import FastAPI
 from fastapi import Request
 from fastapi import HTTPException
 from fastapi import Depends
+from fastapi.responses import Response
 from fastapi.responses import JSONResponse
+from fastapi.responses import PlainTextResponse
 from contextlib import asynccontextmanager
 from yookassa.domain.common import SecurityHelper
-from yookassa.domain.notification import WebhookNotificationFactory
-from sqlalchemy.ext.asyncio import create_async_engine
-from sqlalchemy.ext.asyncio import async_sessionmaker
 
 from config import Config
 from common.setup_logger import setup_logger
-from webhook_processor import WebhookProcessor
-from rwms_tasks_processor import RwmsTasksProcessor
-from redis_message_publisher import RedisMessagePublisher
+from webhook_spool import WebhookSpool
+from tracing import TRACER
+from tuning import TUNING
+from tuning import LOG_LEVELS
+from tuning import apply_log_level
+from metrics import SPOOL_STATS
+from metrics import render_metrics
+from metrics import METRICS_CONTENT_TYPE
+from metrics import HTTP_RECEIVE_SECONDS
+from metrics import WEBHOOKS_RECEIVED_TOTAL
+from metrics import webhook_event_label
+from webhook_decoder import HANDLED_EVENTS
+from webhook_decoder import decode_envelope
+from webhook_decoder import get_partition_key
+from loop_profiler import LoopProfiler
+from loop_profiler import LoopStallWatchdog
+from loop_profiler import MAX_PROFILE_SECONDS
+from loop_profiler import format_task_stacks
+from slow_webhooks import SLOW_WEBHOOKS
 
 config = Config()
 
-log_level = logging.INFO
-
-if config.log_level.lower() == "debug":
-    log_level = logging.DEBUG
-if config.log_level.lower() == "info":
-    log_level = logging.INFO
-if config.log_level.lower() == "warning":
-    log_level = logging.WARN
-if config.log_level.lower() == "error":
-    log_level = logging.ERROR
-if config.log_level.lower() == "critical":
-    log_level = logging.CRITICAL
+log_level = LOG_LEVELS.get(config.log_level.lower(), logging.INFO)
 
 setup_logger(filename="monkey-island-payment.log", level=log_level)
 
-DATABASE_URL = f"postgresql+asyncpg://{config.pg_user}:{config.pg_password}@{config.pg_host}:{config.pg_port}/{config.pg_db}"
-ENGINE = create_async_engine(DATABASE_URL, echo=False)
-SESSION_MAKER = async_sessionmaker(bind=ENGINE, expire_on_commit=False)
+TUNING.configure(config)
+TUNING.on_change(apply_log_level)
+TUNING.on_change(lambda values: TRACER.configure(values.trace_sample_rate))
+
+
+def reload_tuning():
+    try:
+        TUNING.reload()
+    except Exception as e:
+        # Неверный файл не применяется целиком, остаются текущие значения.
+        logging.error(f"reloading tuning from {config.tuning_file} failed: {e}")
+
+
+reload_tuning()
+
+LOOP_PROFILER = LoopProfiler()
+LOOP_STALL_WATCHDOG = LoopStallWatchdog()
+
+
+# Прием webhook'а - только запись в spool, поэтому сервер начинает принимать
+# их сразу после запуска, а база, RWMS и обработчики (payment_service)
+# загружаются в фоне. Импорт идет в отдельном потоке, чтобы event loop в это
+# время отвечал на запросы.
+async def load_payment_service(app: FastAPI):
+    started_at = time.perf_counter()
+
+    try:
+        module = await asyncio.to_thread(importlib.import_module, "payment_service")
+        service = module.PaymentService(config, app.state.webhook_spool)
+        await service.start()
+    except Exception as e:
+        # Без обработчиков webhook'и только копятся на диске - перезапускаемся.
+        logging.critical(f"failed to load payment service: {e}", exc_info=True)
+        os.kill(os.getpid(), signal.SIGTERM)
+        return
+
+    app.state.payment_service = service
+
+    logging.info(f"payment service loaded in {time.perf_counter() - started_at:.2f}s")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    app.state.rwms_tasks_processor = RwmsTasksProcessor(
-        config=config, session_maker=SESSION_MAKER
-    )
+    app.state.webhook_spool = WebhookSpool(config.partitions)
+    app.state.payment_service = None
+
+    migrating = asyncio.create_task(app.state.webhook_spool.migrate_to_shards())
+    counting = asyncio.create_task(SPOOL_STATS.run())
+    loading = asyncio.create_task(load_payment_service(app))
 
-    publisher = RedisMessagePublisher(config=config)
+    if config.loop_stall_threshold_ms > 0:
+        LOOP_STALL_WATCHDOG.start(config.loop_stall_threshold_ms / 1000)
 
-    app.state.webhook_processor = WebhookProcessor(
-        publisher=publisher,
-        rwms_tasks_processor=app.state.rwms_tasks_processor,
-        session_maker=SESSION_MAKER,
-        config=config,
+    # kill -USR1 <pid> пишет стеки всех задач в лог.
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGUSR1, lambda: logging.warning(format_task_stacks())
     )
 
-    asyncio.create_task(app.state.webhook_processor.process())
-    asyncio.create_task(app.state.rwms_tasks_processor.process())
+    # kill -HUP <pid> перечитывает файл настроек пропускной способности.
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_tuning)
+
     yield
 
+    LOOP_STALL_WATCHDOG.stop()
+
+    if not loading.done():
+        loading.cancel()
+
+    if not migrating.done():
+        migrating.cancel()
+
+    counting.cancel()
+
+    if app.state.payment_service is not None:
+        await app.state.payment_service.stop()
 
-def get_webhook_processor(request: Request) -> WebhookProcessor:
-    return request.app.state.webhook_processor
+    SLOW_WEBHOOKS.persist()
+
+
+def get_webhook_spool(request: Request) -> WebhookSpool:
+    return request.app.state.webhook_spool
 
 
 app = FastAPI(lifespan=lifespan)
@@ -72,8 +136,143 @@ app = FastAPI(lifespan=lifespan)
 @app.post("/yookassa/webhook")
 async def webhook(
     request: Request,
-    webhook_processor: WebhookProcessor = Depends(get_webhook_processor),
+    webhook_spool: WebhookSpool = Depends(get_webhook_spool),
 ):
+    started_at = time.perf_counter()
+
+    try:
+        return await receive_webhook(request, webhook_spool)
+    finally:
+        HTTP_RECEIVE_SECONDS.observe(time.perf_counter() - started_at)
+
+
+# Liveness: отвечает, пока жив event loop, от зависимостей не зависит.
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+
+# Readiness: экземпляр готов, когда обработчики загружены и прогреты. Задержки
+# Postgres, Redis и RWMS и отставание очереди только сообщаются: они общие для
+# всех экземпляров, а webhook'и при их недоступности сохраняются на диск,
+# поэтому их отказ не должен выводить из балансировки все экземпляры сразу.
+# Проверка отставания включается MI_YKP_READINESS_MAX_QUEUE_LAG. Отставание
+# берется из последнего обхода spool (metrics.SPOOL_STATS).
+@app.get("/readyz")
+async def readyz(request: Request):
+    service = request.app.state.payment_service
+
+    if service is None:
+        return JSONResponse(
+            status_code=503, content={"ready": False, "reason": "warming up"}
+        )
+
+    queues = service.queue_lag()
+    dependencies = await service.check_dependencies()
+    lag = queues["webhooks"]["oldest_age"]
+    max_lag = config.readiness_max_queue_lag
+    ready = max_lag <= 0 or lag <= max_lag
+
+    content = {"ready": ready, "dependencies": dependencies, "queues": queues}
+
+    if not ready:
+        content["reason"] = f"webhook queue lags {lag:.0f}s behind"
+
+    return JSONResponse(status_code=200 if ready else 503, content=content)
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
+def verify_debug_token(request: Request):
+    if config.debug_token is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    authorization = request.headers.get("authorization", "")
+    expected = f"Bearer {config.debug_token}"
+
+    if not hmac.compare_digest(authorization.encode(), expected.encode()):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+
+# Сэмплирующий профиль event loop в свернутом формате для flamegraph.pl/speedscope.
+@app.get("/debug/profile", dependencies=[Depends(verify_debug_token)])
+async def debug_profile(seconds: float = 10, interval_ms: float = 5):
+    if not 0 < seconds <= MAX_PROFILE_SECONDS or interval_ms < 1:
+        raise HTTPException(status_code=400, detail="Invalid profiling parameters")
+
+    if LOOP_PROFILER.running:
+        raise HTTPException(status_code=409, detail="Profiling already running")
+
+    collapsed = await LOOP_PROFILER.profile(seconds, interval_ms / 1000)
+    return PlainTextResponse(collapsed)
+
+
+@app.get("/debug/tasks", dependencies=[Depends(verify_debug_token)])
+async def debug_tasks():
+    return PlainTextResponse(format_task_stacks())
+
+
+# Без seconds возвращает последние зависания, с seconds - записывает
+# зависания дольше threshold_ms в течение seconds и возвращает их.
+@app.get("/debug/stalls", dependencies=[Depends(verify_debug_token)])
+async def debug_stalls(seconds: float = 0, threshold_ms: float = 100):
+    if seconds == 0:
+        return {
+            "watchdog_running": LOOP_STALL_WATCHDOG.running,
+            "threshold_ms": LOOP_STALL_WATCHDOG.threshold * 1000,
+            "stalls": list(LOOP_STALL_WATCHDOG.stalls),
+        }
+
+    if not 0 < seconds <= MAX_PROFILE_SECONDS or threshold_ms < 1:
+        raise HTTPException(status_code=400, detail="Invalid watchdog parameters")
+
+    if LOOP_STALL_WATCHDOG.window_running:
+        raise HTTPException(status_code=409, detail="Stall recording already running")
+
+    stalls = await LOOP_STALL_WATCHDOG.watch_for(threshold_ms / 1000, seconds)
+    return {"threshold_ms": threshold_ms, "stalls": stalls}
+
+
+# Время обработки webhook'ов и задач RWMS по этапам: последние записи и самые
+# медленные. Фильтры: payment_id и min_total_ms.
+@app.get("/debug/webhooks", dependencies=[Depends(verify_debug_token)])
+async def debug_webhooks(payment_id: str | None = None, min_total_ms: float = 0):
+    return SLOW_WEBHOOKS.query(payment_id=payment_id, min_total_ms=min_total_ms)
+
+
+# Текущие параметры пропускной способности. PATCH меняет переданные поля до
+# перезапуска или SIGHUP, POST /admin/tuning/reload перечитывает файл.
+@app.get("/admin/tuning", dependencies=[Depends(verify_debug_token)])
+async def get_tuning():
+    return TUNING.values.model_dump()
+
+
+@app.patch("/admin/tuning", dependencies=[Depends(verify_debug_token)])
+async def update_tuning(request: Request):
+    try:
+        changes = orjson.loads(await request.body())
+
+        if not isinstance(changes, dict):
+            raise ValueError("tuning changes must be a JSON object")
+
+        return TUNING.update(changes).model_dump()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@app.post("/admin/tuning/reload", dependencies=[Depends(verify_debug_token)])
+async def reload_tuning_file():
+    try:
+        return TUNING.reload().model_dump()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def receive_webhook(request: Request, webhook_spool: WebhookSpool):
+    received_at = time.time_ns()
     client_host_allowed = SecurityHelper().is_ip_trusted(request.client.host)
 
     if not client_host_allowed and config.trust_x_forwarded_for:
@@ -85,18 +284,38 @@ async def webhook(
             status_code=403, content={"error": "Forbidden: IP not allowed"}
         )
 
-    body = (await request.body()).decode("utf-8")
+    raw_body = await request.body()
+    body = raw_body.decode("utf-8")
     logging.info(f"received webhook payload: {body}")
 
     try:
-        json_data = orjson.loads(body)
-        notification_object = WebhookNotificationFactory().create(json_data)
-        response_object = notification_object.object
-        webhook_processor.schedule(response_object.id, body)
-        logging.info(f"webhook {response_object.id} scheduled")
-
-    except orjson.JSONDecodeError:
-        logging.error("Failed to decode JSON", exc_info=True)
+        envelope = decode_envelope(raw_body)
+        WEBHOOKS_RECEIVED_TOTAL.labels(webhook_event_label(envelope.event)).inc()
+
+        if envelope.event not in HANDLED_EVENTS:
+            logging.info(
+                f"webhook {envelope.object.id} with event {envelope.event} "
+                f"has no handler, acknowledged without scheduling"
+            )
+            return {"status": "ok"}
+
+        with TRACER.start_span(
+            "webhook.receive",
+            attributes={"payment.id": envelope.object.id, "event": envelope.event},
+            start_time_ns=received_at,
+        ) as traceparent:
+            webhook_spool.schedule(
+                envelope.object.id,
+                envelope.event,
+                get_partition_key(envelope),
+                raw_body,
+                traceparent,
+            )
+
+        logging.info(f"webhook {envelope.object.id} scheduled")
+
+    except pydantic.ValidationError:
+        logging.error("Failed to decode webhook JSON", exc_info=True)
         raise HTTPException(status_code=400, detail="Invalid JSON")
 
     except Exception as e:
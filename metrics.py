@@ -0,0 +1,211 @@
+import time
+import asyncio
+import logging
+
+from pathlib import Path
+from prometheus_client import Gauge
+from prometheus_client import Counter
+from prometheus_client import Histogram
+from prometheus_client import generate_latest
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from partitions import iter_spool_files
+from webhook_decoder import HANDLED_EVENTS
+from webhook_decoder import PAYMENT_WAITING_FOR_CAPTURE
+
+# Метрики всех этапов обработки платежа: прием webhook'а, запись в spool,
+# ожидание в очереди, транзакция в базе, вызовы RWMS и отправка в Redis.
+# Запись значения - это инкремент счетчика под блокировкой, поэтому метрики
+# можно держать включенными в продакшене. Глубина и отставание spool-директорий
+# пересчитываются в отдельном потоке раз в SPOOL_STATS_INTERVAL секунд, а
+# /metrics и /readyz читают последние посчитанные значения.
+
+METRICS_CONTENT_TYPE = CONTENT_TYPE_LATEST
+
+# Значения метки event. Событие берется из тела запроса, поэтому остальные
+# события считаются как other: иначе каждое новое значение создавало бы
+# новую серию метрик.
+WEBHOOK_EVENT_LABELS = HANDLED_EVENTS | {PAYMENT_WAITING_FOR_CAPTURE}
+OTHER_EVENT_LABEL = "other"
+
+# Интервал пересчета глубины и отставания spool-директорий, секунды.
+SPOOL_STATS_INTERVAL = 5.0
+
+# Границы для быстрых операций (диск, Redis, пул соединений), секунды.
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+# Границы для ожидания в очереди, секунды.
+QUEUE_WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+HTTP_RECEIVE_SECONDS = Histogram(
+    "payment_http_receive_seconds",
+    "Time to receive, validate and acknowledge a webhook request",
+    buckets=FAST_BUCKETS,
+)
+
+SPOOL_WRITE_SECONDS = Histogram(
+    "payment_spool_write_seconds",
+    "Time to write an item to a disk spool",
+    ["spool"],
+    buckets=FAST_BUCKETS,
+)
+
+QUEUE_WAIT_SECONDS = Histogram(
+    "payment_queue_wait_seconds",
+    "Time an item spent in a disk spool before processing",
+    ["spool"],
+    buckets=QUEUE_WAIT_BUCKETS,
+)
+
+DB_TRANSACTION_SECONDS = Histogram(
+    "payment_db_transaction_seconds",
+    "Duration of a webhook database transaction",
+    ["event"],
+)
+
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    "payment_db_pool_checkout_seconds",
+    "Time spent waiting for a postgres connection from the pool",
+    buckets=FAST_BUCKETS,
+)
+
+RWMS_RPC_SECONDS = Histogram(
+    "payment_rwms_rpc_seconds",
+    "Duration of an RWMS gRPC call",
+    ["method"],
+)
+
+REDIS_PUSH_SECONDS = Histogram(
+    "payment_redis_push_seconds",
+    "Duration of a Redis push pipeline",
+    ["transport"],
+    buckets=FAST_BUCKETS,
+)
+
+WEBHOOKS_RECEIVED_TOTAL = Counter(
+    "payment_webhooks_received_total",
+    "Webhooks accepted by the endpoint",
+    ["event"],
+)
+
+WEBHOOKS_PROCESSED_TOTAL = Counter(
+    "payment_webhooks_processed_total",
+    "Webhooks taken from the spool, by event and outcome",
+    ["event", "outcome"],
+)
+
+RWMS_TASKS_PROCESSED_TOTAL = Counter(
+    "payment_rwms_tasks_processed_total",
+    "RWMS tasks taken from the spool, by task type and outcome",
+    ["type", "outcome"],
+)
+
+# Метка stream - очереди ботов из redis_message_publisher, их набор постоянный.
+REDIS_STREAM_LAG = Gauge(
+    "payment_redis_stream_lag",
+    "Messages of a Redis stream not yet read by its slowest consumer group",
+    ["stream"],
+)
+
+USER_ID_CACHE_LOOKUPS_TOTAL = Counter(
+    "payment_user_id_cache_lookups_total",
+    "Lookups in the username to user id cache, by result",
+    ["result"],
+)
+
+USER_ID_CACHE_SIZE = Gauge(
+    "payment_user_id_cache_size",
+    "Number of entries in the username to user id cache",
+)
+
+SPOOL_DEPTH = Gauge(
+    "payment_spool_depth",
+    "Number of items in a disk spool directory",
+    ["spool", "state"],
+)
+
+SPOOL_LAG_SECONDS = Gauge(
+    "payment_spool_lag_seconds",
+    "Age of the oldest pending item in a disk spool",
+    ["spool"],
+)
+
+
+def webhook_event_label(event: str) -> str:
+    return event if event in WEBHOOK_EVENT_LABELS else OTHER_EVENT_LABEL
+
+
+# Число файлов и время изменения самого старого из них по spool-директориям.
+# Обход сотен тысяч файлов занимает секунды, поэтому он идет в отдельном
+# потоке (run), а не в обработчиках /metrics и /readyz на event loop. До
+# первого обхода директории считаются пустыми.
+class SpoolStats:
+    def __init__(self):
+        self.__directories: list[Path] = []
+        self.__counts: dict[Path, int] = {}
+        self.__oldest: dict[Path, float | None] = {}
+
+    def track(self, directories: list[Path]):
+        self.__directories.extend(directories)
+
+    # Файлы spool-директории вместе с поддиректориями (partitions.py).
+    def count(self, directory: Path) -> int:
+        return self.__counts.get(directory, 0)
+
+    # Возраст самого старого файла в spool-директории, 0 для пустой директории.
+    def oldest_age(self, directory: Path) -> float:
+        oldest = self.__oldest.get(directory)
+        return 0.0 if oldest is None else max(time.time() - oldest, 0.0)
+
+    def refresh(self):
+        for directory in list(self.__directories):
+            count = 0
+            oldest = None
+
+            for entry in iter_spool_files(directory):
+                try:
+                    mtime = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+
+                count += 1
+
+                if oldest is None or mtime < oldest:
+                    oldest = mtime
+
+            self.__counts[directory] = count
+            self.__oldest[directory] = oldest
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                logging.error(f"counting spool files failed: {e}")
+
+            await asyncio.sleep(SPOOL_STATS_INTERVAL)
+
+
+SPOOL_STATS = SpoolStats()
+
+
+# Глубина pending/processing и отставание по всем разделам spool - из
+# последнего обхода SPOOL_STATS.
+def track_spool_depth(
+    spool: str, pending_dirs: list[Path], processing_dirs: list[Path]
+):
+    SPOOL_STATS.track(pending_dirs + processing_dirs)
+
+    SPOOL_DEPTH.labels(spool, "pending").set_function(
+        lambda: sum(SPOOL_STATS.count(d) for d in pending_dirs)
+    )
+    SPOOL_DEPTH.labels(spool, "processing").set_function(
+        lambda: sum(SPOOL_STATS.count(d) for d in processing_dirs)
+    )
+    SPOOL_LAG_SECONDS.labels(spool).set_function(
+        lambda: max(SPOOL_STATS.oldest_age(d) for d in pending_dirs)
+    )
+
+
+def render_metrics() -> bytes:
+    return generate_latest()
@@ -0,0 +1,229 @@
+import time
+import orjson
+import asyncio
+import logging
+import itertools
+
+from pathlib import Path
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from after_commit import call_after_commit
+from after_commit import call_before_commit
+from after_commit import call_after_rollback
+from common.models.messages import MessageUnion
+from redis_message_publisher import RedisMessagePublisher
+from statements import SELECT_EXISTING_PAYMENT_IDS
+from tuning import TUNING
+
+
+# Outbox уведомлений для ботов. Сообщения, отправленные в рамках транзакции,
+# копятся в памяти, перед ее коммитом записываются на диск (.staged), а после
+# коммита становятся видны relay'ю (.json). Поэтому Redis не удлиняет
+# транзакцию, при откате бот не получит уведомление, а падение процесса сразу
+# после коммита их не теряет. Relay пачками переносит сообщения в Redis.
+#
+# Файлы .staged, записанные до запуска процесса, остались после падения
+# между записью и коммитом. Вместе с сообщениями в них сохранен платеж,
+# который вставляет транзакция: если строка платежа есть в базе, транзакция
+# закоммичена и файл отдается relay'ю, иначе она откатилась и файл удаляется.
+# Файлы, которые не удалось прочитать, откладываются в failed/.
+class NotificationOutbox:
+    def __init__(
+        self, publisher: RedisMessagePublisher, session_maker: async_sessionmaker
+    ):
+        self.__publisher = publisher
+        self.__session_maker = session_maker
+        self.__file_counter = itertools.count()
+        self.__released = asyncio.Event()
+        self.__started_at = time.time()
+
+        self.__outbox_dir = Path("notifications")
+        self.__pending_dir = self.__outbox_dir / "pending"
+        self.__failed_dir = self.__outbox_dir / "failed"
+
+        self.__outbox_dir.mkdir(parents=True, exist_ok=True)
+        self.__pending_dir.mkdir(parents=True, exist_ok=True)
+        self.__failed_dir.mkdir(parents=True, exist_ok=True)
+
+    # payment_id - платеж, строку которого вставляет транзакция сессии.
+    def for_session(self, session: AsyncSession, payment_id: str) -> "OutboxSession":
+        return OutboxSession(self, session, payment_id)
+
+    # Публикация вне транзакции: сообщение сразу сохраняется на диск.
+    async def publish(self, message: MessageUnion, *queues: str):
+        json = message.model_dump_json()
+        self.release([(queue, json) for queue in queues])
+
+    # Сохранение сообщений (очередь, json) на диск для отправки relay'ем.
+    def release(self, messages: list[tuple[str, str]]):
+        if not messages:
+            return
+
+        path = self.__new_path()
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_bytes(orjson.dumps(messages))
+        tmp_path.rename(path.with_suffix(".json"))
+
+        self.__released.set()
+
+    # Сообщения транзакции: список дополняется до коммита, перед коммитом
+    # записывается на диск, после коммита отдается relay'ю, после отката
+    # удаляется.
+    def release_after_commit(
+        self,
+        session: AsyncSession,
+        payment_id: str,
+        messages: list[tuple[str, str]],
+    ):
+        staged = self.__new_path().with_suffix(".staged")
+
+        call_before_commit(session, lambda: self.__stage(staged, payment_id, messages))
+        call_after_commit(session, lambda: self.__promote(staged))
+        call_after_rollback(session, lambda: staged.unlink(missing_ok=True))
+
+    def __new_path(self) -> Path:
+        return self.__pending_dir / f"{time.time_ns()}-{next(self.__file_counter)}"
+
+    def __stage(self, staged: Path, payment_id: str, messages: list[tuple[str, str]]):
+        tmp_path = staged.with_suffix(".tmp")
+        tmp_path.write_bytes(
+            orjson.dumps({"payment_id": payment_id, "messages": messages})
+        )
+        tmp_path.rename(staged)
+
+    def __promote(self, staged: Path):
+        staged.rename(staged.with_suffix(".json"))
+        self.__released.set()
+
+    async def process(self):
+        while True:
+            tuning = TUNING.values
+
+            try:
+                await asyncio.wait_for(
+                    self.__released.wait(), timeout=tuning.notification_relay_pause
+                )
+                await asyncio.sleep(tuning.notification_relay_coalesce_window)
+            except asyncio.TimeoutError:
+                pass
+
+            self.__released.clear()
+
+            try:
+                await self.__publisher.drain_spilled_messages()
+                await self.__relay_pending()
+            except Exception as e:
+                logging.error(f"relaying notifications failed: {e}", exc_info=True)
+
+    # Сообщения файла: список (очередь, json) или, для сообщений транзакции,
+    # объект с платежом и этим списком.
+    @staticmethod
+    def __read_file(file: Path) -> tuple[str | None, list[tuple[str, str]]]:
+        data = orjson.loads(file.read_bytes())
+        payment_id = None
+
+        if isinstance(data, dict):
+            payment_id = data["payment_id"]
+            data = data["messages"]
+
+        return payment_id, [(queue, json) for queue, json in data]
+
+    def __quarantine(self, file: Path, error: Exception):
+        logging.error(f"moving unreadable notifications {file.name} to failed: {error}")
+        file.rename(self.__failed_dir / file.name)
+
+    # Файлы .staged, оставшиеся от прошлых запусков процесса: по закоммиченным
+    # транзакциям отдаются relay'ю, по откатившимся удаляются.
+    async def __resolve_stale_staged(self):
+        stale = {}
+
+        for staged in self.__pending_dir.glob("*.staged"):
+            try:
+                if staged.stat().st_mtime >= self.__started_at:
+                    continue
+
+                stale[staged] = self.__read_file(staged)[0]
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                self.__quarantine(staged, e)
+
+        if not stale:
+            return
+
+        async with self.__session_maker() as session:
+            result = await session.execute(
+                SELECT_EXISTING_PAYMENT_IDS,
+                {"payment_ids": list(set(stale.values()))},
+            )
+            committed = set(result.scalars())
+
+        for staged, payment_id in stale.items():
+            if payment_id in committed:
+                logging.warning(
+                    f"releasing staged notifications {staged.name} "
+                    f"of committed payment {payment_id}"
+                )
+                staged.rename(staged.with_suffix(".json"))
+            else:
+                logging.warning(
+                    f"dropping staged notifications {staged.name} "
+                    f"of rolled back payment {payment_id}"
+                )
+                staged.unlink(missing_ok=True)
+
+    async def __relay_pending(self):
+        await self.__resolve_stale_staged()
+
+        files = sorted(self.__pending_dir.glob("*.json"))
+        batch_size = TUNING.values.notification_relay_batch_size
+
+        while files:
+            batch_files = []
+            messages = []
+
+            while files and len(messages) < batch_size:
+                file = files.pop(0)
+
+                try:
+                    messages.extend(self.__read_file(file)[1])
+                except Exception as e:
+                    self.__quarantine(file, e)
+                    continue
+
+                batch_files.append(file)
+
+            if not messages:
+                continue
+
+            await self.__publisher.push_serialized_messages(messages)
+            logging.info(f"relayed {len(messages)} notifications to redis")
+
+            for file in batch_files:
+                file.unlink()
+
+
+# Публикация сообщений в outbox в рамках транзакции сессии.
+# Интерфейс совпадает с RedisMessagePublisher и NotificationOutbox,
+# поэтому send_* функции принимают любой из них.
+class OutboxSession:
+    def __init__(
+        self, outbox: NotificationOutbox, session: AsyncSession, payment_id: str
+    ):
+        self.__outbox = outbox
+        self.__session = session
+        self.__payment_id = payment_id
+        self.__messages: list[tuple[str, str]] = []
+
+    async def publish(self, message: MessageUnion, *queues: str):
+        if not self.__messages:
+            self.__outbox.release_after_commit(
+                self.__session, self.__payment_id, self.__messages
+            )
+
+        json = message.model_dump_json()
+        self.__messages.extend((queue, json) for queue in queues)
+
+
+MessagePublisher = RedisMessagePublisher | NotificationOutbox | OutboxSession
@@ -0,0 +1,330 @@
+import math
+import time
+import uuid
+import zlib
+import asyncio
+import logging
+
+from pathlib import Path
+from contextlib import contextmanager
+from redis.asyncio import Redis
+
+from config import Config
+
+# Владение разделами spool (partitions.py). Раздел обрабатывает только
+# процесс, который держит его аренду в Redis: ключ с именем процесса и сроком
+# partition_lease_ttl, продлеваемый каждую треть срока. Процессы отмечаются
+# в общем списке узлов, каждый держит не больше ceil(разделов / узлов)
+# разделов: при подключении узла лишние разделы отпускаются, при уходе узла
+# его аренды истекают и разбираются оставшимися.
+#
+# Раздел отпускается только после завершения начатого прохода обработчика
+# (hold), поэтому два процесса не обрабатывают раздел одновременно, пока
+# Redis доступен. Если аренду не удалось продлить до истечения срока,
+# процесс перестает начинать новые проходы по разделу, а начатые обработчики
+# прерывают, проверяя owns перед каждым webhook'ом, пачкой и задачей.
+#
+# Аренды в Redis, а файлы разделов - в spool-директориях процессов, поэтому
+# делить разделы между процессами можно, только если webhooks/ и rwms-tasks/
+# у них на одном общем томе: иначе раздел, взятый одним процессом, в spool
+# другого не обрабатывает никто. Поэтому владение через Redis включается
+# только с MI_YKP_SHARED_SPOOL=true. Перед тем как брать разделы, процесс
+# пишет в каждую spool-директорию метку со случайным токеном и проверяет, что
+# видит метки всех живых процессов с их токенами из Redis. Если не видит,
+# spool не общий: процесс разделов не берет и в список узлов не попадает,
+# поэтому остальные продолжают работать как прежде.
+#
+# При одном разделе или локальном spool (по умолчанию) все разделы
+# принадлежат процессу и Redis не используется.
+
+PARTITION_LEASE_KEY_PREFIX = "monkey-island-payment:partition:"
+PARTITION_NODES_KEY = "monkey-island-payment:partition-nodes"
+PARTITION_SPOOL_MARKERS_KEY = "monkey-island-payment:partition-spool-markers"
+
+# Поддиректория spool-директории с метками процессов.
+SPOOL_MARKERS_DIR = "partition-nodes"
+
+# Продление и освобождение - только своей аренды.
+RENEW_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class PartitionLease:
+    def __init__(self, index: int):
+        self.index = index
+        # Можно начинать проходы по разделу.
+        self.owned = asyncio.Event()
+        # Аренда в Redis принадлежит процессу (в том числе пока отпускается).
+        self.held = False
+        self.valid_until = 0.0
+        # Число начатых проходов обработчиков.
+        self.holders = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+
+class PartitionOwnership:
+    def __init__(self, config: Config, spool_dirs: list[Path]):
+        self.__count = config.partitions
+        self.__node_id = config.node_id
+        self.__lease_ttl = config.partition_lease_ttl
+        self.__leases = [PartitionLease(index) for index in range(self.__count)]
+        self.__redis: Redis | None = None
+        self.__stopped = False
+
+        self.__spool_dirs = spool_dirs
+        self.__spool_token = uuid.uuid4().hex
+        self.__spool_shared = False
+
+        if self.__count > 1 and not config.shared_spool:
+            logging.info(
+                f"{self.__count} partitions on a local spool, "
+                f"all of them are processed by {self.__node_id}"
+            )
+
+        if self.__count == 1 or not config.shared_spool:
+            for lease in self.__leases:
+                lease.owned.set()
+                lease.held = True
+                lease.valid_until = math.inf
+        else:
+            self.__redis = Redis(
+                host=config.redis_host,
+                port=config.redis_port,
+                password=config.redis_password,
+                decode_responses=True,
+            )
+            self.__renew_lease = self.__redis.register_script(RENEW_LEASE_SCRIPT)
+            self.__release_lease = self.__redis.register_script(RELEASE_LEASE_SCRIPT)
+
+    def owns(self, index: int) -> bool:
+        return self.__leases[index].owned.is_set()
+
+    def owned(self) -> list[int]:
+        return [lease.index for lease in self.__leases if lease.owned.is_set()]
+
+    async def wait_owned(self, index: int):
+        await self.__leases[index].owned.wait()
+
+    # Проход обработчика по разделам: пока он идет, разделы не отпускаются.
+    @contextmanager
+    def hold(self, *indexes: int):
+        leases = [self.__leases[index] for index in indexes]
+
+        for lease in leases:
+            lease.holders += 1
+            lease.idle.clear()
+
+        try:
+            yield
+        finally:
+            for lease in leases:
+                lease.holders -= 1
+
+                if lease.holders == 0:
+                    lease.idle.set()
+
+    async def run(self):
+        if self.__redis is None:
+            return
+
+        while not self.__stopped:
+            try:
+                await self.__rebalance()
+            except Exception as e:
+                logging.error(f"partition rebalance failed: {e}")
+
+            self.__expire_leases()
+            await asyncio.sleep(self.__lease_ttl / 3)
+
+    # Свободные аренды отпускаются сразу, занятые истекут сами.
+    async def stop(self):
+        if self.__redis is None:
+            return
+
+        self.__stopped = True
+
+        for lease in self.__leases:
+            lease.owned.clear()
+
+        try:
+            for lease in self.__leases:
+                if lease.held and lease.holders == 0:
+                    await self.__release_lease(
+                        keys=[self.__lease_key(lease.index)], args=[self.__node_id]
+                    )
+                    lease.held = False
+
+            await self.__redis.zrem(PARTITION_NODES_KEY, self.__node_id)
+            await self.__redis.hdel(PARTITION_SPOOL_MARKERS_KEY, self.__node_id)
+
+            for spool_dir in self.__spool_dirs:
+                self.__spool_marker(spool_dir, self.__node_id).unlink(missing_ok=True)
+        except Exception as e:
+            logging.error(f"releasing partitions failed: {e}")
+
+    async def __rebalance(self):
+        if not self.__spool_shared:
+            self.__spool_shared = await self.__check_shared_spool()
+
+            if not self.__spool_shared:
+                return
+
+        now = time.time()
+        started_at = time.monotonic()
+        ttl_ms = int(self.__lease_ttl * 1000)
+
+        pipeline = self.__redis.pipeline(transaction=False)
+        pipeline.zadd(PARTITION_NODES_KEY, {self.__node_id: now + self.__lease_ttl})
+        pipeline.zremrangebyscore(PARTITION_NODES_KEY, "-inf", now)
+        pipeline.zcard(PARTITION_NODES_KEY)
+        *_, nodes = await pipeline.execute()
+
+        share = math.ceil(self.__count / max(nodes, 1))
+
+        for lease in self.__leases:
+            if not lease.held:
+                continue
+
+            renewed = await self.__renew_lease(
+                keys=[self.__lease_key(lease.index)], args=[self.__node_id, ttl_ms]
+            )
+
+            if renewed:
+                lease.valid_until = started_at + self.__lease_ttl
+            else:
+                logging.warning(f"lease of partition {lease.index} lost")
+                lease.owned.clear()
+                lease.held = False
+
+        held = [lease for lease in self.__leases if lease.held]
+        owned = [lease for lease in held if lease.owned.is_set()]
+
+        for lease in owned[share:]:
+            lease.owned.clear()
+            asyncio.create_task(self.__release(lease))
+
+        if len(held) >= share or self.__stopped:
+            return
+
+        # Обход с разных разделов, чтобы узлы не конкурировали за одни и те же.
+        offset = zlib.crc32(self.__node_id.encode())
+
+        for step in range(self.__count):
+            lease = self.__leases[(offset + step) % self.__count]
+
+            if lease.held:
+                continue
+
+            acquired = await self.__redis.set(
+                self.__lease_key(lease.index), self.__node_id, nx=True, px=ttl_ms
+            )
+
+            if not acquired:
+                continue
+
+            logging.info(f"partition {lease.index} acquired by {self.__node_id}")
+
+            lease.held = True
+            lease.valid_until = started_at + self.__lease_ttl
+            lease.owned.set()
+            held.append(lease)
+
+            if len(held) >= share:
+                break
+
+    # Отпускает аренду после завершения начатых проходов. Пока проход идет,
+    # аренда продлевается как обычно.
+    async def __release(self, lease: PartitionLease):
+        await lease.idle.wait()
+
+        if not lease.held or lease.owned.is_set():
+            return
+
+        try:
+            await self.__release_lease(
+                keys=[self.__lease_key(lease.index)], args=[self.__node_id]
+            )
+            lease.held = False
+            logging.info(f"partition {lease.index} released by {self.__node_id}")
+        except Exception as e:
+            logging.error(f"releasing partition {lease.index} failed: {e}")
+
+    # Аренды, которые не удалось продлить (нет связи с Redis), считаются
+    # потерянными за треть срока до истечения: после него раздел может взять
+    # другой процесс, а начатый проход должен успеть закончиться.
+    def __expire_leases(self):
+        now = time.monotonic()
+
+        for lease in self.__leases:
+            if lease.held and lease.valid_until - self.__lease_ttl / 3 <= now:
+                logging.warning(f"lease of partition {lease.index} expired")
+                lease.owned.clear()
+                lease.held = False
+
+    # Проверка общего spool: метки всех живых процессов видны с их токенами.
+    # Процессы, не записавшие токен в Redis, проверить нельзя - они пропускаются.
+    async def __check_shared_spool(self) -> bool:
+        await asyncio.to_thread(self.__write_spool_markers)
+
+        tokens = await self.__redis.hgetall(PARTITION_SPOOL_MARKERS_KEY)
+        nodes = await self.__redis.zrangebyscore(
+            PARTITION_NODES_KEY, time.time(), "+inf"
+        )
+
+        for node_id in nodes:
+            if node_id == self.__node_id:
+                continue
+
+            token = tokens.get(node_id)
+
+            if token is None:
+                logging.warning(f"node {node_id} has no spool marker, not checked")
+                continue
+
+            for spool_dir in self.__spool_dirs:
+                marker = self.__spool_marker(spool_dir, node_id)
+
+                try:
+                    visible = marker.read_text() == token
+                except FileNotFoundError:
+                    visible = False
+
+                if not visible:
+                    logging.critical(
+                        f"spool marker of node {node_id} is not visible at {marker}: "
+                        f"{spool_dir} is not shared, partitions are not acquired"
+                    )
+                    return False
+
+        await self.__redis.hset(
+            PARTITION_SPOOL_MARKERS_KEY, self.__node_id, self.__spool_token
+        )
+        logging.info(f"spool is shared with {len(nodes)} running nodes")
+        return True
+
+    def __write_spool_markers(self):
+        for spool_dir in self.__spool_dirs:
+            marker = self.__spool_marker(spool_dir, self.__node_id)
+            marker.parent.mkdir(parents=True, exist_ok=True)
+
+            tmp_marker = marker.with_name(f"{marker.name}.tmp")
+            tmp_marker.write_text(self.__spool_token)
+            tmp_marker.rename(marker)
+
+    def __spool_marker(self, spool_dir: Path, node_id: str) -> Path:
+        return spool_dir / SPOOL_MARKERS_DIR / node_id.replace("/", "_")
+
+    def __lease_key(self, index: int) -> str:
+        return f"{PARTITION_LEASE_KEY_PREFIX}{index}"
@@ -0,0 +1,214 @@
+import os
+import zlib
+import orjson
+import logging
+
+from typing import Callable
+from typing import Iterator
+from pathlib import Path
+
+# Разделы spool-очередей. Webhook'и и задачи RWMS раскладываются по
+# MI_YKP_PARTITIONS разделам по хэшу ключа (пользователь платежа или исходный
+# платеж возврата), каждым разделом в каждый момент владеет один процесс
+# (partition_ownership.py). События одного пользователя попадают в один
+# раздел и обрабатываются по очереди, разные разделы - параллельно в разных
+# процессах и на разных узлах.
+# Возврат раскладывается по исходному платежу и может попасть в другой
+# раздел, чем сам платеж: возврат, обработанный раньше платежа, ждет его в
+# очереди (refund_handlers.py).
+#
+# При одном разделе раскладка прежняя: <spool>/pending и <spool>/processing.
+# При нескольких - <spool>/partitions/<номер>/pending и .../processing.
+# Число разделов должно совпадать на всех узлах. После его изменения первый
+# запущенный процесс перекладывает файлы по новым разделам (repartition),
+# поэтому менять его нужно перезапуском всех узлов.
+#
+# Внутри pending и processing файлы лежат в SPOOL_SHARDS поддиректориях по
+# хэшу ключа раздела (pending/3f/p0_<id>.json): при сотнях тысяч файлов в
+# одной директории создание, rename и unlink на ext4/overlayfs замедляются,
+# а в поддиректориях их остается на два-три порядка меньше. Все события
+# одного ключа лежат в одной поддиректории, поэтому режим догоняния, который
+# читает очередь по одной поддиректории за пачку, применяет их в том же
+# порядке, что и обход всей очереди. Из pending в processing и обратно файл
+# переносится внутри своей поддиректории. Файлы, записанные до появления
+# поддиректорий, переносит migrate_to_shards при запуске.
+
+PARTITIONS_DIR = "partitions"
+PARTITIONS_MARKER = "partitions.json"
+
+SPOOL_SHARDS = 256
+SHARDS = [f"{shard:02x}" for shard in range(SPOOL_SHARDS)]
+
+
+# Хэш не зависит от PYTHONHASHSEED, поэтому одинаков во всех процессах.
+def get_partition(key: str, count: int) -> int:
+    return zlib.crc32(key.encode()) % count
+
+
+# Ключ раздела событий пользователя: его webhook'ов и задач RWMS.
+def user_partition_key(username: str) -> str:
+    return f"user:{username}"
+
+
+# Поддиректория по ключу раздела. Раздел берет остаток от деления того же
+# хэша, поэтому поддиректория считается по старшим битам: иначе при числе
+# разделов, кратном степени двойки, в разделе использовалась бы только часть
+# поддиректорий.
+def get_shard(key: str) -> str:
+    return f"{(zlib.crc32(key.encode()) >> 16) % SPOOL_SHARDS:02x}"
+
+
+# Ключ раздела из файла spool или None, если файл не разбирается. Такой файл
+# попадает в раздел 0 и в поддиректорию по имени - его разберет обработчик,
+# порядок для него не важен.
+def read_partition_key(path: Path, get_key: Callable[[bytes], str]) -> str | None:
+    data = path.read_bytes()
+
+    try:
+        return get_key(data) or None
+    except Exception:
+        return None
+
+
+# Файлы spool-директории: в поддиректориях и еще не перенесенные в них.
+def iter_spool_files(directory: Path) -> Iterator[os.DirEntry]:
+    try:
+        with os.scandir(directory) as entries:
+            entries = list(entries)
+    except FileNotFoundError:
+        return
+
+    for entry in entries:
+        if entry.name.endswith(".json"):
+            yield entry
+        elif entry.is_dir():
+            yield from list_shard_files(entry.path)
+
+
+def list_shard_files(directory: str | Path) -> list[os.DirEntry]:
+    try:
+        with os.scandir(directory) as entries:
+            return [entry for entry in entries if entry.name.endswith(".json")]
+    except FileNotFoundError:
+        return []
+
+
+def get_partition_dir(spool_dir: Path, count: int, index: int) -> Path:
+    if count == 1:
+        return spool_dir
+
+    return spool_dir / PARTITIONS_DIR / str(index)
+
+
+class SpoolPartition:
+    def __init__(self, index: int, partition_dir: Path):
+        self.index = index
+        self.pending_dir = partition_dir / "pending"
+        self.processing_dir = partition_dir / "processing"
+
+        for shard in SHARDS:
+            (self.pending_dir / shard).mkdir(parents=True, exist_ok=True)
+            (self.processing_dir / shard).mkdir(parents=True, exist_ok=True)
+
+    def pending_path(self, shard: str, name: str) -> Path:
+        return self.pending_dir / shard / name
+
+    def processing_path(self, shard: str, name: str) -> Path:
+        return self.processing_dir / shard / name
+
+    # Файлы pending во всех поддиректориях или в одной из них. Файлы, которые
+    # еще не перенесены в поддиректории, обработчики не видят.
+    def list_pending(self, shard: str | None = None) -> list[Path]:
+        shards = SHARDS if shard is None else [shard]
+
+        return [
+            Path(entry.path)
+            for shard_name in shards
+            for entry in list_shard_files(self.pending_dir / shard_name)
+        ]
+
+
+# Переносит файлы из pending и processing раздела в поддиректории по ключу
+# раздела из файла (get_key). Файлы только читаются и переименовываются,
+# поэтому перенос можно выполнять в отдельном потоке, пока обработчики
+# работают с поддиректориями.
+def migrate_to_shards(
+    partitions: list[SpoolPartition], get_key: Callable[[bytes], str]
+):
+    moved = 0
+
+    for partition in partitions:
+        for state_dir in (partition.pending_dir, partition.processing_dir):
+            for entry in list_shard_files(state_dir):
+                try:
+                    key = read_partition_key(Path(entry.path), get_key)
+                    shard = get_shard(key or entry.name)
+                    os.rename(entry.path, state_dir / shard / entry.name)
+                    moved += 1
+                except FileNotFoundError:
+                    pass
+
+    if moved:
+        logging.warning(f"moved {moved} spool files into shard directories")
+
+
+# Число разделов, с которым spool записан. Spool без отметки записан
+# до появления разделов, то есть с одним разделом.
+def read_partition_count(spool_dir: Path) -> int:
+    marker = spool_dir / PARTITIONS_MARKER
+
+    if not marker.exists():
+        return 1
+
+    return orjson.loads(marker.read_bytes())["count"]
+
+
+# Перекладывает файлы pending и processing из раскладки с прежним числом
+# разделов в текущую. Ключ раздела читается из файла (get_key).
+# Несколько процессов могут перекладывать одновременно: файл, который уже
+# перенес другой процесс, пропускается.
+def repartition(spool_dir: Path, count: int, get_key: Callable[[bytes], str]):
+    previous_count = read_partition_count(spool_dir)
+
+    if previous_count == count:
+        return
+
+    logging.warning(
+        f"repartitioning {spool_dir} from {previous_count} to {count} partitions"
+    )
+
+    moved = 0
+
+    for index in range(previous_count):
+        partition_dir = get_partition_dir(spool_dir, previous_count, index)
+
+        for state in ("pending", "processing"):
+            for entry in iter_spool_files(partition_dir / state):
+                try:
+                    key = read_partition_key(Path(entry.path), get_key)
+                except FileNotFoundError:
+                    continue
+
+                target_index = get_partition(key, count) if key else 0
+                target_dir = (
+                    get_partition_dir(spool_dir, count, target_index)
+                    / state
+                    / get_shard(key or entry.name)
+                )
+                if Path(entry.path) == target_dir / entry.name:
+                    continue
+
+                target_dir.mkdir(parents=True, exist_ok=True)
+
+                try:
+                    os.rename(entry.path, target_dir / entry.name)
+                    moved += 1
+                except FileNotFoundError:
+                    pass
+
+    marker = spool_dir / PARTITIONS_MARKER
+    tmp_marker = marker.with_suffix(".tmp")
+    tmp_marker.write_bytes(orjson.dumps({"count": count}))
+    tmp_marker.rename(marker)
+
+    logging.warning(f"repartitioned {spool_dir}: {moved} files moved")
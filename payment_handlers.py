@@ -4,29 +4,18 @@ from typing import Optional
 from datetime import datetime
 from datetime import timedelta
 from decimal import Decimal
-from sqlalchemy import insert
-from sqlalchemy import exists
-from sqlalchemy import text
-from sqlalchemy import select
-from sqlalchemy import delete
-from sqlalchemy import update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import async_sessionmaker
-from yookassa.domain.notification import PaymentResponse
 
-from common.rwms_client import RwmsClient
-from config import Config
 from metadata import Metadata
-from redis_message_publisher import RedisMessagePublisher
-from common.models.db import User
-from common.models.db import YkPayment
-from common.models.db import ReferralType
-from common.models.db import ReferralBonus
+from after_commit import call_after_commit
+from tracing import TRACER
+from tracing import current_traceparent
+from webhook_decoder import Payment
+from notification_outbox import NotificationOutbox
 from common.models.db import ReferralBonusType
-from common.models.db import YkRecurrentPayment
 from common.models.tariff import str_to_tariff
 from common.models.tariff import OneMonthTariff
-from common.models.analytics_event import SubscriptionActivated
 from common.models.analytics_event import PaymentTrialManualSuccess
 from common.models.analytics_event import PaymentTrialManualFailure
 from common.models.analytics_event import PaymentRegularManualSuccess
@@ -35,16 +24,23 @@ from common.models.analytics_event import PaymentRegularAutopaySuccess
 from common.models.analytics_event import PaymentRegularAutopayFailure
 from common.models.analytics_event import PaymentTrialToRegularAutopaySuccess
 from common.models.analytics_event import PaymentTrialToRegularAutopayFailure
-from rwms_helpers import update_user
 from rwms_tasks_processor import RwmsTasksProcessor
 from rwms_tasks_processor import RwmsAddTimeIntervalTask
+from rwms_tasks_processor import RwmsReferralBonusTask
 from send_notification import send_succeeded_autopay
-from send_notification import send_referral_purchase_bonus_applied
 from send_notification import send_succeeded_non_autopay
 from send_notification import send_failed_autopay
 from send_notification import send_failed_non_autopay
 from send_purchase import send_purchase
-from save_event_log import save_event_log
+from event_log_writer import EventLogWriter
+from user_id_cache import resolve_user_id
+from statements import DISABLE_AUTOPAY
+from statements import EXTEND_EXPIRE_AT
+from statements import UPSERT_RECURRENT_PAYMENT
+from statements import INSERT_PAYMENT_IF_NOT_EXISTS
+from statements import SELECT_REFERRAL_WITH_REFERRER
+from statements import INSERT_REFERRAL_BONUS_IF_NOT_EXISTS
+from statements import SELECT_AUTOPAY_ALLOW_BY_USERNAME
 
 
 def payment_amount_to_int(value: str) -> int:
@@ -56,25 +52,15 @@ def payment_amount_to_int(value: str) -> int:
     return int(amount)
 
 
-async def has_payment(payment_id: str, session: AsyncSession) -> bool:
-    result = await session.execute(
-        select(YkPayment).where(YkPayment.payment_id == payment_id)
-    )
-
-    return result.scalar() is not None
-
-
 async def get_user_id_by_username(
     username: str, session: AsyncSession
 ) -> Optional[int]:
-    result = await session.execute(select(User.id).where(User.username == username))
-
-    return result.scalars().first()
+    return await resolve_user_id(session, username)
 
 
 async def is_user_allow_autopay_disabled(username: str, session: AsyncSession) -> bool:
     result = await session.execute(
-        select(User.autopay_allow).where(User.username == username)
+        SELECT_AUTOPAY_ALLOW_BY_USERNAME, {"username": username}
     )
 
     flag = result.scalars().first()
@@ -86,90 +72,83 @@ async def is_user_allow_autopay_disabled(username: str, session: AsyncSession) -
     return False
 
 
+# Возвращает True, если платеж сохранен этим вызовом, и False, если он уже был
+# сохранен ранее (повторная доставка того же webhook'а). Проверка и вставка -
+# один запрос (statements.insert_if_not_exists).
 async def save_payment_if_not_exists(
-    payment: PaymentResponse, metadata: Metadata, session: AsyncSession
-):
-    has_payment_flag = await has_payment(payment.id, session)
-
-    if not has_payment_flag:
-        user_id = await get_user_id_by_username(metadata.username, session)
-
-        if user_id is None:
-            # что делать если нет пользователя для которого прилетел платеж в базе?
-            # по идее такой ситуации быть не должно
-            logging.critical(
-                f"not found user in database with telegram ID "
-                f"'{metadata.username}' received by payment ID '{payment.id}'"
-            )
-            raise RuntimeError(
-                f"not found user with telegram ID "
-                f"'{metadata.username}' received by payment ID '{payment.id}'"
-            )
-
-        captured_at = None
-
-        if payment.captured_at is not None:
-            captured_at = datetime.fromisoformat(
-                payment.captured_at.replace("Z", "+00:00")
-            ).replace(tzinfo=None)
-
-        created_at = datetime.fromisoformat(
-            payment.created_at.replace("Z", "+00:00")
+    payment: Payment, metadata: Metadata, session: AsyncSession
+) -> bool:
+    user_id = await get_user_id_by_username(metadata.username, session)
+
+    if user_id is None:
+        # что делать если нет пользователя для которого прилетел платеж в базе?
+        # по идее такой ситуации быть не должно
+        logging.critical(
+            f"not found user in database with telegram ID "
+            f"'{metadata.username}' received by payment ID '{payment.id}'"
+        )
+        raise RuntimeError(
+            f"not found user with telegram ID "
+            f"'{metadata.username}' received by payment ID '{payment.id}'"
+        )
+
+    captured_at = None
+
+    if payment.captured_at is not None:
+        captured_at = datetime.fromisoformat(
+            payment.captured_at.replace("Z", "+00:00")
         ).replace(tzinfo=None)
 
-        await session.execute(
-            insert(YkPayment).values(
-                is_trial_promotion=metadata.trial_promotion,
-                user_id=user_id,
-                amount=payment_amount_to_int(payment.amount.value),
-                currency=payment.amount.currency,
-                status=payment.status,
-                captured_at=captured_at,
-                created_at=created_at,
-                payment_id=payment.id,
-                subscription_period=metadata.subscription_period,
-            )
-        )
+    created_at = datetime.fromisoformat(
+        payment.created_at.replace("Z", "+00:00")
+    ).replace(tzinfo=None)
+
+    result = await session.execute(
+        INSERT_PAYMENT_IF_NOT_EXISTS,
+        {
+            "is_trial_promotion": metadata.trial_promotion,
+            "user_id": user_id,
+            "amount": payment_amount_to_int(payment.amount.value),
+            "currency": payment.amount.currency,
+            "status": payment.status,
+            "captured_at": captured_at,
+            "created_at": created_at,
+            "payment_id": payment.id,
+            "subscription_period": metadata.subscription_period,
+        },
+    )
+
+    return result.scalar() is not None
+
+
+# Удаляет сохраненный рекуррентный платеж и запрещает автосписания одним запросом.
+async def disable_user_autopay(session: AsyncSession, username: str) -> None:
+    await session.execute(DISABLE_AUTOPAY, {"username": username})
 
 
 async def extend_user_subscription_by_username(
     session: AsyncSession,
     username: str,
     interval: timedelta,
-) -> None:
-    extend_expire_at_query = text("""
-        UPDATE users 
-            SET expire_at = 
-            CASE 
-                WHEN expire_at > (NOW() AT TIME ZONE 'UTC') THEN expire_at + (:interval)::interval
-                ELSE (NOW() AT TIME ZONE 'UTC') + (:interval)::interval
-            END
-            WHERE username = :username
-        """)
-
-    await session.execute(
-        extend_expire_at_query,
+) -> datetime | None:
+    result = await session.execute(
+        EXTEND_EXPIRE_AT,
         {
             "username": username,
             "interval": interval,
         },
     )
 
-
-# Дублирующийся код, который уже есть в rwms_tasks_processor, надо подумать как его вынести в общее место, чтобы не было дублирования
-async def save_subscription_reactivated(session: AsyncSession, username: str) -> None:
-    try:
-        await save_event_log(session, username, SubscriptionActivated())
-    except Exception as e:
-        logging.error(f"saving subscription reactivated event log failed: {e}")
+    return result.scalar()
 
 
-# Этот метод должен работать по принципу rwms_tasks_processor
+# Начисление бонуса рефереру в два этапа. В транзакции платежа бонус записывается
+# в базу и ставится задача на продление подписки в remnawave, а саму подписку
+# продлевает rwms_tasks_processor вне транзакции, с повторами при ошибках.
 async def add_referrer_bonus_if_needed(
-    publisher: RedisMessagePublisher,
-    session_maker: async_sessionmaker,
-    rwms_client: RwmsClient,
-    config: Config,
+    session: AsyncSession,
+    tasks_processor: RwmsTasksProcessor,
+    payment_id: str,
     metadata: Metadata,
     bonus_days_count: int,
 ):
@@ -179,334 +158,293 @@ async def add_referrer_bonus_if_needed(
         )
         return
 
-    async with session_maker() as session:
-        async with session.begin():
-            result = await session.execute(
-                select(User.id, User.referred_by_id)
-                .where(User.username == metadata.username)
-                .where(User.referral_type == ReferralType.STANDARD)
-                .where(User.referred_by_id.isnot(None))
-                .limit(1)
-            )
-
-            row = result.one_or_none()
-
-            # Есть небольшой шанс, что и username в базе нет для которого оплата пришла
-            if not row:
-                logging.info(
-                    f"user {metadata.username} has no referrer, skipping referral bonus"
-                )
-                return
-
-            referral_id, referrer_id = row
-
-            already_applied_for_referrer = await session.execute(
-                select(
-                    exists().where(
-                        ReferralBonus.referrer_id == referrer_id,
-                        ReferralBonus.referral_id == referral_id,
-                        ReferralBonus.bonus_type == ReferralBonusType.PURCHASE,
-                    )
-                )
-            )
-
-            if already_applied_for_referrer.scalar():
-                logging.info(
-                    f"referral bonus for referrer {referrer_id} and referral {referral_id} already applied, skipping"
-                )
-                return
-
-            referrer_username_result = await session.execute(
-                select(User.username, User.telegram_id)
-                .where(User.id == referrer_id)
-                .limit(1)
-            )
-
-            referrer_info = referrer_username_result.one_or_none()
-
-            if not referrer_info:
-                logging.warning(
-                    f"referrer info not found for referrer_id {referrer_id}"
-                )
-                return
-
-            referrer_username, referrer_telegram_id = referrer_info
-            bonus_days_interval = timedelta(days=bonus_days_count)
-
-            user = await rwms_client.get_user_by_username(referrer_username)
-            if user is None:
-                logging.warning(
-                    f"referrer subscription not found in RWMS for {referrer_username}"
-                )
-                return
-
-            user_response, subscription_activated = await update_user(
-                rwms_client=rwms_client,
-                config=config,
-                user=user,
-                interval=bonus_days_interval,
-            )
-
-            if user_response is None:
-                logging.error(
-                    f"failed to apply referral bonus for referrer {referrer_username} and referral {metadata.username}"
-                )
-                return
-
-            await extend_user_subscription_by_username(
-                session, referrer_username, bonus_days_interval
-            )
-
-            bonus = ReferralBonus(
-                referral_id=referral_id,
-                referrer_id=referrer_id,
-                bonus_type=ReferralBonusType.PURCHASE,
-                days_added=bonus_days_count,
-            )
-            session.add(bonus)
-
-            logging.info(
-                f"referral bonus for referrer {referrer_username} and referral {metadata.username} applied successfully"
-            )
-
-            if subscription_activated:
-                await save_subscription_reactivated(session, referrer_username)
-
-            if referrer_telegram_id is not None:
-                await send_referral_purchase_bonus_applied(
-                    publisher,
-                    referrer_telegram_id,
-                    metadata.subscription_period,
-                    bonus_days_count,
-                )
+    result = await session.execute(
+        SELECT_REFERRAL_WITH_REFERRER, {"username": metadata.username}
+    )
+
+    row = result.one_or_none()
+
+    # Есть небольшой шанс, что и username в базе нет для которого оплата пришла
+    if not row:
+        logging.info(
+            f"user {metadata.username} has no referrer, skipping referral bonus"
+        )
+        return
+
+    referral_id, referrer_id, referrer_username, referrer_telegram_id = row
+
+    # Сначала запись бонуса: подписка продлевается, только если бонус вставлен
+    # этим вызовом, а не был начислен раньше.
+    inserted = await session.execute(
+        INSERT_REFERRAL_BONUS_IF_NOT_EXISTS,
+        {
+            "referral_id": referral_id,
+            "referrer_id": referrer_id,
+            "bonus_type": ReferralBonusType.PURCHASE,
+            "days_added": bonus_days_count,
+        },
+    )
+
+    if inserted.scalar() is None:
+        logging.info(
+            f"referral bonus for referrer {referrer_id} and referral {referral_id} already applied, skipping"
+        )
+        return
+
+    expire_at = await extend_user_subscription_by_username(
+        session, referrer_username, timedelta(days=bonus_days_count)
+    )
+
+    referral_bonus_task = RwmsReferralBonusTask(
+        type="referral-bonus",
+        username=referrer_username,
+        bonus_days_count=bonus_days_count,
+        expire_at=expire_at,
+        referral_tariff=metadata.subscription_period,
+        telegram_id=referrer_telegram_id,
+        traceparent=current_traceparent(),
+    )
+
+    # Задача ставится только после коммита, чтобы при откате транзакции
+    # (или точки сохранения) подписка в remnawave не продлевалась без записи в базе.
+    call_after_commit(
+        session,
+        lambda: tasks_processor.schedule(
+            f"{payment_id}-referral-bonus", referral_bonus_task
+        ),
+    )
+
+    logging.info(
+        f"referral bonus for referrer {referrer_username} and referral {metadata.username} recorded"
+    )
+
+
+# Обработка успешного платежа в транзакции переданной сессии. Ошибки не
+# перехватываются, транзакцией управляет вызывающий код.
+async def process_succeeded_payment(
+    session: AsyncSession,
+    outbox: NotificationOutbox,
+    event_log_writer: EventLogWriter,
+    tasks_processor: RwmsTasksProcessor,
+    payment: Payment,
+    metadata: Metadata,
+) -> None:
+    publisher = outbox.for_session(session, payment.id)
+    is_new = await save_payment_if_not_exists(payment, metadata, session)
+
+    if not is_new:
+        logging.info(
+            f"succeeded payment {payment.id} for user "
+            f"{metadata.username} already processed, skipping"
+        )
+        return
+
+    await add_referrer_bonus_if_needed(
+        session=session,
+        tasks_processor=tasks_processor,
+        payment_id=payment.id,
+        metadata=metadata,
+        bonus_days_count=30,
+    )
+
+    next_autopay_price = payment_amount_to_int(payment.amount.value)
+    next_autopay_period_to_extend = metadata.subscription_period
+    tariff = str_to_tariff(metadata.subscription_period)
+
+    if metadata.trial_promotion:
+        one_month_tariff = OneMonthTariff()
+        next_autopay_price = one_month_tariff.price
+        next_autopay_period_to_extend = one_month_tariff.db_tariff_id
+
+    captured_at = datetime.fromisoformat(
+        payment.captured_at.replace("Z", "+00:00")
+    ).replace(tzinfo=None)
+
+    is_disabled = await is_user_allow_autopay_disabled(metadata.username, session)
+
+    if is_disabled:
+        logging.info(
+            f"autopay disabled for user {metadata.username}, "
+            f"skipping recurrent payment update for {payment.id}"
+        )
+    elif payment.payment_method is None or not payment.payment_method.saved:
+        logging.info(
+            f"payment method was not saved for payment {payment.id}, "
+            f"skipping recurrent payment update"
+        )
+    else:
+        await session.execute(
+            UPSERT_RECURRENT_PAYMENT,
+            {
+                "recurrent_payment_id": payment.payment_method.id,
+                "username": metadata.username,
+                "amount": next_autopay_price,
+                "currency": payment.amount.currency,
+                "captured_at": captured_at,
+                "subscription_period": next_autopay_period_to_extend,
+                "is_trial_promotion": metadata.trial_promotion,
+                "scheduled_payment": False,
+            },
+        )
+
+    expire_at = await extend_user_subscription_by_username(
+        session, metadata.username, tariff.subscription_period
+    )
+
+    add_time_interval_task = RwmsAddTimeIntervalTask(
+        type="add-time-interval",
+        username=metadata.username,
+        tariff=tariff,
+        expire_at=expire_at,
+        telegram_id=metadata.telegram_id,
+        email=metadata.email,
+        traceparent=current_traceparent(),
+    )
+
+    call_after_commit(
+        session,
+        lambda: tasks_processor.schedule(payment.id, add_time_interval_task),
+    )
+
+    if metadata.autopay:
+        await send_succeeded_autopay(publisher, metadata.telegram_id)
+    else:
+        await send_succeeded_non_autopay(publisher, metadata.telegram_id)
+
+    await send_purchase(publisher, metadata.username, payment.id, tariff)
+
+    event = None
+
+    if metadata.autopay:
+        if metadata.from_trial:  # автоплатеж-переход с пробного периода
+            event = PaymentTrialToRegularAutopaySuccess()
+        else:  # регулярный автоплатеж по тарифу
+            event = PaymentRegularAutopaySuccess()
+    else:
+        if metadata.trial_promotion:  # ручная оплата пробного периода
+            event = PaymentTrialManualSuccess()
+        else:  # ручная оплата обычного тарифа
+            event = PaymentRegularManualSuccess()
+
+    if event is not None:
+        event_log_writer.enqueue_after_commit(session, metadata.username, event)
+
+    logging.info(
+        f"succeeded payment {payment.id} for user "
+        f"{metadata.username} successfully processed"
+    )
 
 
 async def handle_succeeded_payment(
-    publisher: RedisMessagePublisher,
+    outbox: NotificationOutbox,
+    event_log_writer: EventLogWriter,
     tasks_processor: RwmsTasksProcessor,
-    rwms_client: RwmsClient,
-    config: Config,
     session_maker: async_sessionmaker,
-    payment: PaymentResponse,
+    payment: Payment,
     metadata: Metadata,
 ) -> bool:
     try:
-        async with session_maker() as session:
-            async with session.begin():
-                await save_payment_if_not_exists(payment, metadata, session)
-
-                await add_referrer_bonus_if_needed(
-                    publisher=publisher,
-                    session_maker=session_maker,
-                    rwms_client=rwms_client,
-                    config=config,
-                    metadata=metadata,
-                    bonus_days_count=30,
-                )
-
-                next_autopay_price = payment_amount_to_int(payment.amount.value)
-                next_autopay_period_to_extend = metadata.subscription_period
-                tariff = str_to_tariff(metadata.subscription_period)
-
-                if metadata.trial_promotion:
-                    one_month_tariff = OneMonthTariff()
-                    next_autopay_price = one_month_tariff.price
-                    next_autopay_period_to_extend = one_month_tariff.db_tariff_id
-
-                captured_at = datetime.fromisoformat(
-                    payment.captured_at.replace("Z", "+00:00")
-                ).replace(tzinfo=None)
-
-                is_disabled = await is_user_allow_autopay_disabled(
-                    metadata.username, session
-                )
-
-                if is_disabled:
-                    logging.info(
-                        f"autopay disabled for user {metadata.username}, "
-                        f"skipping recurrent payment update for {payment.id}"
-                    )
-                elif not payment.payment_method.saved:
-                    logging.info(
-                        f"payment method was not saved for payment {payment.id}, "
-                        f"skipping recurrent payment update"
-                    )
-                else:
-                    query = text("""
-                        WITH user_data AS (
-                            SELECT id FROM users WHERE username = :username LIMIT 1
-                        )
-                        INSERT INTO yk_recurrent_payments (
-                            recurrent_payment_id,
-                            user_id,
-                            amount,
-                            currency,
-                            captured_at,
-                            subscription_period,
-                            is_trial_promotion,
-                            scheduled_payment
-                        )
-                        SELECT
-                            :recurrent_payment_id,
-                            (SELECT id FROM user_data),
-                            :amount,
-                            :currency,
-                            :captured_at,
-                            :subscription_period,
-                            :is_trial_promotion,
-                            :scheduled_payment
-                        ON CONFLICT (user_id) DO UPDATE SET
-                            recurrent_payment_id = EXCLUDED.recurrent_payment_id,
-                            amount = EXCLUDED.amount,
-                            currency = EXCLUDED.currency,
-                            captured_at = EXCLUDED.captured_at,
-                            subscription_period = EXCLUDED.subscription_period,
-                            is_trial_promotion = EXCLUDED.is_trial_promotion,
-                            scheduled_payment = false
-                        """)
-
-                    await session.execute(
-                        query,
-                        {
-                            "recurrent_payment_id": payment.payment_method.id,
-                            "username": metadata.username,
-                            "amount": next_autopay_price,
-                            "currency": payment.amount.currency,
-                            "captured_at": captured_at,
-                            "subscription_period": next_autopay_period_to_extend,
-                            "is_trial_promotion": metadata.trial_promotion,
-                            "scheduled_payment": False,
-                        },
+        with TRACER.span(
+            "handle_succeeded_payment", attributes={"payment.id": payment.id}
+        ):
+            async with session_maker() as session:
+                async with session.begin():
+                    await process_succeeded_payment(
+                        session=session,
+                        outbox=outbox,
+                        event_log_writer=event_log_writer,
+                        tasks_processor=tasks_processor,
+                        payment=payment,
+                        metadata=metadata,
                     )
 
-                extend_expire_at_query = text("""
-                    UPDATE users 
-                        SET expire_at = 
-                        CASE 
-                            WHEN expire_at > (NOW() AT TIME ZONE 'UTC') THEN expire_at + (:interval)::interval
-                            ELSE (NOW() AT TIME ZONE 'UTC') + (:interval)::interval
-                        END
-                        WHERE username = :username
-                    """)
-
-                await session.execute(
-                    extend_expire_at_query,
-                    {
-                        "username": metadata.username,
-                        "interval": tariff.subscription_period,
-                    },
-                )
-
-                add_time_interval_task = RwmsAddTimeIntervalTask(
-                    type="add-time-interval",
-                    username=metadata.username,
-                    tariff=tariff,
-                    telegram_id=metadata.telegram_id,
-                    email=metadata.email,
-                )
-
-                tasks_processor.schedule(payment.id, add_time_interval_task)
-
-                if metadata.autopay:
-                    await send_succeeded_autopay(publisher, metadata.telegram_id)
-                else:
-                    await send_succeeded_non_autopay(publisher, metadata.telegram_id)
-
-                await send_purchase(publisher, metadata.username, payment.id, tariff)
-
-                event = None
-
-                if metadata.autopay:
-                    if metadata.from_trial:  # автоплатеж-переход с пробного периода
-                        event = PaymentTrialToRegularAutopaySuccess()
-                    else:  # регулярный автоплатеж по тарифу
-                        event = PaymentRegularAutopaySuccess()
-                else:
-                    if metadata.trial_promotion:  # ручная оплата пробного периода
-                        event = PaymentTrialManualSuccess()
-                    else:  # ручная оплата обычного тарифа
-                        event = PaymentRegularManualSuccess()
-
-                if event is not None:
-                    await save_event_log(session, metadata.username, event)
-
-                logging.info(
-                    f"succeeded payment {payment.id} for user "
-                    f"{metadata.username} successfully processed"
-                )
-
-                return True
+        return True
     except Exception as e:
         logging.error(f"handling succeeded payment error: {e}", exc_info=True)
         return False
 
 
-async def handle_canceled_payment(
-    publisher: RedisMessagePublisher,
-    session_maker: async_sessionmaker,
-    payment: PaymentResponse,
+# Обработка отмененного платежа в транзакции переданной сессии. Ошибки не
+# перехватываются, транзакцией управляет вызывающий код.
+async def process_canceled_payment(
+    session: AsyncSession,
+    outbox: NotificationOutbox,
+    event_log_writer: EventLogWriter,
+    payment: Payment,
     metadata: Metadata,
-) -> bool:
-    try:
-        async with session_maker() as session:
-            async with session.begin():
-                await save_payment_if_not_exists(payment, metadata, session)
-
-                logging.info(
-                    f"canceled payment {payment.id} for user "
-                    f"{metadata.username} successfully processed"
-                )
-
-                event = None
-
-                if metadata.autopay:
-                    if (
-                        metadata.from_trial
-                    ):  # неуспешный автоплатеж-переход с пробного периода
-                        event = PaymentTrialToRegularAutopayFailure()
-                    else:  # неуспешный регулярный автоплатеж по тарифу
-                        event = PaymentRegularAutopayFailure()
-                else:
-                    if metadata.trial_promotion:  # ручная оплата пробного периода
-                        event = PaymentTrialManualFailure()
-                    else:  # ручная оплата обычного тарифа
-                        event = PaymentRegularManualFailure()
-
-                if event is not None:
-                    await save_event_log(session, metadata.username, event)
-
-                if payment.status == "expired_on_confirmation":
-                    logging.info(
-                        f"payment for user {metadata.username} was expired on confirmation, do nothing"
-                    )
-                    return True
+) -> None:
+    publisher = outbox.for_session(session, payment.id)
+    is_new = await save_payment_if_not_exists(payment, metadata, session)
 
-                if payment.status == "general_decline":
-                    logging.info(
-                        f"payment declined by user {metadata.username}, do nothing"
-                    )
-                    return True
+    if not is_new:
+        logging.info(
+            f"canceled payment {payment.id} for user "
+            f"{metadata.username} already processed, skipping"
+        )
+        return
+
+    logging.info(
+        f"canceled payment {payment.id} for user "
+        f"{metadata.username} successfully processed"
+    )
 
-                if not metadata.autopay:
-                    await send_failed_non_autopay(publisher, metadata.telegram_id)
-                    return True
+    event = None
 
-                subquery = select(User.id).where(User.username == metadata.username)
-                await session.execute(
-                    delete(YkRecurrentPayment).where(
-                        YkRecurrentPayment.user_id.in_(subquery)
-                    )
-                )
+    if metadata.autopay:
+        if metadata.from_trial:  # неуспешный автоплатеж-переход с пробного периода
+            event = PaymentTrialToRegularAutopayFailure()
+        else:  # неуспешный регулярный автоплатеж по тарифу
+            event = PaymentRegularAutopayFailure()
+    else:
+        if metadata.trial_promotion:  # ручная оплата пробного периода
+            event = PaymentTrialManualFailure()
+        else:  # ручная оплата обычного тарифа
+            event = PaymentRegularManualFailure()
 
-                await session.execute(
-                    update(User)
-                    .where(User.username == metadata.username)
-                    .values(autopay_allow=False)
-                )
+    if event is not None:
+        event_log_writer.enqueue_after_commit(session, metadata.username, event)
 
-                await send_failed_autopay(publisher, metadata.telegram_id)
+    if payment.status == "expired_on_confirmation":
+        logging.info(
+            f"payment for user {metadata.username} was expired on confirmation, do nothing"
+        )
+        return
+
+    if payment.status == "general_decline":
+        logging.info(f"payment declined by user {metadata.username}, do nothing")
+        return
+
+    if not metadata.autopay:
+        await send_failed_non_autopay(publisher, metadata.telegram_id)
+        return
+
+    await disable_user_autopay(session, metadata.username)
+
+    await send_failed_autopay(publisher, metadata.telegram_id)
+
+
+async def handle_canceled_payment(
+    outbox: NotificationOutbox,
+    event_log_writer: EventLogWriter,
+    session_maker: async_sessionmaker,
+    payment: Payment,
+    metadata: Metadata,
+) -> bool:
+    try:
+        with TRACER.span(
+            "handle_canceled_payment", attributes={"payment.id": payment.id}
+        ):
+            async with session_maker() as session:
+                async with session.begin():
+                    await process_canceled_payment(
+                        session=session,
+                        outbox=outbox,
+                        event_log_writer=event_log_writer,
+                        payment=payment,
+                        metadata=metadata,
+                    )
 
-                return True
+        return True
     except Exception as e:
         logging.error(f"handling canceled payment error: {e}", exc_info=True)
         return False
@@ -0,0 +1,192 @@
+import time
+import asyncio
+import logging
+
+from typing import Awaitable
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from config import Config
+from db_engine import ping_db
+from db_engine import prewarm_pool
+from db_engine import create_db_engine
+from event_log_writer import EventLogWriter
+from notification_outbox import NotificationOutbox
+from webhook_spool import WebhookSpool
+from webhook_processor import WebhookProcessor
+from rwms_tasks_processor import RWMS_TASKS_DIR
+from rwms_tasks_processor import RwmsTasksProcessor
+from rwms_tasks_processor import get_rwms_task_partition_key
+from redis_message_publisher import RedisMessagePublisher
+from partition_ownership import PartitionOwnership
+from user_id_cache import USER_ID_CACHE
+from tuning import TUNING
+from slow_webhooks import install_sql_timing
+from partitions import SpoolPartition
+from partitions import migrate_to_shards
+from metrics import SPOOL_STATS
+
+# Обработка платежей: база, Redis, RWMS и фоновые обработчики очередей.
+# Для приема webhook'ов не нужна, поэтому main загружает этот модуль в фоне
+# уже после запуска HTTP-сервера - вместе с SQLAlchemy, asyncpg, redis, grpc
+# и protobuf.
+
+READINESS_CHECK_TIMEOUT = 2  # seconds
+
+
+# Результат проверки зависимости: доступна ли она и за сколько ответила.
+async def check_dependency(call: Awaitable, timeout: float) -> dict:
+    started_at = time.perf_counter()
+
+    try:
+        await asyncio.wait_for(call, timeout)
+    except Exception as e:
+        return {"ok": False, "latency_ms": None, "error": str(e) or type(e).__name__}
+
+    return {"ok": True, "latency_ms": (time.perf_counter() - started_at) * 1000}
+
+
+class PaymentService:
+    def __init__(self, config: Config, webhook_spool: WebhookSpool):
+        self.__config = config
+        self.__webhook_spool = webhook_spool
+
+        TUNING.on_change(
+            lambda values: USER_ID_CACHE.configure(
+                max_size=values.user_id_cache_size, ttl=values.user_id_cache_ttl
+            )
+        )
+
+        self.engine = create_db_engine(config)
+        self.session_maker = async_sessionmaker(
+            bind=self.engine, expire_on_commit=False
+        )
+
+        install_sql_timing(self.engine)
+
+        self.event_log_writer = EventLogWriter(session_maker=self.session_maker)
+
+        self.__publisher = RedisMessagePublisher(config=config)
+
+        self.notification_outbox = NotificationOutbox(
+            publisher=self.__publisher, session_maker=self.session_maker
+        )
+
+        self.ownership = PartitionOwnership(
+            config=config, spool_dirs=[webhook_spool.webhooks_dir, RWMS_TASKS_DIR]
+        )
+
+        self.rwms_tasks_processor = RwmsTasksProcessor(
+            config=config,
+            ownership=self.ownership,
+            outbox=self.notification_outbox,
+            event_log_writer=self.event_log_writer,
+        )
+
+        # По обработчику на раздел очереди: работают те, чьими разделами
+        # владеет процесс.
+        self.webhook_processors = [
+            WebhookProcessor(
+                partition=partition,
+                ownership=self.ownership,
+                outbox=self.notification_outbox,
+                event_log_writer=self.event_log_writer,
+                rwms_tasks_processor=self.rwms_tasks_processor,
+                session_maker=self.session_maker,
+                config=config,
+            )
+            for partition in webhook_spool.partitions
+        ]
+
+    async def start(self):
+        await self.warm_up()
+
+        asyncio.create_task(self.__migrate_rwms_tasks())
+
+        asyncio.create_task(self.ownership.run())
+
+        for webhook_processor in self.webhook_processors:
+            asyncio.create_task(webhook_processor.process())
+
+        asyncio.create_task(self.rwms_tasks_processor.process())
+        asyncio.create_task(self.event_log_writer.process())
+        asyncio.create_task(self.notification_outbox.process())
+
+    # Перенос задач, записанных до появления поддиректорий (partitions.py).
+    # Только rename, поэтому идет в отдельном потоке параллельно с обработкой.
+    async def __migrate_rwms_tasks(self):
+        try:
+            await asyncio.to_thread(
+                migrate_to_shards,
+                self.rwms_tasks_processor.partitions,
+                get_rwms_task_partition_key,
+            )
+        except Exception as e:
+            logging.error(f"moving rwms tasks into shard directories failed: {e}")
+
+    async def stop(self):
+        await self.ownership.stop()
+        await self.event_log_writer.flush()
+
+    # Соединения с Postgres, Redis и RWMS открываются параллельно до запуска
+    # обработчиков, чтобы первые webhook'и не платили за TCP/TLS-рукопожатия.
+    # Вебхуки сохраняются на диск и без зависимостей, поэтому ошибка прогрева
+    # только логируется.
+    async def warm_up(self):
+        started_at = time.perf_counter()
+
+        results = await self.__check_all(
+            {
+                "postgres": prewarm_pool(self.engine, self.__config.pg_pool_size),
+                "redis": self.__publisher.ping(),
+                "rwms": self.rwms_tasks_processor.ping(),
+            },
+            self.__config.warmup_timeout,
+        )
+
+        for name, result in results.items():
+            if result["ok"]:
+                logging.info(f"{name} warmed up in {result['latency_ms']:.1f}ms")
+            else:
+                logging.error(f"failed to warm up {name}: {result['error']}")
+
+        logging.info(f"warm-up finished in {time.perf_counter() - started_at:.3f}s")
+
+    async def check_dependencies(self) -> dict[str, dict]:
+        return await self.__check_all(
+            {
+                "postgres": ping_db(self.engine),
+                "redis": self.__publisher.ping(),
+                "rwms": self.rwms_tasks_processor.ping(),
+            },
+            READINESS_CHECK_TIMEOUT,
+        )
+
+    # Количество и возраст самого старого файла в pending-очередях разделов,
+    # которыми владеет процесс, секунды.
+    def queue_lag(self) -> dict[str, dict]:
+        owned = self.ownership.owned()
+
+        return {
+            spool: {
+                "partitions": owned,
+                "pending": sum(SPOOL_STATS.count(p.pending_dir) for p in partitions),
+                "oldest_age": max(
+                    (SPOOL_STATS.oldest_age(p.pending_dir) for p in partitions),
+                    default=0.0,
+                ),
+            }
+            for spool, partitions in (
+                ("webhooks", self.__owned(self.__webhook_spool.partitions)),
+                ("rwms-tasks", self.__owned(self.rwms_tasks_processor.partitions)),
+            )
+        }
+
+    def __owned(self, partitions: list[SpoolPartition]) -> list[SpoolPartition]:
+        return [p for p in partitions if self.ownership.owns(p.index)]
+
+    async def __check_all(self, calls: dict[str, Awaitable], timeout: float):
+        results = await asyncio.gather(
+            *(check_dependency(call, timeout) for call in calls.values())
+        )
+        return dict(zip(calls, results))
@@ -1,8 +1,27 @@
+import time
 import orjson
 import logging
+from pathlib import Path
 from redis.asyncio import Redis
+from redis.exceptions import ResponseError
 from config import Config
 from common.models.messages import MessageUnion
+from metrics import REDIS_PUSH_SECONDS
+from metrics import REDIS_STREAM_LAG
+
+VPN_BOT_QUEUE = "monkey-island-vpn-bot"
+VPS_BOT_QUEUE = "monkey-island-vps-bot"
+YM_STAT_QUEUE = "monkey-island-ym-stat"
+
+STREAM_LAG_CHECK_INTERVAL = 5  # seconds
+
+
+# lag группы может быть неизвестен (None), тогда ориентируемся на число
+# доставленных, но не подтвержденных сообщений. Нулевой lag - это отсутствие
+# отставания, а не неизвестное значение.
+def get_group_lag(group: dict) -> int:
+    lag = group.get("lag")
+    return lag if lag is not None else group.get("pending", 0)
 
 
 class RedisMessagePublisher:
@@ -14,31 +33,134 @@ class RedisMessagePublisher:
             decode_responses=True,
         )
 
-    async def push_message_to_vpn_bot(self, message: MessageUnion):
-        try:
-            data = message.model_dump()
-            json = orjson.dumps(data).decode("utf-8")
-            await self.__redis.rpush("monkey-island-vpn-bot", json)
-            logging.info(
-                f"pushed message of type {message.type} to VPN bot for {message.telegram_id}"
-            )
-        except Exception as e:
-            logging.error(f"failed to push message to VPN bot: {e}")
-
-    async def push_message_to_vps_bot(self, message: MessageUnion):
-        try:
-            data = message.model_dump()
-            json = orjson.dumps(data).decode("utf-8")
-            await self.__redis.rpush("monkey-island-vps-bot", json)
-            logging.info(
-                f"pushed message of type {message.type} to VPS bot for {message.telegram_id}"
-            )
-        except Exception as e:
-            logging.error(f"failed to push message to VPS bot: {e}")
-
-    async def push_message_to_ym_stat(self, message: MessageUnion):
+        # При транспорте stream очереди - это стримы с ограниченной длиной.
+        # Если отставание групп потребителей превышает порог, сообщения
+        # складываются в локальный spill-файл и дозаливаются, когда отставание спадет.
+        self.__transport = config.redis_transport
+        self.__stream_maxlen = config.redis_stream_maxlen
+        self.__stream_lag_threshold = config.redis_stream_lag_threshold
+        self.__stream_lags: dict[str, int] = {}
+        self.__stream_lags_checked_at: dict[str, float] = {}
+        self.__spill_dir = Path("redis-spill")
+
+        if self.__transport == "stream":
+            self.__spill_dir.mkdir(parents=True, exist_ok=True)
+
+            if self.__stream_lag_threshold >= self.__stream_maxlen:
+                logging.warning(
+                    f"stream lag threshold {self.__stream_lag_threshold} is not below "
+                    f"stream maxlen {self.__stream_maxlen}, lagging consumers will lose messages"
+                )
+
+    # Открывает соединение, если его еще нет в пуле клиента.
+    async def ping(self):
+        await self.__redis.ping()
+
+    # Сообщение сериализуется один раз и отправляется во все очереди одним pipeline.
+    async def publish(self, message: MessageUnion, *queues: str):
         json = message.model_dump_json()
-        await self.__redis.rpush("monkey-island-ym-stat", json)
-        logging.info(
-            f"pushed message of type {message.type} to YM stat for {message.client_id}"
-        )
+        await self.push_serialized_messages([(queue, json) for queue in queues])
+        logging.info(f"pushed message of type {message.type} to {', '.join(queues)}")
+
+    # Отправка уже сериализованных сообщений (очередь, json) одним pipeline,
+    # по одной команде на очередь. Порядок сообщений внутри очереди сохраняется.
+    async def push_serialized_messages(self, messages: list[tuple[str, str]]):
+        queues: dict[str, list[str]] = {}
+
+        for queue, json in messages:
+            queues.setdefault(queue, []).append(json)
+
+        with REDIS_PUSH_SECONDS.labels(self.__transport).time():
+            if self.__transport == "stream":
+                await self.__push_to_streams(queues)
+            else:
+                await self.__push_to_lists(queues)
+
+    # Дозаливка отложенных сообщений без новых. Relay уведомлений вызывает ее
+    # на каждом проходе, чтобы spill-файл очереди не ждал, пока в эту очередь
+    # придет следующее сообщение.
+    async def drain_spilled_messages(self):
+        if self.__transport != "stream":
+            return
+
+        queues = {
+            spill_file.stem: [] for spill_file in self.__spill_dir.glob("*.jsonl")
+        }
+
+        if queues:
+            with REDIS_PUSH_SECONDS.labels(self.__transport).time():
+                await self.__push_to_streams(queues)
+
+    async def __push_to_lists(self, queues: dict[str, list[str]]):
+        pipeline = self.__redis.pipeline(transaction=False)
+
+        for queue, jsons in queues.items():
+            pipeline.rpush(queue, *jsons)
+
+        await pipeline.execute()
+
+    async def __push_to_streams(self, queues: dict[str, list[str]]):
+        pipeline = self.__redis.pipeline(transaction=False)
+        drained_spill_files = []
+
+        for queue, jsons in queues.items():
+            spill_file = self.__spill_dir / f"{queue}.jsonl"
+            lag = await self.__get_stream_lag(queue)
+
+            if lag > self.__stream_lag_threshold:
+                if jsons:
+                    logging.warning(
+                        f"stream {queue} lag {lag} exceeds {self.__stream_lag_threshold}, "
+                        f"spilling {len(jsons)} messages to {spill_file}"
+                    )
+                    self.__spill(spill_file, jsons)
+                continue
+
+            # Сначала дозаливаем отложенные сообщения, чтобы сохранить порядок.
+            if spill_file.exists():
+                jsons = self.__read_spill(spill_file) + jsons
+                drained_spill_files.append(spill_file)
+
+            for json in jsons:
+                pipeline.xadd(
+                    queue,
+                    {"data": json},
+                    maxlen=self.__stream_maxlen,
+                    approximate=True,
+                )
+
+        await pipeline.execute()
+
+        for spill_file in drained_spill_files:
+            spill_file.unlink()
+            logging.info(f"drained spilled messages from {spill_file}")
+
+    async def __get_stream_lag(self, queue: str) -> int:
+        checked_at = self.__stream_lags_checked_at.get(queue, 0.0)
+
+        if time.monotonic() - checked_at < STREAM_LAG_CHECK_INTERVAL:
+            return self.__stream_lags.get(queue, 0)
+
+        try:
+            groups = await self.__redis.xinfo_groups(queue)
+        except ResponseError:
+            # Стрима еще нет.
+            groups = []
+
+        lag = max((get_group_lag(group) for group in groups), default=0)
+
+        self.__stream_lags[queue] = lag
+        self.__stream_lags_checked_at[queue] = time.monotonic()
+        REDIS_STREAM_LAG.labels(queue).set(lag)
+
+        return lag
+
+    def __spill(self, spill_file: Path, jsons: list[str]):
+        with open(spill_file, "ab") as f:
+            for json in jsons:
+                f.write(orjson.dumps(json) + b"\n")
+
+    def __read_spill(self, spill_file: Path) -> list[str]:
+        return [
+            orjson.loads(line) for line in spill_file.read_bytes().splitlines() if line
+        ]
@@ -1,25 +1,42 @@
 import logging
-from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import async_sessionmaker
-from yookassa.domain.notification import RefundResponse
-from common.models.db import YkPayment
+from statements import SET_PAYMENT_REFUNDED
+from webhook_decoder import Refund
+
+
+# Возврат попадает в раздел spool по исходному платежу, а платеж - по
+# пользователю (webhook_decoder.get_partition_key), поэтому возврат может
+# обработаться раньше своего платежа. Тогда отмечать нечего: возврат не
+# применяется, а webhook ждет платежа в очереди (webhook_processor.py).
+class RefundedPaymentNotFound(Exception):
+    pass
+
+
+async def process_succeeded_refund(session: AsyncSession, refund: Refund) -> None:
+    result = await session.execute(
+        SET_PAYMENT_REFUNDED, {"refund_payment_id": refund.payment_id}
+    )
+
+    if result.scalar() is None:
+        raise RefundedPaymentNotFound(
+            f"payment {refund.payment_id} of refund {refund.id} not found"
+        )
 
 
 async def handle_succeeded_refund(
-    session_maker: async_sessionmaker, refund: RefundResponse
+    session_maker: async_sessionmaker, refund: Refund
 ) -> bool:
     try:
         async with session_maker() as session:
-            await session.execute(
-                update(YkPayment)
-                .where(YkPayment.payment_id == refund.payment_id)
-                .values(status="refunded")
-            )
+            await process_succeeded_refund(session, refund)
 
             await session.commit()
 
         logging.info(f"succeeded refund {refund.id} successfully processed")
         return True
+    except RefundedPaymentNotFound:
+        raise
     except Exception as e:
         logging.error(f"handling succeeded refund error: {e}")
         return False
@@ -8,6 +8,23 @@ from common.models.tariff import Tariff
 import proto.rwmanager_pb2 as proto
 
 from config import Config
+from tracing import TRACER
+from tracing import SPAN_KIND_CLIENT
+from metrics import RWMS_RPC_SECONDS
+from slow_webhooks import timed_stage
+
+# Клиентские спаны RWMS продолжают трассу платежа, но traceparent в RWMS пока
+# не передается: для этого RwmsClient (модуль common) должен принимать
+# метаданные вызова или interceptor канала. Передача вынесена в отдельную
+# задачу вместе с изменением common.
+
+
+# Время из базы хранится без часового пояса, в UTC.
+def as_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+
+    return value
 
 
 def datetime_to_timestamp(value: datetime) -> Timestamp:
@@ -16,6 +33,15 @@ def datetime_to_timestamp(value: datetime) -> Timestamp:
     return timestamp
 
 
+async def get_user_by_username(
+    rwms_client: RwmsClient, username: str
+) -> Optional[proto.UserResponse]:
+    with RWMS_RPC_SECONDS.labels("get_user_by_username").time(), timed_stage(
+        "rwms:get_user_by_username"
+    ), TRACER.span("rwms.get_user_by_username", kind=SPAN_KIND_CLIENT):
+        return await rwms_client.get_user_by_username(username)
+
+
 async def create_user(
     rwms_client: RwmsClient,
     config: Config,
@@ -23,21 +49,26 @@ async def create_user(
     username: str,
     telegram_id: int | None = None,
     email: str | None = None,
+    expire_at: datetime | None = None,
 ) -> Optional[proto.UserResponse]:
-    response = await rwms_client.add_user(
-        proto.AddUserRequest(
-            username=username,
-            telegram_id=telegram_id,
-            email=email,
-            expire_at=datetime_to_timestamp(
-                datetime.now(timezone.utc) + tariff.subscription_period
-            ),
-            activate_all_inbounds=True,
-            status=proto.UserStatus.ACTIVE,
-            traffic_limit_strategy=proto.TrafficLimitStrategy.NO_RESET,
-            active_internal_squads=[config.internal_all_nodes_squad_uuid],
+    if expire_at is None:
+        expire_at = datetime.now(timezone.utc) + tariff.subscription_period
+
+    with RWMS_RPC_SECONDS.labels("add_user").time(), timed_stage(
+        "rwms:add_user"
+    ), TRACER.span("rwms.add_user", kind=SPAN_KIND_CLIENT):
+        response = await rwms_client.add_user(
+            proto.AddUserRequest(
+                username=username,
+                telegram_id=telegram_id,
+                email=email,
+                expire_at=datetime_to_timestamp(as_utc(expire_at)),
+                activate_all_inbounds=True,
+                status=proto.UserStatus.ACTIVE,
+                traffic_limit_strategy=proto.TrafficLimitStrategy.NO_RESET,
+                active_internal_squads=[config.internal_all_nodes_squad_uuid],
+            )
         )
-    )
 
     return response
 
@@ -47,27 +78,41 @@ async def update_user(
     config: Config,
     user: proto.UserResponse,
     interval: timedelta,
+    expire_at: datetime | None = None,
 ) -> Optional[proto.UserResponse]:
-    new_expire_at = None
-    subscription_activated = False
+    current_expire_at = None
 
     if user.HasField("expire_at"):
-        new_expire_at = user.expire_at.ToDatetime(tzinfo=timezone.utc)
+        current_expire_at = user.expire_at.ToDatetime(tzinfo=timezone.utc)
+
+    now = datetime.now(timezone.utc)
+    subscription_activated = current_expire_at is None or current_expire_at < now
 
-    if new_expire_at is None or new_expire_at < datetime.now(timezone.utc):
-        new_expire_at = datetime.now(timezone.utc) + interval
-        subscription_activated = True
+    # Задача с итоговым expire_at из базы: повтор после сбоя ставит то же
+    # значение, а не продлевает подписку еще раз. Более позднее время в RWMS
+    # не уменьшается. Задачи без expire_at (записанные до его появления)
+    # продлевают подписку на interval.
+    if expire_at is not None:
+        new_expire_at = as_utc(expire_at)
+
+        if current_expire_at is not None and current_expire_at > new_expire_at:
+            new_expire_at = current_expire_at
+    elif subscription_activated:
+        new_expire_at = now + interval
     else:
-        new_expire_at = new_expire_at + interval
-
-    update_user_response = await rwms_client.update_user(
-        proto.UpdateUserRequest(
-            uuid=user.uuid,
-            expire_at=datetime_to_timestamp(new_expire_at),
-            status=proto.UserStatus.ACTIVE,
-            traffic_limit_strategy=proto.TrafficLimitStrategy.NO_RESET,
-            active_internal_squads=[config.internal_all_nodes_squad_uuid],
+        new_expire_at = current_expire_at + interval
+
+    with RWMS_RPC_SECONDS.labels("update_user").time(), timed_stage(
+        "rwms:update_user"
+    ), TRACER.span("rwms.update_user", kind=SPAN_KIND_CLIENT):
+        update_user_response = await rwms_client.update_user(
+            proto.UpdateUserRequest(
+                uuid=user.uuid,
+                expire_at=datetime_to_timestamp(new_expire_at),
+                status=proto.UserStatus.ACTIVE,
+                traffic_limit_strategy=proto.TrafficLimitStrategy.NO_RESET,
+                active_internal_squads=[config.internal_all_nodes_squad_uuid],
+            )
         )
-    )
 
     return update_user_response, subscription_activated
@@ -1,29 +1,57 @@
+import time
 import orjson
 import logging
 import asyncio
 from pathlib import Path
 from pydantic import BaseModel
 from typing import Literal, Union
-from sqlalchemy.ext.asyncio import async_sessionmaker
+from datetime import datetime
+from datetime import timedelta
 
 from config import Config
-from save_event_log import save_event_log
+from event_log_writer import EventLogWriter
+from notification_outbox import NotificationOutbox
+from send_notification import send_referral_purchase_bonus_applied
 from common.rwms_client import RwmsClient
 from rwms_helpers import create_user, update_user
+from rwms_helpers import get_user_by_username
+from partitions import SpoolPartition
+from partitions import user_partition_key
+from partitions import repartition
+from partitions import get_shard
+from partitions import get_partition
+from partitions import get_partition_dir
+from partition_ownership import PartitionOwnership
+from tracing import TRACER
+from tuning import TUNING
+from slow_webhooks import SLOW_WEBHOOKS
+from metrics import track_spool_depth
+from metrics import QUEUE_WAIT_SECONDS
+from metrics import SPOOL_WRITE_SECONDS
+from metrics import RWMS_TASKS_PROCESSED_TOTAL
 from common.models.tariff import Tariff
 from common.models.analytics_event import SubscriptionActivated
 
-PROCESS_RWMS_TASK_PAUSE = 10  # seconds
+RWMS_TASKS_DIR = Path("rwms-tasks")
+
+# Пользователь, которого заведомо нет в RWMS: запрос к нему проверяет соединение.
+RWMS_PING_USERNAME = "monkey-island-payment-ping"
 
 
 # Поле username используется как идентификатор подписки в remnawave и пользователя в базе данных.
 # Поле telegram_id используется для логирования событий в базе данных.
+# Поле traceparent во всех задачах связывает задачу с трассой платежа.
+# Поле expire_at - время окончания подписки, записанное в базу в транзакции
+# платежа: задача ставит его в remnawave, поэтому повтор задачи не продлевает
+# подписку второй раз. В задачах, записанных до его появления, оно пустое.
 class RwmsAddTimeIntervalTask(BaseModel):
     type: Literal["add-time-interval"]
     username: str
     tariff: Tariff
+    expire_at: datetime | None = None
     telegram_id: int | None = None
     email: str | None = None
+    traceparent: str | None = None
 
 
 class RwmsSubtractTimeIntervalTask(BaseModel):
@@ -32,27 +60,66 @@ class RwmsSubtractTimeIntervalTask(BaseModel):
     tariff: Tariff
     telegram_id: int | None = None
     email: str | None = None
+    traceparent: str | None = None
+
 
+# Продление подписки реферера на bonus_days_count дней за покупку реферала.
+# Бонус уже записан в базу в транзакции платежа, задача применяет его в remnawave.
+# Поле telegram_id используется для уведомления реферера о начисленном бонусе.
+class RwmsReferralBonusTask(BaseModel):
+    type: Literal["referral-bonus"]
+    username: str
+    bonus_days_count: int
+    expire_at: datetime | None = None
+    referral_tariff: str
+    telegram_id: int | None = None
+    traceparent: str | None = None
 
-RwmsTask = Union[RwmsAddTimeIntervalTask, RwmsSubtractTimeIntervalTask]
+
+RwmsTask = Union[
+    RwmsAddTimeIntervalTask, RwmsSubtractTimeIntervalTask, RwmsReferralBonusTask
+]
 
 RWMS_TASK_CLASSES: dict[str, type[BaseModel]] = {
     "add-time-interval": RwmsAddTimeIntervalTask,
     "subtract-time-interval": RwmsSubtractTimeIntervalTask,
+    "referral-bonus": RwmsReferralBonusTask,
 }
 
 
+# Ключ раздела задачи из файла spool - для перекладки при смене числа разделов.
+def get_rwms_task_partition_key(data: bytes) -> str:
+    return user_partition_key(str(orjson.loads(data)["username"]))
+
+
 class RwmsTasksProcessor:
-    def __get_pending_tasks(self):
-        return sorted(
-            self.__pending_dir.glob("*.json"), key=lambda f: f.stat().st_ctime
+    # Задачи разделов, которыми владеет процесс, в порядке записи.
+    def __get_pending_tasks(
+        self, partitions: list[SpoolPartition]
+    ) -> list[tuple[SpoolPartition, Path]]:
+        files = [
+            (partition, file)
+            for partition in partitions
+            for file in partition.list_pending()
+        ]
+        return sorted(files, key=lambda item: item[1].stat().st_mtime)
+
+    def __mark_task_as_processing(self, partition: SpoolPartition, file: Path) -> Path:
+        QUEUE_WAIT_SECONDS.labels("rwms-tasks").observe(
+            max(time.time() - file.stat().st_mtime, 0.0)
         )
 
-    def __mark_task_as_processing(self, file: Path) -> Path:
-        new_path = self.__processing_dir / file.name
+        new_path = partition.processing_path(file.parent.name, file.name)
         file.rename(new_path)
         return new_path
 
+    def __return_task_to_pending(self, partition: SpoolPartition, file: Path):
+        try:
+            file.rename(partition.pending_path(file.parent.name, file.name))
+            logging.info(f"{file.name} returned to pending for retry")
+        except Exception as e:
+            logging.error(f"failed to return {file.name} to pending: {e}")
+
     def __remove_file(self, file: Path):
         try:
             file.unlink()
@@ -60,29 +127,59 @@ class RwmsTasksProcessor:
         except Exception as e:
             logging.error(f"failed to remove {file}: {e}")
 
-    async def __save_subscription_reactivated(self, username: str) -> None:
-        async with self.__session_maker() as session:
-            async with session.begin():
-                try:
-                    await save_event_log(session, username, SubscriptionActivated())
-                except Exception as e:
-                    logging.error(
-                        f"saving subscription reactivated event log failed: {e}"
-                    )
-
-    def __init__(self, config: Config, session_maker: async_sessionmaker):
+    def __init__(
+        self,
+        config: Config,
+        ownership: PartitionOwnership,
+        outbox: NotificationOutbox,
+        event_log_writer: EventLogWriter,
+    ):
         self.__config = config
-        self.__session_maker = session_maker
+        self.__ownership = ownership
+        self.__outbox = outbox
+        self.__event_log_writer = event_log_writer
         self.__rwms_client = RwmsClient(addr=config.rwms_address, port=config.rwms_port)
 
-        # Директории для хранения задач для продления подписок в remnawave
-        self.__rwms_tasks_dir = Path("rwms-tasks")
-        self.__pending_dir = self.__rwms_tasks_dir / "pending"
-        self.__processing_dir = self.__rwms_tasks_dir / "processing"
-
+        # Директории для хранения задач для продления подписок в remnawave,
+        # по разделам (partitions.py) с тем же ключом, что и у webhook'ов
+        self.__rwms_tasks_dir = RWMS_TASKS_DIR
         self.__rwms_tasks_dir.mkdir(parents=True, exist_ok=True)
-        self.__pending_dir.mkdir(parents=True, exist_ok=True)
-        self.__processing_dir.mkdir(parents=True, exist_ok=True)
+
+        # Задачи, исчерпавшие попытки или невыполнимые (например, реферера нет
+        # в RWMS). Вернуть задачу можно переносом в pending ее раздела.
+        self.__failed_dir = self.__rwms_tasks_dir / "failed"
+        self.__failed_dir.mkdir(parents=True, exist_ok=True)
+
+        # Повторы задач по имени файла: число неудачных попыток и время,
+        # раньше которого задача не повторяется. После перезапуска процесса
+        # счет попыток начинается заново.
+        self.__retries: dict[str, tuple[int, float]] = {}
+
+        repartition(
+            self.__rwms_tasks_dir, config.partitions, get_rwms_task_partition_key
+        )
+
+        self.__partitions = [
+            SpoolPartition(
+                index,
+                get_partition_dir(self.__rwms_tasks_dir, config.partitions, index),
+            )
+            for index in range(config.partitions)
+        ]
+
+        track_spool_depth(
+            "rwms-tasks",
+            [partition.pending_dir for partition in self.__partitions],
+            [partition.processing_dir for partition in self.__partitions],
+        )
+
+    @property
+    def partitions(self) -> list[SpoolPartition]:
+        return self.__partitions
+
+    # Канал gRPC подключается при первом вызове, поэтому ping его и открывает.
+    async def ping(self):
+        await self.__rwms_client.get_user_by_username(RWMS_PING_USERNAME)
 
     # Сохранение задачи на продление подписки в remnawave на диск.
     # После этого основной цикл будет её обрабатывать.
@@ -90,76 +187,264 @@ class RwmsTasksProcessor:
         logging.info(f"writing rwms task {payment_id} on disk")
 
         filename = f"{payment_id}.json"
-        task_file = self.__pending_dir / filename
+        partition_key = user_partition_key(str(task.username))
+        partition = self.__partitions[
+            get_partition(partition_key, len(self.__partitions))
+        ]
+        task_file = partition.pending_path(get_shard(partition_key), filename)
 
-        with open(task_file, "w") as f:
-            f.write(task.model_dump_json())
+        with SPOOL_WRITE_SECONDS.labels("rwms-tasks").time():
+            with open(task_file, "w") as f:
+                f.write(task.model_dump_json())
 
         logging.info(f"rwms task {payment_id} saved on disk at {task_file}")
 
     async def process(self):
         while True:
-            files = self.__get_pending_tasks()
-
-            for file in files:
-                processing = self.__mark_task_as_processing(file)
-
-                try:
-                    text = processing.read_text()
-                    data = orjson.loads(text)
-                    type = data.get("type")
-
-                    if type not in RWMS_TASK_CLASSES:
-                        raise ValueError(f"unknown rwms task type: {type}")
-
-                    task_class = RWMS_TASK_CLASSES[type]
-                    task = task_class.model_validate(data)
-
-                    if task_class == RwmsAddTimeIntervalTask:
-                        logging.info(
-                            f"processing {task_class} task for subscription {task.username}"
-                        )
-
-                        user = await self.__rwms_client.get_user_by_username(
-                            task.username
-                        )
-
-                        user_response = None
-                        subscription_activated = False
-
-                        if user is None:
-                            user_response = await create_user(
-                                rwms_client=self.__rwms_client,
-                                config=self.__config,
-                                tariff=task.tariff,
-                                username=task.username,
-                                telegram_id=task.telegram_id,
-                                email=task.email,
-                            )
-                        else:
-                            logging.info(f"updating expire time for {task.username}")
-
-                            user_response, subscription_activated = await update_user(
-                                rwms_client=self.__rwms_client,
-                                config=self.__config,
-                                user=user,
-                                interval=task.tariff.subscription_period,
-                            )
-
-                        if user_response is not None:
-                            self.__remove_file(processing)
-                            logging.info(
-                                f"successfully handled {task_class} task for {task.username}, "
-                                f"tariff {task.tariff.description}"
-                            )
-
-                        if subscription_activated:
-                            await self.__save_subscription_reactivated(task.username)
-
-                except Exception as e:
-                    logging.error(
-                        f"executing rwms task {file.name} failed: {e}",
-                        exc_info=True,
+            partitions = [
+                partition
+                for partition in self.__partitions
+                if self.__ownership.owns(partition.index)
+            ]
+
+            with self.__ownership.hold(*(partition.index for partition in partitions)):
+                await self.__process_tasks(self.__get_pending_tasks(partitions))
+
+            await asyncio.sleep(TUNING.values.rwms_task_pause)
+
+    # Задачи одного пользователя выполняются по очереди в порядке записи, чтобы
+    # продления не читали и не записывали expire_at одновременно. Задачи разных
+    # пользователей - параллельно, не больше rwms_concurrency сразу. Лимит
+    # читается на каждом проходе: новое значение применяется к следующему проходу.
+    async def __process_tasks(self, files: list[tuple[SpoolPartition, Path]]):
+        limiter = asyncio.Semaphore(TUNING.values.rwms_concurrency)
+        user_tasks: dict[str, list[tuple[SpoolPartition, Path, RwmsTask]]] = {}
+
+        for partition, file in files:
+            task = self.__read_task(partition, file)
+
+            if task is not None:
+                user_tasks.setdefault(str(task.username), []).append(
+                    (partition, file, task)
+                )
+
+        await asyncio.gather(
+            *(
+                self.__process_user_tasks(tasks, limiter)
+                for tasks in user_tasks.values()
+            )
+        )
+
+    async def __process_user_tasks(
+        self,
+        tasks: list[tuple[SpoolPartition, Path, RwmsTask]],
+        limiter: asyncio.Semaphore,
+    ):
+        for partition, file, task in tasks:
+            async with limiter:
+                # Аренда раздела потеряна во время прохода - задачи дождутся
+                # нового владельца.
+                if not self.__ownership.owns(partition.index):
+                    logging.warning(
+                        f"lease of partition {partition.index} lost, "
+                        f"skipping rwms task {file.name}"
                     )
+                    return
+
+                # Задача ждет повтора - следующие задачи пользователя ждут ее.
+                if self.__is_waiting_retry(file):
+                    return
+
+                await self.__process_task(partition, file, task)
+
+    # Неразборчивая задача переносится в processing и остается там для разбора.
+    def __read_task(self, partition: SpoolPartition, file: Path) -> RwmsTask | None:
+        try:
+            data = orjson.loads(file.read_bytes())
+            type = data.get("type")
+
+            if type not in RWMS_TASK_CLASSES:
+                raise ValueError(f"unknown rwms task type: {type}")
+
+            return RWMS_TASK_CLASSES[type].model_validate(data)
+        except Exception as e:
+            logging.error(f"reading rwms task {file.name} failed: {e}", exc_info=True)
+            RWMS_TASKS_PROCESSED_TOTAL.labels("unknown", "invalid").inc()
+            self.__mark_task_as_processing(partition, file)
+            return None
+
+    async def __process_task(
+        self, partition: SpoolPartition, file: Path, task: RwmsTask
+    ):
+        processing = self.__mark_task_as_processing(partition, file)
+        type = task.type
+
+        # Ожидание в spool считается от записи файла, повторы входят в него.
+        span_attributes = {"payment.id": processing.stem, "task.type": type}
+
+        TRACER.record_span(
+            "rwms_task.queue",
+            task.traceparent,
+            start_time_ns=processing.stat().st_mtime_ns,
+            end_time_ns=time.time_ns(),
+            attributes=span_attributes,
+        )
+
+        with SLOW_WEBHOOKS.record("rwms-task", processing) as timing:
+            timing.event = type
+            timing.payment_id = processing.stem
+
+            try:
+                with TRACER.span(
+                    "rwms_task.process", task.traceparent, span_attributes
+                ):
+                    if isinstance(task, RwmsAddTimeIntervalTask):
+                        outcome = await self.__add_time_interval(task)
+                    elif isinstance(task, RwmsReferralBonusTask):
+                        outcome = await self.__apply_referral_bonus(task)
+                    else:
+                        logging.warning(f"no handler for rwms task type {type}")
+                        timing.outcome = "skipped"
+                        RWMS_TASKS_PROCESSED_TOTAL.labels(type, "skipped").inc()
+                        return
+            except Exception as e:
+                logging.error(
+                    f"executing rwms task {file.name} failed: {e}", exc_info=True
+                )
+                outcome = "retried"
+
+            if outcome == "retried":
+                outcome = self.__count_failed_attempt(processing)
+
+            timing.outcome = outcome
+
+        if outcome == "processed":
+            self.__retries.pop(processing.name, None)
+            self.__remove_file(processing)
+        elif outcome == "failed":
+            self.__retries.pop(processing.name, None)
+            self.__move_task_to_failed(processing)
+        else:
+            self.__return_task_to_pending(partition, processing)
+
+        RWMS_TASKS_PROCESSED_TOTAL.labels(type, outcome).inc()
+
+    def __is_waiting_retry(self, file: Path) -> bool:
+        retry = self.__retries.get(file.name)
+        return retry is not None and retry[1] > time.monotonic()
+
+    # Неудачная попытка: задача повторяется с экспоненциальной задержкой, а
+    # после rwms_task_max_attempts попыток откладывается в failed/.
+    def __count_failed_attempt(self, file: Path) -> str:
+        tuning = TUNING.values
+        attempts = self.__retries.get(file.name, (0, 0.0))[0] + 1
+
+        if attempts >= tuning.rwms_task_max_attempts:
+            logging.error(f"rwms task {file.name} failed {attempts} times, giving up")
+            return "failed"
+
+        delay = min(
+            tuning.rwms_task_retry_delay * 2 ** (attempts - 1),
+            tuning.rwms_task_max_retry_delay,
+        )
+        self.__retries[file.name] = (attempts, time.monotonic() + delay)
+        logging.warning(
+            f"rwms task {file.name} failed {attempts} times, retrying in {delay:.0f}s"
+        )
+        return "retried"
+
+    def __move_task_to_failed(self, file: Path):
+        try:
+            file.rename(self.__failed_dir / file.name)
+            logging.error(f"rwms task {file.name} moved to {self.__failed_dir}")
+        except Exception as e:
+            logging.error(f"failed to move {file.name} to {self.__failed_dir}: {e}")
+
+    async def __add_time_interval(self, task: RwmsAddTimeIntervalTask) -> str:
+        logging.info(
+            f"processing add-time-interval task for subscription {task.username}"
+        )
+
+        user = await get_user_by_username(self.__rwms_client, task.username)
+
+        user_response = None
+        subscription_activated = False
+
+        if user is None:
+            user_response = await create_user(
+                rwms_client=self.__rwms_client,
+                config=self.__config,
+                tariff=task.tariff,
+                username=task.username,
+                telegram_id=task.telegram_id,
+                email=task.email,
+                expire_at=task.expire_at,
+            )
+        else:
+            logging.info(f"updating expire time for {task.username}")
+
+            user_response, subscription_activated = await update_user(
+                rwms_client=self.__rwms_client,
+                config=self.__config,
+                user=user,
+                interval=task.tariff.subscription_period,
+                expire_at=task.expire_at,
+            )
+
+        if user_response is None:
+            return "retried"
+
+        logging.info(
+            f"successfully handled add-time-interval task for {task.username}, "
+            f"tariff {task.tariff.description}"
+        )
+
+        if subscription_activated:
+            self.__event_log_writer.enqueue(task.username, SubscriptionActivated())
+
+        return "processed"
+
+    # Бонус уже записан в базу, поэтому задача без подписки реферера в RWMS
+    # не удаляется, а откладывается в failed/ для разбора.
+    async def __apply_referral_bonus(self, task: RwmsReferralBonusTask) -> str:
+        logging.info(f"processing referral-bonus task for subscription {task.username}")
+
+        user = await get_user_by_username(self.__rwms_client, task.username)
+
+        if user is None:
+            logging.error(
+                f"referrer subscription not found in RWMS for {task.username}, "
+                f"referral bonus task can not be applied"
+            )
+            return "failed"
+
+        user_response, subscription_activated = await update_user(
+            rwms_client=self.__rwms_client,
+            config=self.__config,
+            user=user,
+            interval=timedelta(days=task.bonus_days_count),
+            expire_at=task.expire_at,
+        )
+
+        if user_response is None:
+            logging.error(
+                f"failed to apply referral bonus for referrer {task.username}"
+            )
+            return "retried"
+
+        logging.info(
+            f"referral bonus for referrer {task.username} applied successfully"
+        )
+
+        if subscription_activated:
+            self.__event_log_writer.enqueue(task.username, SubscriptionActivated())
+
+        if task.telegram_id is not None:
+            await send_referral_purchase_bonus_applied(
+                self.__outbox,
+                task.telegram_id,
+                task.referral_tariff,
+                task.bonus_days_count,
+            )
 
-            await asyncio.sleep(PROCESS_RWMS_TASK_PAUSE)
+        return "processed"
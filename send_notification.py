@@ -1,4 +1,6 @@
-from redis_message_publisher import RedisMessagePublisher
+from notification_outbox import MessagePublisher
+from redis_message_publisher import VPN_BOT_QUEUE
+from redis_message_publisher import VPS_BOT_QUEUE
 from common.models.tariff import Tariff
 from common.models.messages import NotificateUserMessage
 from common.models.messages import ReferralPurchaseBonusApplied
@@ -14,7 +16,7 @@ def create_notification_message(
 
 
 async def send_referral_purchase_bonus_applied(
-    publisher: RedisMessagePublisher,
+    publisher: MessagePublisher,
     telegram_id: int,
     tariff: str,
     bonus_days_count: int,
@@ -24,31 +26,24 @@ async def send_referral_purchase_bonus_applied(
         referral_tariff=tariff,
         bonus_days_count=bonus_days_count,
     )
-    await publisher.push_message_to_vpn_bot(message=message)
-    await publisher.push_message_to_vps_bot(message=message)
+    await publisher.publish(message, VPN_BOT_QUEUE, VPS_BOT_QUEUE)
 
 
-async def send_succeeded_autopay(publisher: RedisMessagePublisher, telegram_id: int):
+async def send_succeeded_autopay(publisher: MessagePublisher, telegram_id: int):
     message = create_notification_message("purchase-success-autopay", telegram_id)
-    await publisher.push_message_to_vpn_bot(message=message)
-    await publisher.push_message_to_vps_bot(message=message)
+    await publisher.publish(message, VPN_BOT_QUEUE, VPS_BOT_QUEUE)
 
 
-async def send_succeeded_non_autopay(
-    publisher: RedisMessagePublisher, telegram_id: int
-):
+async def send_succeeded_non_autopay(publisher: MessagePublisher, telegram_id: int):
     message = create_notification_message("purchase-success-non-autopay", telegram_id)
-    await publisher.push_message_to_vpn_bot(message=message)
-    await publisher.push_message_to_vps_bot(message=message)
+    await publisher.publish(message, VPN_BOT_QUEUE, VPS_BOT_QUEUE)
 
 
-async def send_failed_autopay(publisher: RedisMessagePublisher, telegram_id: int):
+async def send_failed_autopay(publisher: MessagePublisher, telegram_id: int):
     message = create_notification_message("purchase-failure-autopay", telegram_id)
-    await publisher.push_message_to_vpn_bot(message=message)
-    await publisher.push_message_to_vps_bot(message=message)
+    await publisher.publish(message, VPN_BOT_QUEUE, VPS_BOT_QUEUE)
 
 
-async def send_failed_non_autopay(publisher: RedisMessagePublisher, telegram_id: int):
+async def send_failed_non_autopay(publisher: MessagePublisher, telegram_id: int):
     message = create_notification_message("purchase-failure-non-autopay", telegram_id)
-    await publisher.push_message_to_vpn_bot(message=message)
-    await publisher.push_message_to_vps_bot(message=message)
+    await publisher.publish(message, VPN_BOT_QUEUE, VPS_BOT_QUEUE)
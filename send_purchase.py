@@ -1,10 +1,11 @@
-from redis_message_publisher import RedisMessagePublisher
+from notification_outbox import MessagePublisher
+from redis_message_publisher import YM_STAT_QUEUE
 from common.models.messages import SendPurchaseMessage
 from common.models.tariff import Tariff
 
 
 async def send_purchase(
-    publisher: RedisMessagePublisher,
+    publisher: MessagePublisher,
     username: str,
     transaction_id: str,
     tariff: Tariff,
@@ -16,4 +17,4 @@ async def send_purchase(
         transaction_id=transaction_id,
         tariff=tariff,
     )
-    await publisher.push_message_to_ym_stat(message=message)
+    await publisher.publish(message, YM_STAT_QUEUE)
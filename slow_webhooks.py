@@ -0,0 +1,213 @@
+import re
+import time
+import orjson
+import logging
+
+from pathlib import Path
+from functools import lru_cache
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Журнал времени обработки webhook'ов и задач RWMS по этапам: ожидание в spool,
+# разбор, группы SQL-запросов, callback'и после коммита, вызовы RWMS и итог.
+# Последние записи хранятся в кольцевом буфере в памяти, самые медленные -
+# в top-K, который периодически сохраняется на диск и переживает перезапуск.
+# Текущая запись хранится в contextvar, поэтому этапы отмечаются там, где
+# выполняются, без передачи записи через все вызовы.
+
+SLOW_WEBHOOKS_RING_SIZE = 1000  # records
+SLOW_WEBHOOKS_TOP_K = 100  # records
+SLOW_WEBHOOKS_PERSIST_INTERVAL = 10  # seconds
+
+_CURRENT_TIMING: ContextVar["WebhookTiming | None"] = ContextVar(
+    "current_webhook_timing", default=None
+)
+
+_SQL_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE)\s+([\w.\"]+)", re.IGNORECASE)
+
+
+class WebhookTiming:
+    def __init__(self, kind: str, name: str, spool_wait: float):
+        self.kind = kind
+        self.name = name
+        self.payment_id: str | None = None
+        self.event: str | None = None
+        self.outcome: str | None = None
+        self.started_at = time.time()
+        self.total = 0.0
+        self.stages: dict[str, float] = {"spool_wait": spool_wait}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, stage: str):
+        started_at = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started_at)
+
+    def as_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            "name": self.name,
+            "payment_id": self.payment_id,
+            "event": self.event,
+            "outcome": self.outcome,
+            "started_at": self.started_at,
+            "total_ms": round(self.total * 1000, 3),
+            "stages_ms": {
+                stage: round(seconds * 1000, 3)
+                for stage, seconds in self.stages.items()
+            },
+        }
+
+
+def current_timing() -> WebhookTiming | None:
+    return _CURRENT_TIMING.get()
+
+
+# Отмечает этап текущей записи. Вне обработки webhook'а или задачи ничего не делает.
+@contextmanager
+def timed_stage(stage: str):
+    timing = _CURRENT_TIMING.get()
+
+    if timing is None:
+        yield
+        return
+
+    with timing.stage(stage):
+        yield
+
+
+class SlowWebhookLog:
+    def __init__(self, path: Path = Path("slow-webhooks/top.json")):
+        self.__path = path
+        self.__recent: deque[dict] = deque(maxlen=SLOW_WEBHOOKS_RING_SIZE)
+        self.__slowest: list[dict] = []
+        self.__dirty = False
+        self.__persisted_at = 0.0
+        self.__loaded = False
+
+    # Запись о webhook'е или задаче из spool-файла. Ожидание в spool
+    # считается от записи файла (mtime сохраняется при переносе в processing).
+    @contextmanager
+    def record(self, kind: str, spool_file: Path):
+        self.__load()
+
+        spool_wait = max(time.time() - spool_file.stat().st_mtime, 0.0)
+        timing = WebhookTiming(kind, spool_file.stem, spool_wait)
+        token = _CURRENT_TIMING.set(timing)
+        started_at = time.perf_counter()
+
+        try:
+            yield timing
+        finally:
+            _CURRENT_TIMING.reset(token)
+            timing.total = spool_wait + time.perf_counter() - started_at
+            self.__add(timing.as_dict())
+
+    def query(
+        self, payment_id: str | None = None, min_total_ms: float = 0.0
+    ) -> dict[str, list[dict]]:
+        self.__load()
+
+        def matches(record: dict) -> bool:
+            if payment_id is not None and payment_id not in (
+                record["payment_id"],
+                record["name"],
+            ):
+                return False
+
+            return record["total_ms"] >= min_total_ms
+
+        return {
+            "recent": [record for record in self.__recent if matches(record)],
+            "slowest": [record for record in self.__slowest if matches(record)],
+        }
+
+    def persist(self):
+        if not self.__dirty:
+            return
+
+        self.__path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.__path.with_suffix(".tmp")
+        tmp_path.write_bytes(orjson.dumps(self.__slowest))
+        tmp_path.rename(self.__path)
+
+        self.__dirty = False
+        self.__persisted_at = time.monotonic()
+
+    def __add(self, record: dict):
+        self.__recent.append(record)
+
+        if (
+            len(self.__slowest) < SLOW_WEBHOOKS_TOP_K
+            or record["total_ms"] > self.__slowest[-1]["total_ms"]
+        ):
+            self.__slowest.append(record)
+            self.__slowest.sort(key=lambda r: r["total_ms"], reverse=True)
+            del self.__slowest[SLOW_WEBHOOKS_TOP_K:]
+            self.__dirty = True
+
+        if (
+            self.__dirty
+            and time.monotonic() - self.__persisted_at > SLOW_WEBHOOKS_PERSIST_INTERVAL
+        ):
+            try:
+                self.persist()
+            except Exception as e:
+                logging.error(f"persisting slow webhooks failed: {e}")
+
+    def __load(self):
+        if self.__loaded:
+            return
+
+        self.__loaded = True
+
+        try:
+            self.__slowest = orjson.loads(self.__path.read_bytes())
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logging.error(f"loading slow webhooks from {self.__path} failed: {e}")
+
+
+@lru_cache(maxsize=256)
+def _sql_stage(statement: str) -> str:
+    words = statement.split(None, 1)
+    verb = words[0].upper() if words else "?"
+    table = _SQL_TABLE_RE.search(statement)
+
+    if table is None:
+        return f"sql:{verb}"
+
+    return f"sql:{verb} {table.group(1).strip(chr(34))}"
+
+
+# Время SQL-запросов записывается в текущую запись по группам "глагол таблица".
+# SQLAlchemy импортируется здесь: журнал нужен и HTTP-серверу, который
+# запускается без базы.
+def install_sql_timing(engine):
+    from sqlalchemy import event
+
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        if _CURRENT_TIMING.get() is not None:
+            context._slow_webhook_started_at = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):
+        timing = _CURRENT_TIMING.get()
+        started_at = getattr(context, "_slow_webhook_started_at", None)
+
+        if timing is not None and started_at is not None:
+            timing.add(_sql_stage(statement), time.perf_counter() - started_at)
+
+
+SLOW_WEBHOOKS = SlowWebhookLog()
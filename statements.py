@@ -0,0 +1,163 @@
+# Реестр горячих SQL-запросов обработки платежей.
+# Запросы собираются один раз при импорте модуля, а значения передаются
+# параметрами при выполнении. Так SQLAlchemy не пересобирает конструкции
+# на каждый webhook и сразу находит скомпилированный запрос в своем кэше,
+# а asyncpg переиспользует подготовленные выражения соединения.
+from sqlalchemy import text
+from sqlalchemy import exists
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy import bindparam
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.postgresql import insert
+
+from common.models.db import User
+from common.models.db import YkPayment
+from common.models.db import ReferralType
+from common.models.db import ReferralBonus
+
+REFERRER = aliased(User, name="referrer")
+
+SELECT_USER_ID_BY_USERNAME = (
+    select(User.id).where(User.username == bindparam("username")).limit(1)
+)
+
+SELECT_AUTOPAY_ALLOW_BY_USERNAME = select(User.autopay_allow).where(
+    User.username == bindparam("username")
+)
+
+
+# Значения вставляемой строки параметрами, с типами колонок модели: для
+# INSERT ... SELECT ... WHERE NOT EXISTS.
+def select_params(model, columns: tuple[str, ...]):
+    table = model.__table__
+    return select(
+        *(bindparam(column, type_=table.c[column].type) for column in columns)
+    )
+
+
+# Вставка строки, если такой еще нет, одним запросом. ON CONFLICT DO NOTHING
+# без указания ограничения отсекает параллельную вставку по любому
+# уникальному ограничению таблицы и не ломает запрос, если его еще нет, а
+# NOT EXISTS - повторную вставку, если ограничения нет. RETURNING возвращает
+# строку, только если ее вставил этот запрос.
+def insert_if_not_exists(model, columns: tuple[str, ...], *conditions):
+    return (
+        insert(model)
+        .from_select(
+            columns, select_params(model, columns).where(~exists().where(*conditions))
+        )
+        .on_conflict_do_nothing()
+    )
+
+
+# Параметры: значения колонок yk_payments. Повторная доставка отсекается по
+# payment_id. Без уникального ограничения на yk_payments.payment_id две
+# параллельные доставки обе пройдут NOT EXISTS; ограничение добавляется
+# в модель в common, и тогда вторую вставку отсекает ON CONFLICT.
+INSERT_PAYMENT_IF_NOT_EXISTS = insert_if_not_exists(
+    YkPayment,
+    (
+        "is_trial_promotion",
+        "user_id",
+        "amount",
+        "currency",
+        "status",
+        "captured_at",
+        "created_at",
+        "payment_id",
+        "subscription_period",
+    ),
+    YkPayment.payment_id == bindparam("payment_id"),
+).returning(YkPayment.payment_id)
+
+# Платежи из списка, уже сохраненные в yk_payments.
+SELECT_EXISTING_PAYMENT_IDS = select(YkPayment.payment_id).where(
+    YkPayment.payment_id.in_(bindparam("payment_ids", expanding=True))
+)
+
+# Реферал, его реферер и данные реферера для начисления бонуса одним запросом.
+SELECT_REFERRAL_WITH_REFERRER = (
+    select(User.id, REFERRER.id, REFERRER.username, REFERRER.telegram_id)
+    .join(REFERRER, REFERRER.id == User.referred_by_id)
+    .where(User.username == bindparam("username"))
+    .where(User.referral_type == ReferralType.STANDARD)
+    .limit(1)
+)
+
+# Параметры: значения колонок referral_bonuses. Бонус за одну покупку
+# начисляется один раз на пару реферер-реферал; без уникального ограничения
+# (referrer_id, referral_id, bonus_type), которое добавляется в модель в
+# common, параллельные вставки обе пройдут NOT EXISTS.
+INSERT_REFERRAL_BONUS_IF_NOT_EXISTS = insert_if_not_exists(
+    ReferralBonus,
+    ("referral_id", "referrer_id", "bonus_type", "days_added"),
+    ReferralBonus.referrer_id == bindparam("referrer_id"),
+    ReferralBonus.referral_id == bindparam("referral_id"),
+    ReferralBonus.bonus_type == bindparam("bonus_type"),
+).returning(ReferralBonus.referral_id)
+
+SET_PAYMENT_REFUNDED = (
+    update(YkPayment)
+    .where(YkPayment.payment_id == bindparam("refund_payment_id"))
+    .values(status="refunded")
+    .returning(YkPayment.payment_id)
+    .execution_options(synchronize_session=False)
+)
+
+EXTEND_EXPIRE_AT = text("""
+    UPDATE users
+        SET expire_at =
+        CASE
+            WHEN expire_at > (NOW() AT TIME ZONE 'UTC') THEN expire_at + (:interval)::interval
+            ELSE (NOW() AT TIME ZONE 'UTC') + (:interval)::interval
+        END
+        WHERE username = :username
+        RETURNING expire_at
+    """)
+
+UPSERT_RECURRENT_PAYMENT = text("""
+    WITH user_data AS (
+        SELECT id FROM users WHERE username = :username LIMIT 1
+    )
+    INSERT INTO yk_recurrent_payments (
+        recurrent_payment_id,
+        user_id,
+        amount,
+        currency,
+        captured_at,
+        subscription_period,
+        is_trial_promotion,
+        scheduled_payment
+    )
+    SELECT
+        :recurrent_payment_id,
+        (SELECT id FROM user_data),
+        :amount,
+        :currency,
+        :captured_at,
+        :subscription_period,
+        :is_trial_promotion,
+        :scheduled_payment
+    ON CONFLICT (user_id) DO UPDATE SET
+        recurrent_payment_id = EXCLUDED.recurrent_payment_id,
+        amount = EXCLUDED.amount,
+        currency = EXCLUDED.currency,
+        captured_at = EXCLUDED.captured_at,
+        subscription_period = EXCLUDED.subscription_period,
+        is_trial_promotion = EXCLUDED.is_trial_promotion,
+        scheduled_payment = false
+    """)
+
+DISABLE_AUTOPAY = text("""
+    WITH target_user AS (
+        SELECT id FROM users WHERE username = :username
+    ),
+    deleted_recurrent_payment AS (
+        DELETE FROM yk_recurrent_payments
+            WHERE user_id IN (SELECT id FROM target_user)
+    )
+    UPDATE users
+        SET autopay_allow = false
+        WHERE id IN (SELECT id FROM target_user)
+    """)
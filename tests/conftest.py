@@ -0,0 +1,6 @@
+import sys
+
+from pathlib import Path
+
+# Модули сервиса лежат в корне репозитория и импортируются без пакета.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
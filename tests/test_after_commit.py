@@ -0,0 +1,92 @@
+import asyncio
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from after_commit import savepoint
+from after_commit import call_after_commit
+from after_commit import call_before_commit
+from after_commit import call_after_rollback
+
+
+def run_in_session(body) -> list[str]:
+    calls = []
+
+    async def main():
+        engine = create_async_engine("sqlite+aiosqlite://")
+        session_maker = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+        try:
+            async with session_maker() as session:
+                await body(session, calls)
+        finally:
+            await engine.dispose()
+
+    asyncio.run(main())
+    return calls
+
+
+def test_released_savepoint_does_not_run_callbacks_before_outer_rollback():
+    async def body(session, calls):
+        async with session.begin():
+            async with savepoint(session):
+                await session.execute(text("select 1"))
+                call_after_commit(session, lambda: calls.append("released"))
+
+            await session.rollback()
+
+    assert run_in_session(body) == []
+
+
+def test_callbacks_run_once_after_outer_commit():
+    async def body(session, calls):
+        async with session.begin():
+            call_after_commit(session, lambda: calls.append("outer"))
+
+            async with savepoint(session):
+                call_after_commit(session, lambda: calls.append("released"))
+
+            try:
+                async with savepoint(session):
+                    call_after_commit(session, lambda: calls.append("rolled back"))
+                    raise ValueError()
+            except ValueError:
+                pass
+
+            assert calls == []
+
+    assert run_in_session(body) == ["outer", "released"]
+
+
+def test_rollback_callbacks_run_only_for_outer_rollback():
+    async def body(session, calls):
+        async with session.begin():
+            call_before_commit(session, lambda: calls.append("before commit"))
+            call_after_rollback(session, lambda: calls.append("outer"))
+
+            try:
+                async with savepoint(session):
+                    call_after_rollback(session, lambda: calls.append("savepoint"))
+                    raise ValueError()
+            except ValueError:
+                pass
+
+            await session.rollback()
+
+    assert run_in_session(body) == ["outer"]
+
+
+def test_before_commit_callbacks_run_before_after_commit_callbacks():
+    async def body(session, calls):
+        async with session.begin():
+            call_before_commit(session, lambda: calls.append("before commit"))
+            call_after_commit(session, lambda: calls.append("after commit"))
+            call_after_rollback(session, lambda: calls.append("rollback"))
+
+            async with savepoint(session):
+                await session.execute(text("select 1"))
+
+            assert calls == []
+
+    assert run_in_session(body) == ["before commit", "after commit"]
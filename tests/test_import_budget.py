@@ -0,0 +1,43 @@
+import orjson
+import pytest
+
+from argparse import Namespace
+
+from benchmarks import bench_import
+
+
+def read_forbidden_modules() -> list[str]:
+    return orjson.loads(bench_import.BUDGET_PATH.read_bytes())["forbidden_modules"]
+
+
+# Проверка по исходникам не импортирует main и работает без зависимостей
+# образа и модуля common.
+def test_main_does_not_import_forbidden_modules():
+    forbidden = read_forbidden_modules()
+    imported = bench_import.static_imports("main")
+
+    assert "webhook_spool" in imported
+    assert [
+        name for name in imported if bench_import.is_forbidden(name, forbidden)
+    ] == []
+
+
+def test_static_imports_follow_repository_modules():
+    imported = bench_import.static_imports("payment_service")
+
+    assert "sqlalchemy" in imported
+    assert "redis" in imported
+
+
+# main импортируется в отдельном процессе, поэтому проверка имеет смысл только
+# там, где установлены зависимости образа и подключен common.
+def test_main_import_loads_no_forbidden_modules():
+    pytest.importorskip("fastapi")
+    pytest.importorskip("uvicorn")
+    pytest.importorskip("prometheus_client")
+    pytest.importorskip("common.setup_logger")
+
+    budget = {"forbidden_modules": read_forbidden_modules()}
+    result = bench_import.run(Namespace(runs=3, top=0), budget)
+
+    assert bench_import.check_budget(result) == []
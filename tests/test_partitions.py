@@ -0,0 +1,36 @@
+import orjson
+
+from partitions import SpoolPartition
+from partitions import get_shard
+from partitions import migrate_to_shards
+from partitions import user_partition_key
+from webhook_decoder import encode_spooled_webhook
+from webhook_decoder import get_spooled_webhook_partition_key
+
+
+def webhook(event: str, payment_id: str, username: str) -> bytes:
+    body = {
+        "event": event,
+        "object": {"id": payment_id, "metadata": {"username": username}},
+    }
+    return encode_spooled_webhook(orjson.dumps(body), None)
+
+
+def test_webhooks_of_one_user_are_moved_into_one_shard(tmp_path):
+    partition = SpoolPartition(0, tmp_path)
+    names = ["p0_first.json", "p1_second.json", "p0_third.json"]
+
+    for name in names:
+        (partition.pending_dir / name).write_bytes(
+            webhook("payment.succeeded", name, "42")
+        )
+
+    (partition.pending_dir / "p0_broken.json").write_bytes(b"{")
+
+    migrate_to_shards([partition], get_spooled_webhook_partition_key)
+
+    shard = get_shard(user_partition_key("42"))
+    assert sorted(path.name for path in partition.list_pending(shard)) == sorted(names)
+    assert partition.pending_path(
+        get_shard("p0_broken.json"), "p0_broken.json"
+    ).exists()
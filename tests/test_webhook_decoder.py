@@ -0,0 +1,18 @@
+from webhook_decoder import OtherNotification
+from webhook_decoder import get_notification_id
+from webhook_decoder import decode_spooled_webhook
+from webhook_decoder import encode_spooled_webhook
+
+
+def test_unhandled_notification_keeps_object_id():
+    body = b'{"event":"payment.waiting_for_capture","object":{"id":"p1","status":"x"}}'
+    notification, _ = decode_spooled_webhook(encode_spooled_webhook(body, None))
+
+    assert isinstance(notification, OtherNotification)
+    assert get_notification_id(notification) == "p1"
+
+
+def test_unhandled_notification_without_object():
+    notification, _ = decode_spooled_webhook(b'{"event":"payout.succeeded"}')
+
+    assert get_notification_id(notification) is None
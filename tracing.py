@@ -0,0 +1,259 @@
+import os
+import time
+import orjson
+import random
+import logging
+
+from pathlib import Path
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Трассировка платежа от приема webhook'а до активации подписки в RWMS.
+# Контекст передается в формате W3C traceparent: он создается при приеме,
+# сохраняется в spool-файлах webhook'а и задачи RWMS и внутри процесса
+# хранится в contextvar. Решение о сэмплировании принимается один раз при
+# создании трассы и передается во флагах traceparent. Спаны сэмплированных
+# трасс пишутся в файл построчно в формате OTLP JSON, который умеет читать
+# OpenTelemetry Collector (otlpjsonfile receiver).
+
+TRACE_SERVICE_NAME = "monkey-island-payment"
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+
+STATUS_CODE_OK = 1
+STATUS_CODE_ERROR = 2
+
+_CURRENT_TRACEPARENT: ContextVar[str | None] = ContextVar(
+    "current_traceparent", default=None
+)
+
+
+def current_traceparent() -> str | None:
+    return _CURRENT_TRACEPARENT.get()
+
+
+def _parse_traceparent(traceparent: str | None) -> tuple[str, str, bool] | None:
+    if not traceparent:
+        return None
+
+    parts = traceparent.split("-")
+
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+
+    return parts[1], parts[2], parts[3] == "01"
+
+
+def _format_traceparent(trace_id: str, span_id: str, sampled: bool) -> str:
+    return f"00-{trace_id}-{span_id}-{'01' if sampled else '00'}"
+
+
+def _otlp_attributes(attributes: dict) -> list[dict]:
+    return [
+        {"key": key, "value": {"stringValue": str(value)}}
+        for key, value in attributes.items()
+    ]
+
+
+class SpanFileExporter:
+    def __init__(self, path: Path):
+        self.__path = path
+        self.__path.parent.mkdir(parents=True, exist_ok=True)
+
+    def export(self, span: dict):
+        line = orjson.dumps(
+            {
+                "resourceSpans": [
+                    {
+                        "resource": {
+                            "attributes": _otlp_attributes(
+                                {"service.name": TRACE_SERVICE_NAME}
+                            )
+                        },
+                        "scopeSpans": [
+                            {"scope": {"name": TRACE_SERVICE_NAME}, "spans": [span]}
+                        ],
+                    }
+                ]
+            }
+        )
+
+        with open(self.__path, "ab") as f:
+            f.write(line + b"\n")
+
+
+class Tracer:
+    def __init__(
+        self, sample_rate: float = 0.0, path: Path = Path("traces/spans.jsonl")
+    ):
+        self.__sample_rate = sample_rate
+        self.__path = path
+        self.__exporter: SpanFileExporter | None = None
+
+    def configure(self, sample_rate: float):
+        self.__sample_rate = sample_rate
+
+        if sample_rate > 0 and self.__exporter is None:
+            self.__exporter = SpanFileExporter(self.__path)
+
+    # Корневой спан новой трассы. Трасса сэмплируется с вероятностью sample_rate,
+    # для несэмплированной трассы возвращается traceparent со сброшенным флагом.
+    @contextmanager
+    def start_span(
+        self,
+        name: str,
+        attributes: dict | None = None,
+        kind: int = SPAN_KIND_SERVER,
+        start_time_ns: int | None = None,
+    ):
+        trace_id = os.urandom(16).hex()
+        sampled = self.__exporter is not None and random.random() < self.__sample_rate
+
+        if not sampled:
+            traceparent = _format_traceparent(trace_id, os.urandom(8).hex(), False)
+            token = _CURRENT_TRACEPARENT.set(traceparent)
+
+            try:
+                yield traceparent
+            finally:
+                _CURRENT_TRACEPARENT.reset(token)
+
+            return
+
+        with self.__span(
+            name, trace_id, None, attributes, kind, start_time_ns
+        ) as traceparent:
+            yield traceparent
+
+    # Дочерний спан traceparent'а (по умолчанию текущего контекста).
+    # Если контекста нет или трасса не сэмплирована, ничего не записывается.
+    @contextmanager
+    def span(
+        self,
+        name: str,
+        traceparent: str | None = None,
+        attributes: dict | None = None,
+        kind: int = SPAN_KIND_INTERNAL,
+        start_time_ns: int | None = None,
+    ):
+        if traceparent is None:
+            traceparent = current_traceparent()
+
+        parsed = _parse_traceparent(traceparent)
+
+        if parsed is None or not parsed[2] or self.__exporter is None:
+            token = _CURRENT_TRACEPARENT.set(traceparent)
+
+            try:
+                yield traceparent
+            finally:
+                _CURRENT_TRACEPARENT.reset(token)
+
+            return
+
+        trace_id, parent_span_id, _ = parsed
+
+        with self.__span(
+            name, trace_id, parent_span_id, attributes, kind, start_time_ns
+        ) as child_traceparent:
+            yield child_traceparent
+
+    # Спан с уже известными началом и концом, например ожидание в spool.
+    def record_span(
+        self,
+        name: str,
+        traceparent: str | None,
+        start_time_ns: int,
+        end_time_ns: int,
+        attributes: dict | None = None,
+    ):
+        parsed = _parse_traceparent(traceparent)
+
+        if parsed is None or not parsed[2] or self.__exporter is None:
+            return
+
+        trace_id, parent_span_id, _ = parsed
+
+        self.__export(
+            name,
+            trace_id,
+            os.urandom(8).hex(),
+            parent_span_id,
+            attributes,
+            SPAN_KIND_INTERNAL,
+            start_time_ns,
+            end_time_ns,
+            STATUS_CODE_OK,
+        )
+
+    @contextmanager
+    def __span(
+        self,
+        name: str,
+        trace_id: str,
+        parent_span_id: str | None,
+        attributes: dict | None,
+        kind: int,
+        start_time_ns: int | None,
+    ):
+        span_id = os.urandom(8).hex()
+        traceparent = _format_traceparent(trace_id, span_id, True)
+        token = _CURRENT_TRACEPARENT.set(traceparent)
+        started_at = start_time_ns or time.time_ns()
+        status_code = STATUS_CODE_OK
+
+        try:
+            yield traceparent
+        except BaseException:
+            status_code = STATUS_CODE_ERROR
+            raise
+        finally:
+            _CURRENT_TRACEPARENT.reset(token)
+
+            self.__export(
+                name,
+                trace_id,
+                span_id,
+                parent_span_id,
+                attributes,
+                kind,
+                started_at,
+                time.time_ns(),
+                status_code,
+            )
+
+    def __export(
+        self,
+        name: str,
+        trace_id: str,
+        span_id: str,
+        parent_span_id: str | None,
+        attributes: dict | None,
+        kind: int,
+        start_time_ns: int,
+        end_time_ns: int,
+        status_code: int,
+    ):
+        span = {
+            "traceId": trace_id,
+            "spanId": span_id,
+            "name": name,
+            "kind": kind,
+            "startTimeUnixNano": str(start_time_ns),
+            "endTimeUnixNano": str(end_time_ns),
+            "attributes": _otlp_attributes(attributes or {}),
+            "status": {"code": status_code},
+        }
+
+        if parent_span_id is not None:
+            span["parentSpanId"] = parent_span_id
+
+        try:
+            self.__exporter.export(span)
+        except Exception as e:
+            logging.error(f"exporting span {name} failed: {e}")
+
+
+TRACER = Tracer()
@@ -0,0 +1,158 @@
+import orjson
+import logging
+
+from typing import Literal
+from typing import Callable
+from pathlib import Path
+from pydantic import Field
+from pydantic import BaseModel
+from pydantic import ConfigDict
+from pydantic import model_validator
+
+from config import Config
+
+# Параметры пропускной способности, которые меняются без перезапуска сервиса.
+# Обработчики читают их из TUNING.values на каждом проходе цикла, поэтому новое
+# значение применяется к следующему проходу, а начатая работа дорабатывает
+# со старым. Значения по умолчанию берутся из окружения (Config), поверх них -
+# из файла config.tuning_file, который перечитывается при запуске и по SIGHUP.
+# Изменения через /admin/tuning действуют до перезапуска или следующего SIGHUP.
+# Новые значения проверяются целиком и применяются, только если верны все.
+
+LOG_LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+    "critical": logging.CRITICAL,
+}
+
+
+class TuningValues(BaseModel):
+    model_config = ConfigDict(extra="forbid", frozen=True)
+
+    # Пауза между проходами очереди webhook'ов, секунды.
+    webhook_pause: float = Field(10, gt=0)
+    # Режим догоняния: если в очереди больше webhook_backlog_threshold webhook'ов
+    # (например, после недоступности Postgres), они обрабатываются пачками по
+    # webhook_backlog_batch_size в одной транзакции, каждый в своей точке
+    # сохранения. Обычный режим возвращается, когда очередь спадет до
+    # webhook_backlog_exit_threshold.
+    webhook_backlog_threshold: int = Field(200, ge=1)
+    webhook_backlog_exit_threshold: int = Field(50, ge=0)
+    webhook_backlog_batch_size: int = Field(50, ge=1)
+
+    # Пауза между проходами очереди задач RWMS и число задач, которые
+    # выполняются одновременно (задачи одного пользователя - всегда по очереди).
+    rwms_task_pause: float = Field(10, gt=0)
+    rwms_concurrency: int = Field(1, ge=1, le=64)
+    # Неудачная задача RWMS повторяется через rwms_task_retry_delay секунд,
+    # задержка удваивается с каждой попыткой до rwms_task_max_retry_delay.
+    # После rwms_task_max_attempts попыток задача откладывается в failed/.
+    rwms_task_max_attempts: int = Field(20, ge=1)
+    rwms_task_retry_delay: float = Field(10, gt=0)
+    rwms_task_max_retry_delay: float = Field(3600, gt=0)
+
+    notification_relay_batch_size: int = Field(200, ge=1)
+    notification_relay_pause: float = Field(1, gt=0)
+    # Сколько ждать после первого сообщения, чтобы собрать в один pipeline
+    # сообщения параллельно завершившихся транзакций.
+    notification_relay_coalesce_window: float = Field(0.01, ge=0, le=1)
+
+    event_log_flush_size: int = Field(500, ge=1)
+    event_log_flush_interval: float = Field(5, gt=0)
+
+    user_id_cache_size: int = Field(10000, ge=0)
+    user_id_cache_ttl: float = Field(3600, ge=0)
+
+    log_level: Literal["debug", "info", "warning", "error", "critical"] = "info"
+    trace_sample_rate: float = Field(0.0, ge=0, le=1)
+
+    @model_validator(mode="after")
+    def check_backlog_thresholds(self) -> "TuningValues":
+        if self.webhook_backlog_exit_threshold >= self.webhook_backlog_threshold:
+            raise ValueError(
+                "webhook_backlog_exit_threshold must be below webhook_backlog_threshold"
+            )
+
+        return self
+
+
+class Tuning:
+    def __init__(self):
+        self.values = TuningValues()
+        self.__defaults = self.values
+        self.__path: Path | None = None
+        self.__listeners: list[Callable[[TuningValues], None]] = []
+
+    def configure(self, config: Config):
+        self.__path = Path(config.tuning_file)
+
+        log_level = config.log_level.lower()
+
+        self.__defaults = TuningValues(
+            log_level=log_level if log_level in LOG_LEVELS else "info",
+            user_id_cache_size=config.user_id_cache_size,
+            user_id_cache_ttl=config.user_id_cache_ttl,
+            trace_sample_rate=config.trace_sample_rate,
+        )
+        self.__apply(self.__defaults)
+
+    # Callback вызывается сразу и после каждого изменения - для параметров,
+    # которые нужно применить к объекту, а не прочитать на следующем проходе.
+    def on_change(self, callback: Callable[[TuningValues], None]):
+        self.__listeners.append(callback)
+        callback(self.values)
+
+    # Частичное изменение поверх текущих значений. Бросает pydantic.ValidationError.
+    def update(self, changes: dict) -> TuningValues:
+        values = TuningValues.model_validate({**self.values.model_dump(), **changes})
+        self.__apply(values)
+        return values
+
+    # Значения из файла поверх значений по умолчанию. Отсутствующий файл - это
+    # значения по умолчанию. Бросает ValueError (включая ValidationError).
+    def reload(self) -> TuningValues:
+        overrides = {}
+
+        if self.__path is not None and self.__path.exists():
+            overrides = orjson.loads(self.__path.read_bytes())
+
+            if not isinstance(overrides, dict):
+                raise ValueError(f"{self.__path} must contain a JSON object")
+
+        values = TuningValues.model_validate(
+            {**self.__defaults.model_dump(), **overrides}
+        )
+        self.__apply(values)
+        return values
+
+    def __apply(self, values: TuningValues):
+        changes = {
+            name: value
+            for name, value in values.model_dump().items()
+            if getattr(self.values, name) != value
+        }
+
+        self.values = values
+
+        for callback in self.__listeners:
+            try:
+                callback(values)
+            except Exception as e:
+                logging.error(f"applying tuning failed: {e}", exc_info=True)
+
+        if changes:
+            logging.warning(f"tuning changed: {changes}")
+
+
+def apply_log_level(values: TuningValues):
+    level = LOG_LEVELS[values.log_level]
+    root = logging.getLogger()
+    root.setLevel(level)
+
+    for handler in root.handlers:
+        handler.setLevel(level)
+
+
+TUNING = Tuning()
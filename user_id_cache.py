@@ -0,0 +1,91 @@
+import time
+import logging
+
+from typing import Optional
+from collections import OrderedDict
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from metrics import USER_ID_CACHE_SIZE
+from metrics import USER_ID_CACHE_LOOKUPS_TOTAL
+from statements import SELECT_USER_ID_BY_USERNAME
+
+DEFAULT_USER_ID_CACHE_SIZE = 10000
+DEFAULT_USER_ID_CACHE_TTL = 3600  # seconds
+
+
+# Общий на процесс кэш соответствия username -> User.id.
+# Соответствие практически не меняется, поэтому точечный запрос в базу
+# на каждый платеж/событие не нужен. Отсутствующих пользователей не кэшируем,
+# чтобы только что зарегистрированный пользователь сразу находился. Сервис
+# сам пользователей не меняет, поэтому устаревание записей ограничено ttl.
+# Попадания, промахи и размер кэша - в метриках (metrics.py).
+class UserIdCache:
+    def __init__(
+        self,
+        max_size: int = DEFAULT_USER_ID_CACHE_SIZE,
+        ttl: float = DEFAULT_USER_ID_CACHE_TTL,
+    ):
+        self.__entries: OrderedDict[str, tuple[int, float]] = OrderedDict()
+        self.__max_size = max_size
+        self.__ttl = ttl
+
+    def configure(self, max_size: int, ttl: float):
+        self.__max_size = max_size
+        self.__ttl = ttl
+        self.__evict_overflow()
+
+    def get(self, username: str) -> Optional[int]:
+        entry = self.__entries.get(username)
+
+        if entry is None:
+            USER_ID_CACHE_LOOKUPS_TOTAL.labels("miss").inc()
+            return None
+
+        user_id, expires_at = entry
+
+        if expires_at <= time.monotonic():
+            del self.__entries[username]
+            USER_ID_CACHE_LOOKUPS_TOTAL.labels("miss").inc()
+            return None
+
+        self.__entries.move_to_end(username)
+        USER_ID_CACHE_LOOKUPS_TOTAL.labels("hit").inc()
+        return user_id
+
+    def put(self, username: str, user_id: int):
+        if self.__max_size <= 0:
+            return
+
+        self.__entries[username] = (user_id, time.monotonic() + self.__ttl)
+        self.__entries.move_to_end(username)
+        self.__evict_overflow()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def clear(self):
+        self.__entries.clear()
+
+    def __evict_overflow(self):
+        while len(self.__entries) > max(self.__max_size, 0):
+            self.__entries.popitem(last=False)
+
+
+USER_ID_CACHE = UserIdCache()
+USER_ID_CACHE_SIZE.set_function(lambda: len(USER_ID_CACHE))
+
+
+async def resolve_user_id(session: AsyncSession, username: str) -> Optional[int]:
+    user_id = USER_ID_CACHE.get(username)
+
+    if user_id is not None:
+        return user_id
+
+    user_id = await session.scalar(SELECT_USER_ID_BY_USERNAME, {"username": username})
+
+    if user_id is not None:
+        USER_ID_CACHE.put(username, user_id)
+    else:
+        logging.debug(f"user id for username {username} not found in database")
+
+    return user_id
@@ -0,0 +1,197 @@
+import orjson
+
+from typing import Any, Union
+from typing import Annotated
+from pydantic import Tag
+from pydantic import BaseModel
+from pydantic import TypeAdapter
+from pydantic import Discriminator
+
+from metadata import Metadata
+from partitions import user_partition_key
+
+PAYMENT_SUCCEEDED = "payment.succeeded"
+PAYMENT_CANCELED = "payment.canceled"
+PAYMENT_WAITING_FOR_CAPTURE = "payment.waiting_for_capture"
+REFUND_SUCCEEDED = "refund.succeeded"
+
+# События, для которых есть обработчики. Остальные уведомления подтверждаются
+# сразу при приеме и не сохраняются на диск.
+HANDLED_EVENTS = frozenset((PAYMENT_SUCCEEDED, PAYMENT_CANCELED, REFUND_SUCCEEDED))
+
+# Компактное представление уведомлений YooKassa. Валидируются только поля,
+# которые читают обработчики, остальные поля JSON игнорируются.
+
+
+class Amount(BaseModel):
+    value: str
+    currency: str
+
+
+class PaymentMethod(BaseModel):
+    id: str
+    saved: bool = False
+
+
+class Payment(BaseModel):
+    id: str
+    status: str
+    amount: Amount
+    metadata: Metadata
+    payment_method: PaymentMethod | None = None
+    captured_at: str | None = None
+    created_at: str
+
+
+class Refund(BaseModel):
+    id: str
+    payment_id: str
+    status: str
+
+
+class PaymentNotification(BaseModel):
+    event: str
+    object: Payment
+
+
+class RefundNotification(BaseModel):
+    event: str
+    object: Refund
+
+
+class OtherNotificationObject(BaseModel):
+    id: str
+
+
+# Уведомления, для которых обработчиков нет (ожидание подтверждения, сделки, выплаты).
+# Объект у них читается только ради ID для логов, трасс и журнала времени.
+class OtherNotification(BaseModel):
+    event: str
+    object: OtherNotificationObject | None = None
+
+
+# ID объекта уведомления любого типа, None - если объекта в уведомлении нет.
+def get_notification_id(
+    notification: PaymentNotification | RefundNotification | OtherNotification,
+) -> str | None:
+    if notification.object is None:
+        return None
+
+    return notification.object.id
+
+
+# Минимум, который нужен при приеме webhook'а: тип события, ID объекта и
+# ключ раздела spool - username платежа или исходный платеж возврата.
+class EnvelopeMetadata(BaseModel):
+    username: str | None = None
+
+
+class NotificationObjectId(BaseModel):
+    id: str
+    payment_id: str | None = None
+    metadata: EnvelopeMetadata | None = None
+
+
+class NotificationEnvelope(BaseModel):
+    event: str
+    object: NotificationObjectId
+
+
+# События одного пользователя попадают в один раздел spool: платежи - по
+# username, возвраты - по исходному платежу. Задачи RWMS того же пользователя
+# используют тот же ключ.
+def get_partition_key(envelope: NotificationEnvelope) -> str:
+    notification_object = envelope.object
+
+    if envelope.event == REFUND_SUCCEEDED and notification_object.payment_id:
+        return f"payment:{notification_object.payment_id}"
+
+    if notification_object.metadata and notification_object.metadata.username:
+        return user_partition_key(notification_object.metadata.username)
+
+    return f"payment:{notification_object.id}"
+
+
+def _notification_kind(value: Any) -> str:
+    if isinstance(value, dict):
+        event = value.get("event")
+    else:
+        event = getattr(value, "event", None)
+
+    if event in (PAYMENT_SUCCEEDED, PAYMENT_CANCELED):
+        return "payment"
+
+    if event == REFUND_SUCCEEDED:
+        return "refund"
+
+    return "other"
+
+
+Notification = Annotated[
+    Union[
+        Annotated[PaymentNotification, Tag("payment")],
+        Annotated[RefundNotification, Tag("refund")],
+        Annotated[OtherNotification, Tag("other")],
+    ],
+    Discriminator(_notification_kind),
+]
+
+NOTIFICATION_ADAPTER = TypeAdapter(Notification)
+
+
+# Разбор уведомления сразу из байтов запроса, вместе с валидацией Metadata.
+# При невалидном уведомлении бросает pydantic.ValidationError.
+def decode_notification(
+    data: bytes | str,
+) -> PaymentNotification | RefundNotification | OtherNotification:
+    return NOTIFICATION_ADAPTER.validate_json(data)
+
+
+def decode_envelope(data: bytes | str) -> NotificationEnvelope:
+    return NotificationEnvelope.model_validate_json(data)
+
+
+# Формат webhook'а в spool: исходное тело уведомления вложено без пересериализации
+# вместе с traceparent трассы. Файлы, сохраненные до появления трассировки,
+# содержат только тело уведомления.
+SPOOLED_WEBHOOK_PREFIX = b'{"traceparent":'
+
+
+class SpooledWebhook(BaseModel):
+    traceparent: str | None = None
+    notification: Notification
+
+
+def encode_spooled_webhook(body: bytes, traceparent: str | None) -> bytes:
+    return (
+        SPOOLED_WEBHOOK_PREFIX
+        + orjson.dumps(traceparent)
+        + b',"notification":'
+        + body
+        + b"}"
+    )
+
+
+class SpooledEnvelope(BaseModel):
+    traceparent: str | None = None
+    notification: NotificationEnvelope
+
+
+# Ключ раздела webhook'а из файла spool без полной валидации уведомления.
+def get_spooled_webhook_partition_key(data: bytes) -> str:
+    if data.startswith(SPOOLED_WEBHOOK_PREFIX):
+        envelope = SpooledEnvelope.model_validate_json(data).notification
+    else:
+        envelope = decode_envelope(data)
+
+    return get_partition_key(envelope)
+
+
+def decode_spooled_webhook(
+    data: bytes,
+) -> tuple[PaymentNotification | RefundNotification | OtherNotification, str | None]:
+    if data.startswith(SPOOLED_WEBHOOK_PREFIX):
+        spooled = SpooledWebhook.model_validate_json(data)
+        return spooled.notification, spooled.traceparent
+
+    return decode_notification(data), None
@@ -1,114 +1,460 @@
-import orjson
+import time
 import logging
 import asyncio
 import pydantic
 
 from pathlib import Path
+from collections import Counter
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import async_sessionmaker
-from yookassa.domain.notification import WebhookNotification
-from yookassa.domain.notification import WebhookNotificationFactory
-from yookassa.domain.notification import WebhookNotificationEventType
 
 from config import Config
-from metadata import Metadata
-from common.rwms_client import RwmsClient
-from redis_message_publisher import RedisMessagePublisher
+from after_commit import savepoint
+from webhook_decoder import Payment
+from webhook_decoder import Notification
+from webhook_decoder import PAYMENT_SUCCEEDED
+from webhook_decoder import PAYMENT_CANCELED
+from webhook_decoder import PAYMENT_WAITING_FOR_CAPTURE
+from webhook_decoder import REFUND_SUCCEEDED
+from webhook_decoder import decode_spooled_webhook
+from webhook_decoder import get_notification_id
+from webhook_spool import WebhookSpoolPartition
+from webhook_spool import HIGH_PRIORITY
+from webhook_spool import get_priority
+from partitions import SHARDS
+from event_log_writer import EventLogWriter
+from notification_outbox import NotificationOutbox
+from refund_handlers import RefundedPaymentNotFound
 from refund_handlers import handle_succeeded_refund
+from refund_handlers import process_succeeded_refund
 from payment_handlers import handle_canceled_payment
 from payment_handlers import handle_succeeded_payment
+from payment_handlers import process_canceled_payment
+from payment_handlers import process_succeeded_payment
 from rwms_tasks_processor import RwmsTasksProcessor
+from partition_ownership import PartitionOwnership
+from tracing import TRACER
+from tuning import TUNING
+from slow_webhooks import SLOW_WEBHOOKS
+from metrics import QUEUE_WAIT_SECONDS
+from metrics import DB_TRANSACTION_SECONDS
+from metrics import WEBHOOKS_PROCESSED_TOTAL
+from metrics import webhook_event_label
 
-PROCESS_WEBHOOK_PAUSE = 10  # seconds
+# Паузы и размеры пачек режима догоняния - в TUNING (tuning.py), они
+# читаются на каждом проходе и меняются без перезапуска.
+
+# Сколько секунд с приема webhook'а возврат ждет в очереди своего платежа
+# (refund_handlers.RefundedPaymentNotFound). Дольше - возврат остается в
+# processing для разбора, как webhook с ошибкой.
+REFUND_PAYMENT_WAIT = 3600
+
+# Обработчик отвечает за один раздел очереди (partitions.py) и проходит по
+# нему, только пока процесс владеет разделом. Владение проверяется перед
+# каждым webhook'ом и пачкой: если аренда потеряна, проход прерывается, не
+# дожидаясь конца очереди, чтобы не обрабатывать раздел вместе с новым владельцем.
 
 
 class WebhookProcessor:
     def __init__(
         self,
-        publisher: RedisMessagePublisher,
+        partition: WebhookSpoolPartition,
+        ownership: PartitionOwnership,
+        outbox: NotificationOutbox,
+        event_log_writer: EventLogWriter,
         rwms_tasks_processor: RwmsTasksProcessor,
         session_maker: async_sessionmaker,
         config: Config,
     ):
-        self.__publisher = publisher
+        self.__outbox = outbox
+        self.__event_log_writer = event_log_writer
         self.__rwms_tasks_processor = rwms_tasks_processor
         self.__config = config
-        self.__rwms_client = RwmsClient(addr=config.rwms_address, port=config.rwms_port)
         self.__session_maker = session_maker
 
-        self.__webhooks_dir = Path("webhooks")
-        self.__pending_dir = self.__webhooks_dir / "pending"
-        self.__processing_dir = self.__webhooks_dir / "processing"
-
-        self.__webhooks_dir.mkdir(parents=True, exist_ok=True)
-        self.__pending_dir.mkdir(parents=True, exist_ok=True)
-        self.__processing_dir.mkdir(parents=True, exist_ok=True)
-
-    def schedule(self, event_id: str, body: str):
-        logging.info(f"writing webhook {event_id} to disk")
+        self.__partition = partition
+        self.__ownership = ownership
 
-        filename = f"{event_id}.json"
-
-        path = self.__pending_dir / filename
-        path.write_text(body)
-
-        logging.info(f"webhook {event_id} saved on disk at {path}")
+        self.__backlog_mode = False
+        self.__backlog_shard = 0
+        self.__backlog_shard_sizes: Counter[str] = Counter()
+        self.__backlog_urgent = False
 
     async def process(self):
         while True:
-            files = self.__get_pending_webhooks()
+            await self.__ownership.wait_owned(self.__partition.index)
 
-            for file in files:
-                processing = self.__mark_webhook_as_processing(file)
+            with self.__ownership.hold(self.__partition.index):
+                drained = await self.__process_pending()
 
+            if drained:
                 try:
-                    ET = WebhookNotificationEventType
-                    logging.info(f"took {processing.name} to handle")
-                    event, response = await self.__parse_webhook_from_file(processing)
+                    await asyncio.wait_for(
+                        self.__partition.scheduled.wait(),
+                        timeout=TUNING.values.webhook_pause,
+                    )
+                except asyncio.TimeoutError:
+                    pass
+
+    # Один проход по очереди раздела. Возвращает True, если очередь разобрана
+    # и можно ждать новых webhook'ов.
+    async def __process_pending(self) -> bool:
+        self.__partition.scheduled.clear()
+        self.__partition.high_priority_scheduled = False
+
+        if self.__backlog_mode:
+            await self.__process_backlog_shard()
+            return False
+
+        self.__partition.high_priority_shards.clear()
+
+        files = self.__get_pending_webhooks()
+
+        if len(files) > TUNING.values.webhook_backlog_threshold:
+            logging.warning(f"{len(files)} pending webhooks, switching to backlog mode")
+            self.__backlog_mode = True
+            self.__backlog_shard = 0
+            self.__backlog_shard_sizes = Counter(file.parent.name for file in files)
+            return False
+
+        for file in files:
+            if self.__lease_lost():
+                return False
+
+            # Пришел успешный платеж, а впереди только менее важные события -
+            # перечитываем очередь, чтобы активация не ждала их обработки.
+            if (
+                self.__partition.high_priority_scheduled
+                and get_priority(file) != HIGH_PRIORITY
+            ):
+                logging.info("high priority webhook scheduled, rescanning queue")
+                return False
+
+            await self.__process_webhook(file)
+
+        return True
+
+    # В режиме догоняния каждая пачка читает одну поддиректорию очереди, а не
+    # всю очередь: поддиректории обходятся по кругу, поддиректории с новыми
+    # важными webhook'ами - через пачку вне очереди. Размер очереди оценивается
+    # по размерам поддиректорий за последний круг, по нему режим и выключается.
+    async def __process_backlog_shard(self):
+        urgent = self.__partition.high_priority_shards and not self.__backlog_urgent
+        self.__backlog_urgent = bool(urgent)
+
+        if urgent:
+            shard = self.__partition.high_priority_shards.pop()
+        else:
+            shard = SHARDS[self.__backlog_shard]
+            self.__backlog_shard = (self.__backlog_shard + 1) % len(SHARDS)
+
+        files = self.__get_pending_webhooks(shard)
+        self.__backlog_shard_sizes[shard] = len(files)
+
+        if files:
+            await self.__process_backlog_batch(files)
+
+        if urgent or self.__backlog_shard != 0:
+            return
+
+        pending = sum(self.__backlog_shard_sizes.values())
 
-                    if event == ET.PAYMENT_SUCCEEDED:
-                        await self.__on_payment_succeeded(processing, response)
+        if pending <= TUNING.values.webhook_backlog_exit_threshold:
+            logging.info(f"{pending} pending webhooks, switching back to normal mode")
+            self.__backlog_mode = False
 
-                    elif event == ET.PAYMENT_WAITING_FOR_CAPTURE:
-                        logging.info(f"{processing.name} is waiting for capture")
-                        self.__remove_file(processing)
+    async def __process_webhook(self, file: Path):
+        processing = self.__mark_webhook_as_processing(file)
+        event = "unknown"
+        outcome = "failed"
 
-                    elif event == ET.PAYMENT_CANCELED:
-                        await self.__on_payment_canceled(processing, response)
+        with SLOW_WEBHOOKS.record("webhook", processing) as timing:
+            try:
+                logging.info(f"took {processing.name} to handle")
 
-                    elif event == ET.REFUND_SUCCEEDED:
-                        await handle_succeeded_refund(self.__session_maker, response)
+                with timing.stage("parse"):
+                    notification, traceparent = self.__parse_webhook_from_file(
+                        processing
+                    )
 
-                    elif event == ET.DEAL_CLOSED:
-                        ...
+                event = notification.event
+                timing.event = event
+                timing.payment_id = get_notification_id(notification)
+                self.__record_queue_span(processing, notification, traceparent)
+
+                with TRACER.span(
+                    "webhook.process",
+                    traceparent,
+                    self.__get_span_attributes(notification),
+                ):
+                    outcome = await self.__dispatch_webhook(processing, notification)
+            except pydantic.ValidationError:
+                # Возможно здесь нужно удалить .processing webhook файл
+                logging.warning(
+                    f"invalid webhook or metadata in {processing.name}",
+                    exc_info=True,
+                )
+                outcome = "invalid"
+            except Exception as e:
+                logging.error(
+                    f"error processing file {processing.name}: {e}", exc_info=True
+                )
+
+            timing.outcome = outcome
+
+        WEBHOOKS_PROCESSED_TOTAL.labels(webhook_event_label(event), outcome).inc()
+
+    async def __dispatch_webhook(self, processing: Path, notification: Notification):
+        event = notification.event
 
-                    elif event == ET.PAYOUT_SUCCEEDED:
-                        ...
+        if event == PAYMENT_SUCCEEDED:
+            success = await self.__on_payment_succeeded(processing, notification.object)
+            return "processed" if success else "failed"
 
-                    elif event == ET.PAYOUT_CANCELED:
-                        ...
+        if event == PAYMENT_CANCELED:
+            success = await self.__on_payment_canceled(processing, notification.object)
+            return "processed" if success else "failed"
 
-                    else:
-                        logging.debug(
-                            f"skipping uninteresting webhook in file {processing.name}"
-                        )
-                        self.__remove_file(processing)
-                except Exception as e:
-                    logging.error(
-                        f"error processing file {processing.name}: {e}", exc_info=True
+        if event == REFUND_SUCCEEDED:
+            try:
+                with DB_TRANSACTION_SECONDS.labels(event).time():
+                    success = await handle_succeeded_refund(
+                        self.__session_maker, notification.object
                     )
+            except RefundedPaymentNotFound as e:
+                return self.__wait_for_refunded_payment(processing, e)
+
+            self.__remove_on_success(success, processing)
+            return "processed" if success else "failed"
+
+        if event == PAYMENT_WAITING_FOR_CAPTURE:
+            logging.info(f"{processing.name} is waiting for capture")
+        else:
+            logging.debug(f"skipping uninteresting webhook in file {processing.name}")
+
+        self.__remove_file(processing)
+        return "skipped"
+
+    # Ожидание в spool - отдельный спан от записи файла до начала обработки.
+    def __record_queue_span(
+        self, processing: Path, notification: Notification, traceparent: str | None
+    ):
+        TRACER.record_span(
+            "webhook.queue",
+            traceparent,
+            start_time_ns=processing.stat().st_mtime_ns,
+            end_time_ns=time.time_ns(),
+            attributes=self.__get_span_attributes(notification),
+        )
+
+    def __get_span_attributes(self, notification: Notification) -> dict:
+        attributes = {"event": notification.event}
+        notification_id = get_notification_id(notification)
+
+        if notification_id is not None:
+            attributes["payment.id"] = notification_id
+
+        return attributes
+
+    # Обработка пачки webhook'ов одной транзакцией. В пачку попадает не больше
+    # одного webhook'а на пользователя (платеж) - остальные ждут следующей пачки,
+    # чтобы события одного пользователя применялись по очереди. Ошибка webhook'а
+    # откатывает только его точку сохранения, ошибка коммита возвращает всю
+    # пачку в очередь.
+    async def __process_backlog_batch(self, files: list[Path]):
+        batch = []
+        owners = set()
+        batch_size = TUNING.values.webhook_backlog_batch_size
+
+        for file in files:
+            if len(batch) >= batch_size or self.__lease_lost():
+                break
+
+            parse_started_at = time.perf_counter()
+
+            try:
+                notification, traceparent = self.__parse_webhook_from_file(file)
+            except Exception:
+                # Разбор повторится в обычной обработке, которая и разберется с файлом.
+                await self.__process_webhook(file)
+                continue
+
+            if notification.event not in (
+                PAYMENT_SUCCEEDED,
+                PAYMENT_CANCELED,
+                REFUND_SUCCEEDED,
+            ):
+                await self.__process_webhook(file)
+                continue
+
+            owner = self.__get_webhook_owner(notification)
+
+            if owner in owners:
+                continue
+
+            owners.add(owner)
+            parse_seconds = time.perf_counter() - parse_started_at
+            processing = self.__mark_webhook_as_processing(file)
+            self.__record_queue_span(processing, notification, traceparent)
+            batch.append((processing, notification, traceparent, parse_seconds))
+
+        if not batch:
+            return
+
+        if self.__lease_lost():
+            for processing, _, _, _ in batch:
+                self.__return_webhook_to_pending(processing)
+            return
+
+        processed = []
+        failed = []
+        waiting = []
+
+        try:
+            with DB_TRANSACTION_SECONDS.labels("backlog-batch").time():
+                async with self.__session_maker() as session:
+                    async with session.begin():
+                        for item in batch:
+                            await self.__apply_batched_webhook(
+                                session, *item, processed, failed, waiting
+                            )
+        except Exception as e:
+            logging.error(f"committing backlog batch failed: {e}", exc_info=True)
+
+            for processing, notification, _, _ in batch:
+                self.__return_webhook_to_pending(processing)
+                WEBHOOKS_PROCESSED_TOTAL.labels(
+                    webhook_event_label(notification.event), "retried"
+                ).inc()
+
+            # База, скорее всего, недоступна - не повторяем пачку сразу.
+            await asyncio.sleep(TUNING.values.webhook_pause)
+            return
 
-            await asyncio.sleep(PROCESS_WEBHOOK_PAUSE)
+        for processing, notification in processed:
+            self.__remove_file(processing)
+            WEBHOOKS_PROCESSED_TOTAL.labels(
+                webhook_event_label(notification.event), "processed"
+            ).inc()
+
+        for _, notification in failed:
+            WEBHOOKS_PROCESSED_TOTAL.labels(
+                webhook_event_label(notification.event), "failed"
+            ).inc()
+
+        for processing, notification, error in waiting:
+            outcome = self.__wait_for_refunded_payment(processing, error)
+            WEBHOOKS_PROCESSED_TOTAL.labels(
+                webhook_event_label(notification.event), outcome
+            ).inc()
+
+        logging.info(
+            f"backlog batch committed: {len(processed)} of {len(batch)} webhooks processed"
+        )
+
+    # Запись о времени обработки в пачке покрывает только точку сохранения
+    # webhook'а: коммит общий для всей пачки.
+    async def __apply_batched_webhook(
+        self,
+        session: AsyncSession,
+        processing: Path,
+        notification: Notification,
+        traceparent: str | None,
+        parse_seconds: float,
+        processed: list,
+        failed: list,
+        waiting: list,
+    ):
+        with SLOW_WEBHOOKS.record("webhook", processing) as timing:
+            timing.add("parse", parse_seconds)
+            timing.event = notification.event
+
+            try:
+                timing.payment_id = get_notification_id(notification)
+
+                with TRACER.span(
+                    "webhook.process",
+                    traceparent,
+                    self.__get_span_attributes(notification),
+                ):
+                    async with savepoint(session):
+                        await self.__apply_webhook(session, notification)
+
+                processed.append((processing, notification))
+                timing.outcome = "processed"
+            except RefundedPaymentNotFound as e:
+                waiting.append((processing, notification, e))
+                timing.outcome = "retried"
+            except Exception as e:
+                logging.error(
+                    f"error processing file {processing.name} in backlog batch: {e}",
+                    exc_info=True,
+                )
+                failed.append((processing, notification))
+                timing.outcome = "failed"
+
+    async def __apply_webhook(self, session: AsyncSession, notification: Notification):
+        event = notification.event
+
+        if event == PAYMENT_SUCCEEDED:
+            await process_succeeded_payment(
+                session=session,
+                outbox=self.__outbox,
+                event_log_writer=self.__event_log_writer,
+                tasks_processor=self.__rwms_tasks_processor,
+                payment=notification.object,
+                metadata=notification.object.metadata,
+            )
+
+        elif event == PAYMENT_CANCELED:
+            await process_canceled_payment(
+                session=session,
+                outbox=self.__outbox,
+                event_log_writer=self.__event_log_writer,
+                payment=notification.object,
+                metadata=notification.object.metadata,
+            )
+
+        elif event == REFUND_SUCCEEDED:
+            await process_succeeded_refund(session, notification.object)
+
+    def __lease_lost(self) -> bool:
+        if self.__ownership.owns(self.__partition.index):
+            return False
+
+        logging.warning(
+            f"lease of partition {self.__partition.index} lost, aborting the pass"
+        )
+        return True
 
-    def __get_pending_webhooks(self):
+    # Платежи группируются по пользователю, возвраты - по исходному платежу.
+    def __get_webhook_owner(self, notification: Notification) -> str:
+        if notification.event == REFUND_SUCCEEDED:
+            return f"payment:{notification.object.payment_id}"
+
+        return f"user:{notification.object.metadata.username}"
+
+    def __get_pending_webhooks(self, shard: str | None = None) -> list[Path]:
         return sorted(
-            self.__pending_dir.glob("*.json"), key=lambda f: f.stat().st_ctime
+            self.__partition.list_pending(shard),
+            key=lambda f: (get_priority(f), f.stat().st_ctime),
         )
 
     def __mark_webhook_as_processing(self, file: Path) -> Path:
-        new_path = self.__processing_dir / file.name
+        QUEUE_WAIT_SECONDS.labels("webhooks").observe(
+            max(time.time() - file.stat().st_mtime, 0.0)
+        )
+
+        new_path = self.__partition.processing_path(file.parent.name, file.name)
         file.rename(new_path)
         return new_path
 
+    def __return_webhook_to_pending(self, file: Path):
+        try:
+            file.rename(self.__partition.pending_path(file.parent.name, file.name))
+        except Exception as e:
+            logging.error(f"failed to return {file.name} to pending: {e}")
+
     def __remove_file(self, file: Path):
         try:
             file.unlink()
@@ -116,6 +462,19 @@ class WebhookProcessor:
         except Exception as e:
             logging.error(f"failed to remove {file.name}: {e}")
 
+    # Возврат, обработанный раньше своего платежа, возвращается в pending и
+    # повторяется на следующих проходах, пока не истечет REFUND_PAYMENT_WAIT.
+    def __wait_for_refunded_payment(
+        self, processing: Path, error: RefundedPaymentNotFound
+    ) -> str:
+        if time.time() - processing.stat().st_mtime > REFUND_PAYMENT_WAIT:
+            logging.error(f"{error}, leaving {processing.name} in processing")
+            return "failed"
+
+        logging.info(f"{error}, returning {processing.name} to pending")
+        self.__return_webhook_to_pending(processing)
+        return "retried"
+
     def __remove_on_success(self, success: bool, file: Path):
         if not success:
             logging.info(f"success flag is false, do not remove {file}")
@@ -123,49 +482,32 @@ class WebhookProcessor:
 
         self.__remove_file(file)
 
-    async def __on_payment_succeeded(self, processing, response):
-        try:
-            metadata = Metadata.model_validate(response.metadata)
-        except pydantic.ValidationError:
-            # Возможно здесь нужно удалить .processing webhook файл
-            logging.warning(f"invalid metadata in webhook {processing.name}")
-            return
-
-        success = await handle_succeeded_payment(
-            publisher=self.__publisher,
-            tasks_processor=self.__rwms_tasks_processor,
-            rwms_client=self.__rwms_client,
-            config=self.__config,
-            session_maker=self.__session_maker,
-            payment=response,
-            metadata=metadata,
-        )
+    async def __on_payment_succeeded(self, processing: Path, payment: Payment) -> bool:
+        with DB_TRANSACTION_SECONDS.labels(PAYMENT_SUCCEEDED).time():
+            success = await handle_succeeded_payment(
+                outbox=self.__outbox,
+                event_log_writer=self.__event_log_writer,
+                tasks_processor=self.__rwms_tasks_processor,
+                session_maker=self.__session_maker,
+                payment=payment,
+                metadata=payment.metadata,
+            )
 
         self.__remove_on_success(success, processing)
-
-    async def __on_payment_canceled(self, processing, response):
-        try:
-            metadata = Metadata.model_validate(response.metadata)
-        except pydantic.ValidationError:
-            # Возможно здесь нужно удалить .processing webhook файл
-            logging.warning(f"invalid metadata in webhook {processing.name}")
-            return
-
-        success = await handle_canceled_payment(
-            publisher=self.__publisher,
-            session_maker=self.__session_maker,
-            payment=response,
-            metadata=metadata,
-        )
+        return success
+
+    async def __on_payment_canceled(self, processing: Path, payment: Payment) -> bool:
+        with DB_TRANSACTION_SECONDS.labels(PAYMENT_CANCELED).time():
+            success = await handle_canceled_payment(
+                outbox=self.__outbox,
+                event_log_writer=self.__event_log_writer,
+                session_maker=self.__session_maker,
+                payment=payment,
+                metadata=payment.metadata,
+            )
 
         self.__remove_on_success(success, processing)
+        return success
 
-    async def __parse_webhook_from_file(self, file) -> tuple[str, WebhookNotification]:
-        text = file.read_text()
-        json_data = orjson.loads(text)
-
-        notification = WebhookNotificationFactory().create(json_data)
-        event = notification.event
-        response = notification.object
-
-        return event, response
+    def __parse_webhook_from_file(self, file: Path) -> tuple[Notification, str | None]:
+        return decode_spooled_webhook(file.read_bytes())
@@ -0,0 +1,111 @@
+import logging
+import asyncio
+
+from pathlib import Path
+
+from webhook_decoder import PAYMENT_SUCCEEDED
+from webhook_decoder import PAYMENT_CANCELED
+from webhook_decoder import REFUND_SUCCEEDED
+from webhook_decoder import encode_spooled_webhook
+from webhook_decoder import get_spooled_webhook_partition_key
+from partitions import SpoolPartition
+from partitions import repartition
+from partitions import migrate_to_shards
+from partitions import get_shard
+from partitions import get_partition
+from partitions import get_partition_dir
+from metrics import track_spool_depth
+from metrics import SPOOL_WRITE_SECONDS
+
+# Очередь webhook'ов на диске. Прием webhook'а - только запись файла сюда,
+# поэтому модуль не зависит от базы, RWMS и обработчиков и загружается вместе
+# с HTTP-сервером, а WebhookProcessor'ы подключаются к разделам очереди позже.
+
+# Очередь обработки: сначала успешные платежи (активация подписки),
+# затем отмены и возвраты. Приоритет хранится в префиксе имени файла.
+HIGH_PRIORITY = 0
+LOW_PRIORITY = 1
+
+EVENT_PRIORITIES = {
+    PAYMENT_SUCCEEDED: HIGH_PRIORITY,
+    PAYMENT_CANCELED: LOW_PRIORITY,
+    REFUND_SUCCEEDED: LOW_PRIORITY,
+}
+
+
+# Файлы, сохраненные до появления приоритетов, обрабатываются как важные.
+def get_priority(file: Path) -> int:
+    if file.name[:1] == "p" and file.name[1:2].isdigit() and file.name[2:3] == "_":
+        return int(file.name[1])
+
+    return HIGH_PRIORITY
+
+
+class WebhookSpoolPartition(SpoolPartition):
+    def __init__(self, index: int, partition_dir: Path):
+        super().__init__(index, partition_dir)
+
+        # Будят WebhookProcessor раздела. Флаг важного webhook'а и поддиректории
+        # с новыми важными webhook'ами сбрасывает сам обработчик. Обработчик на
+        # другом узле будится только по таймауту.
+        self.scheduled = asyncio.Event()
+        self.high_priority_scheduled = False
+        self.high_priority_shards: set[str] = set()
+
+
+class WebhookSpool:
+    def __init__(self, partitions: int = 1):
+        self.webhooks_dir = Path("webhooks")
+        self.webhooks_dir.mkdir(parents=True, exist_ok=True)
+
+        repartition(self.webhooks_dir, partitions, get_spooled_webhook_partition_key)
+
+        self.partitions = [
+            WebhookSpoolPartition(
+                index, get_partition_dir(self.webhooks_dir, partitions, index)
+            )
+            for index in range(partitions)
+        ]
+
+        track_spool_depth(
+            "webhooks",
+            [partition.pending_dir for partition in self.partitions],
+            [partition.processing_dir for partition in self.partitions],
+        )
+
+    # Перенос файлов, записанных до появления поддиректорий. Только rename,
+    # поэтому выполняется в отдельном потоке после запуска сервера.
+    async def migrate_to_shards(self):
+        try:
+            await asyncio.to_thread(
+                migrate_to_shards, self.partitions, get_spooled_webhook_partition_key
+            )
+        except Exception as e:
+            logging.error(f"moving webhooks into shard directories failed: {e}")
+
+    def schedule(
+        self,
+        event_id: str,
+        event: str,
+        partition_key: str,
+        body: bytes,
+        traceparent: str | None = None,
+    ):
+        logging.info(f"writing webhook {event_id} to disk")
+
+        priority = EVENT_PRIORITIES.get(event, LOW_PRIORITY)
+        filename = f"p{priority}_{event_id}.json"
+
+        partition = self.partitions[get_partition(partition_key, len(self.partitions))]
+        path = partition.pending_path(get_shard(partition_key), filename)
+
+        with SPOOL_WRITE_SECONDS.labels("webhooks").time():
+            path.write_bytes(encode_spooled_webhook(body, traceparent))
+
+        logging.info(f"webhook {event_id} saved on disk at {path}")
+
+        if priority == HIGH_PRIORITY:
+            partition.high_priority_scheduled = True
+            partition.high_priority_shards.add(path.parent.name)
+
+        partition.scheduled.set()